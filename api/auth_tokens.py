@@ -0,0 +1,226 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+from uuid import UUID
+import supabase_client
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+except ImportError:     # optional, without it only HS256 tokens can be verified (start() says so)
+    InvalidSignature = None
+
+'''
+Local verification of Supabase access tokens, so authenticated endpoints don't call Supabase on every request.
+Signing keys come from the project's JWKS (/auth/v1/.well-known/jwks.json), refreshed in the background every
+JWKS_REFRESH_SECONDS and early (at most every JWKS_MIN_REFRESH_SECONDS) when a token names a key we don't know yet.
+Only asymmetric keys (RS256 / ES256, which need the cryptography package) are taken from the JWKS; symmetric "oct"
+entries are ignored and HS256 tokens are only accepted with the legacy shared secret from SUPABASE_JWT_SECRET.
+Tokens that verified are kept in a small LRU until they expire, a repeat request only costs a dict lookup; the LRU
+is dropped whenever the key set changes so a revoked key stops working at the next refresh.
+'''
+
+JWKS_REFRESH_SECONDS = float(os.getenv("JWKS_REFRESH_SECONDS", "600"))
+JWKS_MIN_REFRESH_SECONDS = float(os.getenv("JWKS_MIN_REFRESH_SECONDS", "30"))
+VERIFIED_TOKENS_MAX = int(os.getenv("VERIFIED_TOKENS_MAX", "1024"))
+AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+LEEWAY_SECONDS = 30         # clock skew allowed on exp / nbf
+
+
+class InvalidTokenError(ValueError):
+    pass
+
+
+def required() -> bool:
+    return os.getenv("AUTH_REQUIRED", "0") == "1"
+
+def _b64decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+def _b64int(segment: str) -> int:
+    return int.from_bytes(_b64decode(segment), "big")
+
+
+# Verifier for one JWK: (signing input, signature) -> bool
+def _hmac_verifier(secret: bytes) -> Callable[[bytes, bytes], bool]:
+    return lambda signing_input, signature: hmac.compare_digest(hmac.new(secret, signing_input, hashlib.sha256).digest(), signature)
+
+def _rsa_verifier(jwk: dict) -> Callable[[bytes, bytes], bool]:
+    key = rsa.RSAPublicNumbers(_b64int(jwk["e"]), _b64int(jwk["n"])).public_key()
+
+    def verify(signing_input: bytes, signature: bytes) -> bool:
+        try:
+            key.verify(signature, signing_input, padding.PKCS1v15(), hashes.SHA256())
+            return True
+        except InvalidSignature:
+            return False
+    return verify
+
+def _ec_verifier(jwk: dict) -> Callable[[bytes, bytes], bool]:
+    key = ec.EllipticCurvePublicNumbers(_b64int(jwk["x"]), _b64int(jwk["y"]), ec.SECP256R1()).public_key()
+
+    def verify(signing_input: bytes, signature: bytes) -> bool:
+        if len(signature) != 64:
+            return False
+        # JWS carries r || s, cryptography wants DER
+        der = utils.encode_dss_signature(int.from_bytes(signature[:32], "big"), int.from_bytes(signature[32:], "big"))
+        try:
+            key.verify(der, signing_input, ec.ECDSA(hashes.SHA256()))
+            return True
+        except InvalidSignature:
+            return False
+    return verify
+
+# kid -> (alg, verifier) for the public keys of a JWKS document we can check, the others are skipped
+def parse_jwks(document: dict) -> dict[str, tuple[str, Callable]]:
+    keys = {}
+    for jwk in document.get("keys", []):
+        kid, kty = jwk.get("kid"), jwk.get("kty")
+        # A shared secret has no business in a public key set, HS256 only comes from SUPABASE_JWT_SECRET
+        if not kid or jwk.get("use", "sig") != "sig" or kty == "oct" or InvalidSignature is None:
+            continue
+        if kty == "RSA":
+            keys[kid] = ("RS256", _rsa_verifier(jwk))
+        elif kty == "EC" and jwk.get("crv") == "P-256":
+            keys[kid] = ("ES256", _ec_verifier(jwk))
+    return keys
+
+
+_keys: dict[str, tuple[str, Callable]] = {}
+_keys_fingerprint = None
+_refreshed_at = 0.0                 # monotonic time of the last fetch attempt
+_refresh_lock: Optional[asyncio.Lock] = None
+_verified: OrderedDict[str, tuple[UUID, float]] = OrderedDict()      # token -> (caller, exp)
+_task: Optional[asyncio.Task] = None
+
+
+def set_keys(keys: dict[str, tuple[str, Callable]], fingerprint=None):
+    global _keys, _keys_fingerprint
+    if fingerprint is None or fingerprint != _keys_fingerprint:
+        _verified.clear()
+    _keys, _keys_fingerprint = keys, fingerprint
+
+def jwks_url() -> str:
+    return supabase_client.auth_url(".well-known/jwks.json")
+
+async def refresh_keys() -> int:
+    global _refreshed_at, _refresh_lock
+    _refresh_lock = _refresh_lock or asyncio.Lock()
+    async with _refresh_lock:
+        _refreshed_at = time.monotonic()
+        response = await supabase_client.get(jwks_url(), headers={"apikey": os.getenv("EXPO_PUBLIC_SUPABASE_ANON_KEY", "")})
+        if response.status_code >= 400:
+            raise supabase_client.UpstreamError(response.status_code, f"JWKS fetch answered {response.status_code}")
+        document = response.json()
+        set_keys(parse_jwks(document), json.dumps(document, sort_keys=True))
+    return len(_keys)
+
+async def _refresh_loop():
+    while True:
+        try:
+            await refresh_keys()
+            delay = JWKS_REFRESH_SECONDS
+        except (supabase_client.UpstreamError, ValueError, KeyError) as exc:
+            print(f"JWKS refresh failed ({exc}), keeping the current keys")
+            delay = JWKS_MIN_REFRESH_SECONDS
+        await asyncio.sleep(delay)
+
+# Starts the background key refresh on the running loop, called from the app lifespan
+def start():
+    global _task
+    if InvalidSignature is None:
+        if required() and not os.getenv("SUPABASE_JWT_SECRET"):
+            raise RuntimeError("AUTH_REQUIRED=1 needs the cryptography package (RS256 / ES256 keys) or SUPABASE_JWT_SECRET")
+        print("cryptography is not installed: RS256 / ES256 access tokens will be rejected, only HS256 with SUPABASE_JWT_SECRET works")
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_refresh_loop())
+
+async def stop():
+    global _task, _refresh_lock
+    task, _task = _task, None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    _refresh_lock = None
+
+
+def _verifier_for(alg: str, kid: Optional[str]) -> Optional[Callable]:
+    if alg == "HS256":
+        secret = os.getenv("SUPABASE_JWT_SECRET")
+        return _hmac_verifier(secret.encode()) if secret else None
+    if kid in _keys and _keys[kid][0] == alg:
+        return _keys[kid][1]
+    return None
+
+def _check(token: str, verifier: Callable, now: float) -> tuple[UUID, float]:
+    signing_input, _, signature = token.rpartition(".")
+    if not verifier(signing_input.encode(), _b64decode(signature)):
+        raise InvalidTokenError("Bad token signature")
+    claims = json.loads(_b64decode(token.split(".")[1]))
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp + LEEWAY_SECONDS < now:
+        raise InvalidTokenError("Token expired")
+    if isinstance(claims.get("nbf"), (int, float)) and claims["nbf"] - LEEWAY_SECONDS > now:
+        raise InvalidTokenError("Token not valid yet")
+    audience = claims.get("aud")
+    if AUDIENCE and AUDIENCE not in (audience if isinstance(audience, list) else [audience]):
+        raise InvalidTokenError("Token is for another audience")
+    issuer = os.getenv("SUPABASE_JWT_ISSUER")
+    if issuer and claims.get("iss") != issuer:
+        raise InvalidTokenError("Token from another issuer")
+    try:
+        return UUID(claims["sub"]), exp
+    except (KeyError, TypeError, ValueError):
+        raise InvalidTokenError("Token has no user id") from None
+
+# The caller's user UUID (the sub claim) for a valid access token, InvalidTokenError otherwise
+async def verify(token: str) -> UUID:
+    now = time.time()
+    cached = _verified.get(token)
+    if cached is not None:
+        if cached[1] + LEEWAY_SECONDS >= now:
+            _verified.move_to_end(token)
+            return cached[0]
+        del _verified[token]
+
+    try:
+        header = json.loads(_b64decode(token.split(".")[0]))
+        alg, kid = header["alg"], header.get("kid")
+        if token.count(".") != 2:
+            raise ValueError
+    except (ValueError, KeyError, TypeError, IndexError):
+        raise InvalidTokenError("Malformed token") from None
+
+    verifier = _verifier_for(alg, kid)
+    if verifier is None and kid and alg != "HS256" and time.monotonic() - _refreshed_at >= JWKS_MIN_REFRESH_SECONDS:
+        # Possibly a freshly rotated key
+        try:
+            await refresh_keys()
+        except (supabase_client.UpstreamError, ValueError, KeyError) as exc:
+            print(f"JWKS refresh failed ({exc})")
+        verifier = _verifier_for(alg, kid)
+    if verifier is None:
+        raise InvalidTokenError(f"No {alg} key for this token")
+
+    try:
+        caller, exp = _check(token, verifier, now)
+    except (ValueError, TypeError) as exc:
+        raise InvalidTokenError(str(exc) if isinstance(exc, InvalidTokenError) else "Malformed token") from None
+    _verified[token] = (caller, exp)
+    while len(_verified) > VERIFIED_TOKENS_MAX:
+        _verified.popitem(last=False)
+    return caller
+
+def stats() -> dict:
+    return {"keys": len(_keys), "verified_cached": len(_verified), "refresh_running": _task is not None and not _task.done(),
+            "asymmetric_keys_supported": InvalidSignature is not None}
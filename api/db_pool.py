@@ -0,0 +1,313 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+'''
+Process-wide Postgres connection pool shared by lot_database, users_database and detection_database.
+Opening a connection to Supabase costs a TCP + TLS + auth handshake, so connections are kept open and handed out again.
+Sizing is configured through env vars (see .env.example), pool_stats() shows how the pool is actually being used.
+'''
+
+DEFAULT_MIN_SIZE = 1
+DEFAULT_MAX_SIZE = 10
+DEFAULT_ACQUIRE_TIMEOUT = 5.0       # seconds to wait for a free connection
+DEFAULT_HEALTHCHECK_IDLE = 30.0     # connections idle longer than this are pinged before reuse
+DEFAULT_MAX_PENDING = 1000          # queued + running DB calls per worker before new ones are shed
+
+
+class PoolTimeoutError(RuntimeError):
+    pass
+
+
+class DatabaseBusyError(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, dsn: str, min_size: int = DEFAULT_MIN_SIZE, max_size: int = DEFAULT_MAX_SIZE,
+                 acquire_timeout: float = DEFAULT_ACQUIRE_TIMEOUT, healthcheck_idle: float = DEFAULT_HEALTHCHECK_IDLE):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size min={min_size} max={max_size}.")
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_idle = healthcheck_idle
+
+        self._cond = threading.Condition()
+        self._idle = []         # stack of (connection, last_used) so the warmest connection is reused first
+        self._size = 0          # open connections, idle + in use
+        self._closed = False
+
+        self._stats = {
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "acquired": 0,
+            "waited": 0,
+            "timeouts": 0,
+            "healthcheck_failures": 0,
+            "total_wait_seconds": 0.0,
+        }
+
+        for _ in range(min_size):
+            connection = self._connect()
+            self._idle.append((connection, time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        connection = psycopg2.connect(self.dsn)
+        self._stats["connections_created"] += 1
+        return connection
+
+    def _discard(self, connection):
+        self._stats["connections_discarded"] += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    # Cheap liveness check, only done when the connection sat idle long enough to have been dropped
+    def _is_healthy(self, connection, last_used: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            return True
+        except psycopg2.Error:
+            self._stats["healthcheck_failures"] += 1
+            return False
+
+    def getconn(self, timeout: float | None = None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed.")
+
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+
+                if self._size < self.max_size:
+                    # Reserve the slot before connecting so other threads don't overshoot max_size
+                    self._size += 1
+                    connection, last_used = None, None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeoutError(
+                        f"Timed out after {timeout:.1f}s waiting for a database connection (max_size={self.max_size})."
+                    )
+                if not waited:
+                    waited = True
+                    self._stats["waited"] += 1
+                self._cond.wait(remaining)
+
+            self._stats["acquired"] += 1
+            self._stats["total_wait_seconds"] += timeout - max(0.0, deadline - time.monotonic())
+
+        # Network work happens outside the lock
+        try:
+            if connection is not None and not self._is_healthy(connection, last_used):
+                self._discard(connection)
+                connection = None
+            if connection is None:
+                connection = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        return connection
+
+    def putconn(self, connection, discard: bool = False):
+        if not discard and not connection.closed:
+            try:
+                # Never hand out a connection that is still inside a transaction
+                if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            if discard or connection.closed or self._closed:
+                self._size -= 1
+                self._discard(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: float | None = None):
+        connection = self.getconn(timeout)
+        broken = False
+        try:
+            yield connection
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        finally:
+            self.putconn(connection, discard=broken or bool(connection.closed))
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(connection)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                min_size=self.min_size,
+                max_size=self.max_size,
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+            )
+        stats["avg_wait_ms"] = round(1000 * stats["total_wait_seconds"] / stats["acquired"], 3) if stats["acquired"] else 0.0
+        return stats
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _env_number(name: str, default, cast):
+    value = os.getenv(name)
+    return default if value in (None, "") else cast(value)
+
+
+def get_pool() -> ConnectionPool:
+    global _pool, _pool_pid
+
+    # A forked worker must not share sockets with its parent, so each pid gets its own pool
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            database_url = os.getenv("DATABASE_URL")
+            if not database_url:
+                raise RuntimeError("Missing DB env var (DATABASE_URL). Check your .env loading.")
+
+            _pool = ConnectionPool(
+                database_url,
+                min_size=_env_number("DB_POOL_MIN_SIZE", DEFAULT_MIN_SIZE, int),
+                max_size=_env_number("DB_POOL_MAX_SIZE", DEFAULT_MAX_SIZE, int),
+                acquire_timeout=_env_number("DB_POOL_ACQUIRE_TIMEOUT", DEFAULT_ACQUIRE_TIMEOUT, float),
+                healthcheck_idle=_env_number("DB_POOL_HEALTHCHECK_IDLE", DEFAULT_HEALTHCHECK_IDLE, float),
+            )
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def close_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_pid = None
+
+
+def pool_stats() -> dict:
+    if _pool is None or _pool_pid != os.getpid():
+        return {"size": 0, "idle": 0, "in_use": 0}
+    return _pool.stats()
+
+
+'''
+Async access for the FastAPI endpoints. psycopg2 is blocking, so calls run on a dedicated thread pool sized to the
+connection pool instead of on the event loop. The number of queued calls is bounded: past DB_EXECUTOR_MAX_PENDING
+new calls fail fast with DatabaseBusyError (served as a 503) rather than piling up behind a slow database.
+'''
+
+_executor = None
+_executor_pid = None
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor, _executor_pid
+    if _executor is not None and _executor_pid == os.getpid():
+        return _executor
+
+    with _pool_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            # More threads than connections would only wait on getconn(), so match the pool size
+            workers = _env_number("DB_POOL_MAX_SIZE", DEFAULT_MAX_SIZE, int)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+            _executor_pid = os.getpid()
+    return _executor
+
+
+def _release_pending(_future=None):
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+async def run_in_executor(func, *args, **kwargs):
+    global _pending
+    max_pending = _env_number("DB_EXECUTOR_MAX_PENDING", DEFAULT_MAX_PENDING, int)
+    with _pending_lock:
+        if _pending >= max_pending:
+            raise DatabaseBusyError(f"Database executor is saturated ({_pending} calls pending).")
+        _pending += 1
+
+    try:
+        future = _get_executor().submit(functools.partial(func, *args, **kwargs))
+    except Exception:
+        _release_pending()
+        raise
+    # Released when the call actually finishes, even if the awaiting request was cancelled
+    future.add_done_callback(_release_pending)
+    return await asyncio.wrap_future(future)
+
+
+# Wraps a blocking DB function into an awaitable one with the same signature
+def awaitable(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_executor(func, *args, **kwargs)
+    return wrapper
+
+
+def executor_stats() -> dict:
+    return {
+        "pending": _pending,
+        "max_pending": _env_number("DB_EXECUTOR_MAX_PENDING", DEFAULT_MAX_PENDING, int),
+    }
+
+
+def shutdown_executor():
+    global _executor, _executor_pid
+    with _pool_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=True)
+        _executor = None
+        _executor_pid = None
@@ -1,9 +1,12 @@
+import io
 import random
 import lot_helper as lh
 import math
 import lot_database as ldb
+import lot_cache as lc
 from datetime import datetime, timedelta
 from pydantic import BaseModel
+from typing import Literal, Optional
 
 START_TIME = 7      # 7 AM
 END_TIME   = 20     # 8 PM
@@ -16,108 +19,225 @@ class Vehicle(BaseModel):
     is_entering: bool       #1 is entering, 0 is exiting 
     lot_id: int
 
+class IngestResult(BaseModel):
+    status: Literal["accepted", "rejected"]
+    reason: Optional[Literal["unknown_lot", "lot_full", "lot_empty"]] = None
+    vehicle: Vehicle
+    current: Optional[int] = None           # lot count after the event (or unchanged count when rejected)
+    total_capacity: Optional[int] = None
+    queued: bool = False                    # accepted into the write-behind buffer, not committed yet
+
+# Bounds check, event insert and lots.current update in one statement, so it's a single round trip and atomic.
+# The UPDATE only matches when the new count stays within [0, total_capacity]; Postgres re-checks that condition
+# against the latest row version after taking the row lock, so concurrent arrivals can't push current past capacity.
+# The event row is only inserted when the UPDATE matched, the NOTIFY is queued the same way.
+INGEST_QUERY = f"""
+WITH lot AS (
+    SELECT lot_id, current, total_capacity FROM lots WHERE lot_id = %(lot_id)s
+), moved AS (
+    UPDATE lots
+    SET current = lots.current + %(delta)s
+    WHERE lots.lot_id = %(lot_id)s
+      AND lots.current + %(delta)s BETWEEN 0 AND lots.total_capacity
+    RETURNING lots.lot_id, lots.current, lots.total_capacity
+), event AS (
+    INSERT INTO {EVENTS_TABLE} (dt, is_entering, lot_id)
+    SELECT %(dt)s, %(is_entering)s, lot_id FROM moved
+)
+SELECT lot.current, lot.total_capacity, moved.current, moved.total_capacity,
+       CASE WHEN moved.lot_id IS NOT NULL THEN pg_notify(%(channel)s, json_build_object(
+           'lot_id', moved.lot_id, 'current', moved.current, 'total_capacity', moved.total_capacity)::text) END
+FROM lot LEFT JOIN moved USING (lot_id);
+"""
+
 # takes a Vehicle Obj and adds it to the parking_events table
 # lot_id | lot_name | total_capacity | current |  type   |  hours
-def insert_vehicle_entry(vehicle: Vehicle):
-    lot_id = vehicle.lot_id
-    is_entering = vehicle.is_entering
+def insert_vehicle_entry(vehicle: Vehicle) -> IngestResult:
+    # Make dt microseconds 0 for db consistency
+    vehicle.dt = vehicle.dt.replace(microsecond=0)
 
-    lot = ldb.fetch_lot_by_id(lot_id)
-    if lot is None:
-        print(f"Error lot_id {lot_id} does not exist.")
-        return None
+    params = {
+        "lot_id": vehicle.lot_id,
+        "delta": 1 if vehicle.is_entering else -1,
+        "dt": vehicle.dt,
+        "is_entering": vehicle.is_entering,
+        "channel": lh.LOT_CHANNEL,
+    }
 
-    if is_entering and ((lot.current + 1) > lot.total_capacity):
-        print("Error lot_capacity can not exceed total capacity.")
-        return None
+    # Autocommit cursor: the single statement is its own transaction, no BEGIN/COMMIT round trips
+    with lh.get_cursor() as cursor:
+        cursor.execute(INGEST_QUERY, params)
+        row = cursor.fetchone()
 
-    if not is_entering and ((lot.current - 1) < 0):
-        print("Error lot_capacity can not be less than 0.")
-        return None
+    if row is None:
+        return IngestResult(status="rejected", reason="unknown_lot", vehicle=vehicle)
 
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
+    previous_current, previous_capacity, current, total_capacity = row[:4]
+    if current is None:
+        return IngestResult(
+            status="rejected",
+            reason="lot_full" if vehicle.is_entering else "lot_empty",
+            vehicle=vehicle,
+            current=previous_current,
+            total_capacity=previous_capacity,
+        )
 
-    insert_query = f"""
-    INSERT INTO {EVENTS_TABLE} (dt, is_entering, lot_id)
-    VALUES (%s, %s, %s);
-    """
+    # Keep the cached lot state in step with what was just committed
+    lc.set_occupancy(vehicle.lot_id, current, total_capacity)
 
-    # Make dt microseconds 0 for db consistency
-    vehicle.dt = vehicle.dt.replace(microsecond=0)
+    return IngestResult(status="accepted", vehicle=vehicle, current=current, total_capacity=total_capacity)
 
-    cursor.execute(insert_query, (vehicle.dt, vehicle.is_entering, vehicle.lot_id))
 
-    # Now we update lots table current count based on lot_id and is_entering
-    # check if the lot_id is at max capacity or 0 before updating
-    if is_entering:
-        cursor.execute("UPDATE lots SET current = current + 1 WHERE lot_id = %s;", (lot_id,))
-    else:
-        cursor.execute("UPDATE lots SET current = current - 1 WHERE lot_id = %s;", (lot_id,))
 
-    connection.commit()
+# Entry point for single sensor events: write-behind buffer when EVENT_WRITE_BEHIND=1, otherwise committed right away
+def record_vehicle_entry(vehicle: Vehicle) -> IngestResult:
+    import event_buffer
+    if event_buffer.enabled():
+        return event_buffer.enqueue(vehicle)
+    return insert_vehicle_entry(vehicle)
 
-    cursor.close()
-    connection.close()
 
-    return vehicle
+class RejectedEvent(BaseModel):
+    index: int                  # position of the record in the uploaded batch
+    lot_id: int
+    reason: Literal["unknown_lot", "lot_full", "lot_empty"]
+
+class BulkIngestResult(BaseModel):
+    accepted: int
+    rejected: list[RejectedEvent]
+    lot_counts: dict[int, int]  # lot_id -> current after the batch, for every lot the batch touched
+
+# Streams events into parking_events with COPY, far cheaper than one INSERT per row
+def _copy_events(cursor, vehicles: list[Vehicle]):
+    if not vehicles:
+        return
+    buffer = io.StringIO()
+    for vehicle in vehicles:
+        buffer.write(f"{vehicle.dt.isoformat()},{'t' if vehicle.is_entering else 'f'},{vehicle.lot_id}\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {EVENTS_TABLE} (dt, is_entering, lot_id) FROM STDIN WITH (FORMAT csv);", buffer)
+
+# Adds each lot's net delta to lots.current in a single UPDATE and queues one NOTIFY per lot
+# clamp=True keeps the result within [0, total_capacity] for callers that could not validate against locked rows
+def _apply_lot_deltas(cursor, deltas: dict[int, int], clamp: bool = False) -> list[tuple[int, int, int]]:
+    deltas = {lot_id: delta for lot_id, delta in deltas.items() if delta != 0}
+    if not deltas:
+        return []
+    new_current = "GREATEST(0, LEAST(lots.total_capacity, lots.current + d.delta))" if clamp else "lots.current + d.delta"
+    cursor.execute(
+        f"""
+        WITH moved AS (
+            UPDATE lots
+            SET current = {new_current}
+            FROM unnest(%s::int[], %s::int[]) AS d(lot_id, delta)
+            WHERE lots.lot_id = d.lot_id
+            RETURNING lots.lot_id, lots.current, lots.total_capacity
+        )
+        SELECT lot_id, current, total_capacity,
+               pg_notify(%s, json_build_object('lot_id', lot_id, 'current', current, 'total_capacity', total_capacity)::text)
+        FROM moved;
+        """,
+        (list(deltas.keys()), list(deltas.values()), lh.LOT_CHANNEL),
+    )
+    return [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+
+# Bulk version of insert_vehicle_entry for gate controllers uploading buffered events.
+# Records are applied in the order given: the touched lots are locked, every record is checked against the running
+# count, accepted ones are COPYed in and each lot's net delta lands in one UPDATE. All in one transaction.
+def insert_vehicle_entries(vehicles: list[Vehicle]) -> BulkIngestResult:
+    lot_ids = sorted({vehicle.lot_id for vehicle in vehicles})
+    accepted = []
+    rejected = []
+
+    with lh.get_cursor(transaction=True) as cursor:
+        # Lock in lot_id order so concurrent batches can't deadlock each other
+        cursor.execute(
+            "SELECT lot_id, current, total_capacity FROM lots WHERE lot_id = ANY(%s) ORDER BY lot_id FOR UPDATE;",
+            (lot_ids,),
+        )
+        rows = cursor.fetchall()
+        counts = {row[0]: row[1] for row in rows}
+        capacities = {row[0]: row[2] for row in rows}
+        starting = dict(counts)
+
+        for index, vehicle in enumerate(vehicles):
+            current = counts.get(vehicle.lot_id)
+            if current is None:
+                rejected.append(RejectedEvent(index=index, lot_id=vehicle.lot_id, reason="unknown_lot"))
+                continue
+            if vehicle.is_entering and current + 1 > capacities[vehicle.lot_id]:
+                rejected.append(RejectedEvent(index=index, lot_id=vehicle.lot_id, reason="lot_full"))
+                continue
+            if not vehicle.is_entering and current - 1 < 0:
+                rejected.append(RejectedEvent(index=index, lot_id=vehicle.lot_id, reason="lot_empty"))
+                continue
+            counts[vehicle.lot_id] = current + (1 if vehicle.is_entering else -1)
+            # Make dt microseconds 0 for db consistency
+            accepted.append(vehicle.model_copy(update={"dt": vehicle.dt.replace(microsecond=0)}))
+
+        _copy_events(cursor, accepted)
+        updated = _apply_lot_deltas(cursor, {lot_id: counts[lot_id] - starting[lot_id] for lot_id in counts})
+
+    # Keep the cached lot state in step with what was just committed
+    for lot_id, current, total_capacity in updated:
+        lc.set_occupancy(lot_id, current, total_capacity)
+
+    return BulkIngestResult(accepted=len(accepted), rejected=rejected, lot_counts=counts)
 
 
 
 # Lot of math here get ready
-def _progress_time(dt: datetime, tails = 0.05) -> datetime:
-    skew = 0
-
+# rng is anything with random/uniform/lognormvariate, the random module by default or a seeded random.Random
+def _sample_skew(rng = random, tails = 0.05) -> float:
     # We flip a weighted coin where p_tails happens 5% of the time and heas happens 95 % of the time
-    if random.random() > tails:
+    if rng.random() > tails:
         # When heads hits we take a random uniform value between 1,5 std = 0 at 3 so most likely 3
-        skew = random.uniform(1,5)
-    else:
-        # When tails hits we use lognormvariate which allows us to skewed dist along an centered domain (50mins) and std of 0.25 allowing for values ranging ~40 and 65 one std dev +-
-        mu = math.log(50)
-        sigma = 0.25
-        skew = random.lognormvariate(mu, sigma)
-
-        # Cut values off that are not within normal ~99% domain
-        if(skew > 80):
-            skew = 80
-        if(skew < 5 ):
-            skew = 5
+        return rng.uniform(1,5)
+
+    # When tails hits we use lognormvariate which allows us to skewed dist along an centered domain (50mins) and std of 0.25 allowing for values ranging ~40 and 65 one std dev +-
+    mu = math.log(50)
+    sigma = 0.25
+    skew = rng.lognormvariate(mu, sigma)
+
+    # Cut values off that are not within normal ~99% domain
+    if(skew > 80):
+        skew = 80
+    if(skew < 5 ):
+        skew = 5
+    return skew
 
+def _advance_time(dt: datetime, skew: float) -> datetime:
     # Add the skew to previous time so DES steps are progressive
     future_date = dt + timedelta(minutes=skew)
     if future_date.hour >= END_TIME:
         future_date = (future_date + timedelta(days=1)).replace(hour=START_TIME, minute=0, second=0, microsecond=0)
     return future_date
 
+def _progress_time(dt: datetime, tails = 0.05) -> datetime:
+    return _advance_time(dt, _sample_skew(random, tails))
+
+# Entering/leaving decision for a lot at the given occupancy, shared by the db-backed path and the in-memory engine
+def _is_entering_for(current: int, total_capacity: int, rng = random) -> bool:
+    if current <= 0:
+        return True
+    if current >= total_capacity:
+        return False
+
+    lot_full_percent = int((current / total_capacity) * 100)
+    cf = rng.random()
+
+    if lot_full_percent <= 80:
+        return cf < 0.9     #Growing
+    return cf < 0.1         #Shrinking
+
 def _randomizeIsEntering(lot_id: int) -> bool:
     lot = ldb.fetch_lot_by_id(lot_id)
     if lot is None:
         raise ValueError(f"Lot {lot_id} does not exist.")
     if lot.total_capacity <= 0:
         raise ValueError(f"Lot {lot_id} has no capacity.")
-    if lot.current <= 0:
-        return True
-    if lot.current >= lot.total_capacity:
-        return False
-
-    lot_full_percent = int((lot.current / lot.total_capacity) * 100)
-    cf = random.random()
-
-    print(f"Lot ID: {lot_id}, Current: {lot.current}, Capacity: {lot.total_capacity}, Full%: {lot_full_percent}, Random CF: {cf}")
 
-
-    if lot_full_percent <= 80:
-        if cf < 0.9:    #Growing
-            return True
-        else:
-            return False
-    else:
-        if cf < 0.1:    #Shrinking
-            return True
-        else:
-            return False
-    return random.choice([True, False])
+    return _is_entering_for(lot.current, lot.total_capacity)
 
 def _select_lot_id(input_lot: int = -1) -> int:
     if input_lot >= 0:
@@ -138,26 +258,23 @@ def simulate_single_entry(input_lot: int = -1, select_dt: datetime | None = None
     v = fab_vehicle_entry(input_lot, select_dt)
     return v
 
-def simulate(days: int = 0, itterations: int = 0, input_lot: int = -1):
+# Runs on the in-memory engine (simulation.SimulationEngine): lot state is read once, not once per simulated car
+def simulate(days: int = 0, itterations: int = 0, input_lot: int = -1, seed: int | None = None):
+    import simulation
     vehicles = []
     if (days >= 1 and itterations >= 1) or days < 0 or itterations < 0 or (days == 0 and itterations == 0):
         print("Error: Please only specify either days or itterations, not both (or neither).")
         return vehicles
-    
-    if days >= 1:
-        end_dt = datetime.now() + timedelta(days=days)
-        v = simulate_single_entry(input_lot)
-        while v is not None and v.dt < end_dt:
-            vehicles.append(v)
-            v = simulate_single_entry(input_lot, _progress_time(v.dt))
-        
-    else:
-        for i in range(itterations):
-            v = simulate_single_entry(input_lot)
-            if v is not None:
-                vehicles.append(v)
-
-    return vehicles
+
+    engine = simulation.SimulationEngine.from_db(seed=seed)
+    return engine.run(days=days, itterations=itterations, input_lot=input_lot)
+
+
+# Awaitable versions for the async endpoints, these run on the DB executor so the event loop never blocks
+insert_vehicle_entry_async = lh.awaitable(insert_vehicle_entry)
+record_vehicle_entry_async = lh.awaitable(record_vehicle_entry)
+insert_vehicle_entries_async = lh.awaitable(insert_vehicle_entries)
+simulate_single_entry_async = lh.awaitable(simulate_single_entry)
     
 
 if __name__ == "__main__":
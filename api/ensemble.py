@@ -0,0 +1,242 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Optional
+import numpy as np
+from pydantic import BaseModel, Field, model_validator
+import lot_helper as lh
+import lot_cache as lc
+import simulation
+
+'''
+Monte Carlo ensemble of the in-memory parking DES for capacity planning.
+Replications run on one process pool per API worker (ENSEMBLE_WORKERS processes, started in the app lifespan), and at
+most ENSEMBLE_MAX_CONCURRENT ensembles run at once; further requests are turned away with EnsembleBusyError (429)
+rather than queueing CPU-bound work. replications x buckets is capped at ENSEMBLE_MAX_CELLS per request.
+Each replication gets its own RNG stream derived from (seed, index), optionally samples its own tails parameter and
+capacity jitter from that stream, and returns a per-lot occupancy series as a NumPy array (one value per time bucket).
+The parent stacks those and reduces them with np.percentile along the replication axis into bands per lot and bucket,
+plus distributions of peak occupancy and time-to-full.
+'''
+
+DEFAULT_PERCENTILES = (5.0, 50.0, 95.0)
+ENSEMBLE_WORKERS = int(os.getenv("ENSEMBLE_WORKERS", "0")) or os.cpu_count() or 1
+ENSEMBLE_MAX_CONCURRENT = int(os.getenv("ENSEMBLE_MAX_CONCURRENT", "1"))
+ENSEMBLE_MAX_CELLS = int(os.getenv("ENSEMBLE_MAX_CELLS", "2000000"))      # replications x buckets per request
+# Replications start on a Monday at opening time so buckets line up with weekdays across runs
+SIMULATION_START = datetime(2024, 1, 1, 7, 0)
+
+
+class EnsembleRequest(BaseModel):
+    replications: int = Field(200, ge=1, le=5000)
+    days: int = Field(5, ge=1, le=90)
+    seed: int = 0
+    bucket_minutes: int = Field(60, ge=5, le=1440)
+    tails: float = Field(0.05, ge=0, le=1)
+    tails_spread: float = Field(0.0, ge=0, le=1)            # each replication draws tails from tails +- spread
+    capacity_jitter: float = Field(0.0, ge=0, le=0.9)       # each replication scales capacities by 1 +- jitter
+    capacities: dict[int, int] = {}                         # lot_id -> fixed capacity override
+    lot_ids: Optional[list[int]] = None                     # default: every lot
+    percentiles: list[float] = list(DEFAULT_PERCENTILES)
+
+    @model_validator(mode="after")
+    def check_size(self):
+        if any(not 0 <= q <= 100 for q in self.percentiles):
+            raise ValueError("percentiles must be between 0 and 100")
+        cells = self.replications * (self.days * 1440 // self.bucket_minutes)
+        if cells > ENSEMBLE_MAX_CELLS:
+            raise ValueError(f"replications x buckets is {cells}, at most {ENSEMBLE_MAX_CELLS} per request; "
+                             "use fewer replications, fewer days or larger buckets")
+        return self
+
+class LotBands(BaseModel):
+    lot_id: int
+    total_capacity: int
+    occupancy: dict[str, list[float]]           # "p50" -> one value per bucket
+    peak: dict[str, float]                      # percentiles of the peak occupancy
+    time_to_full_minutes: dict[str, float]      # percentiles over the replications that filled up
+    full_probability: float
+
+class EnsembleBusyError(RuntimeError):
+    pass
+
+class EnsembleResult(BaseModel):
+    replications: int
+    days: int
+    bucket_minutes: int
+    bucket_starts: list[datetime]
+    lots: list[LotBands]
+
+
+# Independent stream per replication, stable for a given (seed, index) no matter which worker runs it
+def replication_seed(seed: int, index: int) -> int:
+    return int.from_bytes(hashlib.sha256(f"{seed}:{index}".encode()).digest()[:8], "big")
+
+# Runs in a worker process, lots are plain tuples (lot_id, current, total_capacity) so they pickle cheaply
+def _run_replication(task) -> dict[int, tuple[np.ndarray, int, Optional[float]]]:
+    index, request, lots = task
+    rng = random.Random(replication_seed(request.seed, index))
+
+    tails = request.tails
+    if request.tails_spread:
+        tails = min(1.0, max(0.0, rng.uniform(tails - request.tails_spread, tails + request.tails_spread)))
+
+    models = []
+    for lot_id, current, total_capacity in lots:
+        capacity = request.capacities.get(lot_id, total_capacity)
+        if request.capacity_jitter:
+            capacity = max(1, round(capacity * rng.uniform(1 - request.capacity_jitter, 1 + request.capacity_jitter)))
+        models.append(lh.Lot(lot_id=lot_id, lot_name="", total_capacity=capacity, current=min(current, capacity), type="", hours=""))
+
+    engine = simulation.SimulationEngine(models, seed=rng.getrandbits(64), tails=tails)
+    bucket_seconds = request.bucket_minutes * 60
+    bucket_count = request.days * 1440 // request.bucket_minutes
+
+    results = {}
+    for lot in models:
+        current = lot.current
+        series = np.zeros(bucket_count, dtype=np.int32)
+        filled = 0
+        peak = current
+        time_to_full = 0.0 if current >= lot.total_capacity else None
+
+        for vehicle in engine.run(days=request.days, input_lot=lot.lot_id, start=SIMULATION_START):
+            bucket = int((vehicle.dt - SIMULATION_START).total_seconds() // bucket_seconds)
+            if bucket >= bucket_count:
+                break
+            # Buckets between events keep the occupancy they ended with
+            while filled < bucket:
+                series[filled] = current
+                filled += 1
+            current += 1 if vehicle.is_entering else -1
+            peak = max(peak, current)
+            if time_to_full is None and current >= lot.total_capacity:
+                time_to_full = (vehicle.dt - SIMULATION_START).total_seconds() / 60
+        while filled < bucket_count:
+            series[filled] = current
+            filled += 1
+
+        results[lot.lot_id] = (series, peak, time_to_full)
+    return results
+
+
+def _label(q: float) -> str:
+    return f"p{q:g}"
+
+# spawn keeps workers clear of the parent's db sockets and background threads
+def _new_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(ENSEMBLE_MAX_CONCURRENT)
+
+# Creates the shared pool, called from the app lifespan (worker processes are spawned on first use)
+def start():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _new_pool(ENSEMBLE_WORKERS)
+
+def stop():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+@contextmanager
+def _slot():
+    if not _slots.acquire(blocking=False):
+        raise EnsembleBusyError(f"{ENSEMBLE_MAX_CONCURRENT} ensemble(s) already running, try again later")
+    try:
+        yield
+    finally:
+        _slots.release()
+
+# Runs on the shared pool when it is started, otherwise on a pool of max_workers processes for this call (CLI, tests)
+def run_ensemble(request: EnsembleRequest, lots: list[lh.Lot], max_workers: Optional[int] = None) -> EnsembleResult:
+    if request.lot_ids is not None:
+        wanted = set(request.lot_ids)
+        lots = [lot for lot in lots if lot.lot_id in wanted]
+    lot_tuples = [(lot.lot_id, lot.current, lot.total_capacity) for lot in lots]
+    tasks = [(index, request, lot_tuples) for index in range(request.replications)]
+
+    with _slot():
+        shared = _pool if max_workers is None else None
+        workers = max_workers or ENSEMBLE_WORKERS
+        chunksize = max(1, len(tasks) // (workers * 4))
+        if shared is not None:
+            replications = list(shared.map(_run_replication, tasks, chunksize=chunksize))
+        else:
+            with _new_pool(workers) as pool:
+                replications = list(pool.map(_run_replication, tasks, chunksize=chunksize))
+
+    bucket_count = request.days * 1440 // request.bucket_minutes
+    quantiles = np.asarray(request.percentiles, dtype=float)
+    bands = []
+    for lot in lots:
+        runs = [replication[lot.lot_id] for replication in replications]
+
+        # replications x buckets, reduced along the replication axis
+        occupancy = np.percentile(np.stack([run[0] for run in runs]), quantiles, axis=0)
+        peaks = np.percentile(np.array([peak for _, peak, _ in runs], dtype=float), quantiles)
+        fill_times = np.array([minutes for _, _, minutes in runs if minutes is not None], dtype=float)
+        filled = np.percentile(fill_times, quantiles) if fill_times.size else None
+        bands.append(LotBands(
+            lot_id=lot.lot_id,
+            total_capacity=request.capacities.get(lot.lot_id, lot.total_capacity),
+            occupancy={_label(q): row.tolist() for q, row in zip(request.percentiles, occupancy)},
+            peak={_label(q): float(value) for q, value in zip(request.percentiles, peaks)},
+            time_to_full_minutes={_label(q): float(value) for q, value in zip(request.percentiles, filled)} if filled is not None else {},
+            full_probability=fill_times.size / len(runs),
+        ))
+
+    bucket_starts = [SIMULATION_START + i * timedelta(minutes=request.bucket_minutes) for i in range(bucket_count)]
+    return EnsembleResult(
+        replications=request.replications,
+        days=request.days,
+        bucket_minutes=request.bucket_minutes,
+        bucket_starts=bucket_starts,
+        lots=bands,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo ensemble of the parking DES.")
+    parser.add_argument("--replications", type=int, default=200)
+    parser.add_argument("--days", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bucket-minutes", type=int, default=60)
+    parser.add_argument("--tails", type=float, default=0.05)
+    parser.add_argument("--tails-spread", type=float, default=0.0)
+    parser.add_argument("--capacity-jitter", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="-", help="JSON output path, - for stdout")
+    args = parser.parse_args()
+
+    ensemble_request = EnsembleRequest(
+        replications=args.replications,
+        days=args.days,
+        seed=args.seed,
+        bucket_minutes=args.bucket_minutes,
+        tails=args.tails,
+        tails_spread=args.tails_spread,
+        capacity_jitter=args.capacity_jitter,
+    )
+    result = run_ensemble(ensemble_request, lc.get_all_lots(), max_workers=args.workers)
+
+    payload = result.model_dump_json(indent=2)
+    if args.output == "-":
+        print(payload)
+    else:
+        with open(args.output, "w") as file:
+            file.write(payload)
+        print(f"Wrote bands for {len(result.lots)} lots to {args.output}")
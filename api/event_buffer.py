@@ -0,0 +1,207 @@
+import os
+import queue
+import threading
+import time
+import lot_helper as lh
+import lot_cache as lc
+import detection_database as ddb
+
+'''
+Optional write-behind mode for vehicle events (EVENT_WRITE_BEHIND=1).
+An accepted event updates the in-process lot state right away and is queued; a background thread writes queued events
+to parking_events with COPY and applies the aggregated per-lot deltas in one UPDATE every EVENT_FLUSH_MS milliseconds
+or EVENT_FLUSH_MAX events, whichever comes first. The queue is bounded: when it is full, enqueue() waits up to
+EVENT_ENQUEUE_TIMEOUT seconds and then raises BufferFullError (a 503).
+
+Events were only checked against this worker's cached state, so a flush locks the touched lots and replays the batch
+against their committed counts like insert_vehicle_entries does: events another worker made impossible (lot already
+full / empty) are left out of the COPY and counted under "rejected", so the event log and lots.current always agree.
+stop() drains the queue, but gives up after EVENT_DRAIN_TIMEOUT seconds when the database is unreachable and logs
+the events it had to drop.
+'''
+
+FLUSH_INTERVAL = int(os.getenv("EVENT_FLUSH_MS", "500")) / 1000
+FLUSH_MAX_EVENTS = int(os.getenv("EVENT_FLUSH_MAX", "5000"))
+BUFFER_MAX_EVENTS = int(os.getenv("EVENT_BUFFER_MAX", "50000"))
+ENQUEUE_TIMEOUT = float(os.getenv("EVENT_ENQUEUE_TIMEOUT", "1.0"))
+DRAIN_TIMEOUT = float(os.getenv("EVENT_DRAIN_TIMEOUT", "10"))
+RETRY_MAX_SECONDS = 10.0
+
+
+class BufferFullError(RuntimeError):
+    pass
+
+
+_queue: queue.Queue = queue.Queue(maxsize=BUFFER_MAX_EVENTS)
+_stop = threading.Event()
+_drain_deadline: float | None = None        # monotonic time stop() stops waiting for the database
+_thread = None
+_stats = {"queued": 0, "flushed": 0, "flushes": 0, "failed_flushes": 0, "rejected": 0, "dropped": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(**increments: int):
+    with _stats_lock:
+        for name, amount in increments.items():
+            _stats[name] += amount
+
+def enabled() -> bool:
+    return os.getenv("EVENT_WRITE_BEHIND", "0") == "1"
+
+
+def enqueue(vehicle: ddb.Vehicle) -> ddb.IngestResult:
+    delta = 1 if vehicle.is_entering else -1
+    reason, lot = lc.reserve(vehicle.lot_id, delta)
+    if reason != "accepted":
+        return ddb.IngestResult(
+            status="rejected",
+            reason=reason,
+            vehicle=vehicle,
+            current=lot.current if lot else None,
+            total_capacity=lot.total_capacity if lot else None,
+        )
+
+    # Make dt microseconds 0 for db consistency
+    vehicle = vehicle.model_copy(update={"dt": vehicle.dt.replace(microsecond=0)})
+    try:
+        _queue.put(vehicle, timeout=ENQUEUE_TIMEOUT)
+    except queue.Full:
+        lc.release(vehicle.lot_id, delta)
+        raise BufferFullError(f"Event buffer is full ({BUFFER_MAX_EVENTS} events waiting to be written).") from None
+
+    _count(queued=1)
+    return ddb.IngestResult(
+        status="accepted",
+        vehicle=vehicle,
+        current=lot.current,
+        total_capacity=lot.total_capacity,
+        queued=True,
+    )
+
+
+# Wait for the first event, then keep collecting until the batch is full or the flush interval has passed
+def _collect_batch(timeout: float) -> list[ddb.Vehicle]:
+    try:
+        batch = [_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+
+    deadline = time.monotonic() + FLUSH_INTERVAL
+    while len(batch) < FLUSH_MAX_EVENTS:
+        remaining = deadline - time.monotonic()
+        try:
+            batch.append(_queue.get(timeout=remaining) if remaining > 0 else _queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def _delta(vehicle: ddb.Vehicle) -> int:
+    return 1 if vehicle.is_entering else -1
+
+# Writes the events that still fit the locked lot counts, returns how many were rejected
+def _write_batch(batch: list[ddb.Vehicle]) -> int:
+    reserved = {}
+    for vehicle in batch:
+        reserved[vehicle.lot_id] = reserved.get(vehicle.lot_id, 0) + _delta(vehicle)
+
+    with lh.get_cursor(transaction=True) as cursor:
+        # Lock in lot_id order so concurrent flushes and bulk uploads can't deadlock each other
+        cursor.execute(
+            "SELECT lot_id, current, total_capacity FROM lots WHERE lot_id = ANY(%s) ORDER BY lot_id FOR UPDATE;",
+            (sorted(reserved),),
+        )
+        locked = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        counts = {lot_id: current for lot_id, (current, _) in locked.items()}
+        accepted = []
+        for vehicle in batch:
+            current = counts.get(vehicle.lot_id)
+            if current is None or not 0 <= current + _delta(vehicle) <= locked[vehicle.lot_id][1]:
+                continue
+            counts[vehicle.lot_id] = current + _delta(vehicle)
+            accepted.append(vehicle)
+
+        ddb._copy_events(cursor, accepted)
+        updated = ddb._apply_lot_deltas(cursor, {lot_id: counts[lot_id] - locked[lot_id][0] for lot_id in counts})
+
+    # Settle everything this batch reserved, rejected events included, against what was committed
+    committed = {lot_id: (current, total_capacity) for lot_id, (current, total_capacity) in locked.items()}
+    committed.update({lot_id: (current, total_capacity) for lot_id, current, total_capacity in updated})
+    for lot_id, delta in reserved.items():
+        if lot_id in committed:
+            lc.settle(lot_id, delta, *committed[lot_id])
+        else:
+            lc.release(lot_id, delta)
+    return len(batch) - len(accepted)
+
+def _log_dropped(events: list[ddb.Vehicle]):
+    per_lot = {}
+    for vehicle in events:
+        per_lot.setdefault(vehicle.lot_id, []).append(vehicle.dt)
+    for lot_id, times in sorted(per_lot.items()):
+        print(f"Event buffer dropped {len(times)} events for lot {lot_id} between {min(times).isoformat()} and {max(times).isoformat()}")
+
+# Writes the batch, retrying while the database is unavailable until stop() runs out of drain time,
+# returns whether the batch was written
+def flush(batch: list[ddb.Vehicle]) -> bool:
+    backoff = 0.5
+    while True:
+        try:
+            rejected = _write_batch(batch)
+            _count(flushed=len(batch) - rejected, rejected=rejected, flushes=1)
+            if rejected:
+                print(f"Event buffer left out {rejected} of {len(batch)} events that no longer fit their lot")
+            return True
+        except Exception as exc:
+            # Keep the batch and retry, dropping it would lose events that were already acknowledged
+            _count(failed_flushes=1)
+            deadline = _drain_deadline
+            if deadline is not None and time.monotonic() + backoff > deadline:
+                return False
+            print(f"Event buffer flush of {len(batch)} events failed ({exc}), retrying in {backoff:.1f}s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, RETRY_MAX_SECONDS)
+
+def _drop(events: list[ddb.Vehicle]):
+    for vehicle in events:
+        lc.release(vehicle.lot_id, _delta(vehicle))
+    _count(dropped=len(events))
+    _log_dropped(events)
+
+def _run():
+    # Once stopping, drain whatever is left without waiting for more
+    while True:
+        stopping = _stop.is_set()
+        batch = _collect_batch(0 if stopping else FLUSH_INTERVAL)
+        if not batch:
+            if stopping:
+                return
+            continue
+        if not flush(batch):
+            while rest := _collect_batch(0):
+                batch.extend(rest)
+            print(f"Event buffer could not reach the database within {DRAIN_TIMEOUT:.0f}s of stopping, dropping {len(batch)} events")
+            _drop(batch)
+            return
+
+
+def start():
+    global _thread, _drain_deadline
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _drain_deadline = None
+    _thread = threading.Thread(target=_run, name="event-buffer", daemon=True)
+    _thread.start()
+
+# Stop the flusher after everything queued so far has been written (or dropped after DRAIN_TIMEOUT)
+def stop():
+    global _thread, _drain_deadline
+    _drain_deadline = time.monotonic() + DRAIN_TIMEOUT
+    _stop.set()
+    if _thread is not None:
+        _thread.join()
+    _thread = None
+
+def stats() -> dict:
+    with _stats_lock:
+        return dict(_stats, waiting=_queue.qsize(), max_events=BUFFER_MAX_EVENTS)
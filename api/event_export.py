@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+from typing import AsyncIterator, Iterator, Literal, Optional
+import db_pool
+import lot_helper as lh
+from detection_database import EVENTS_TABLE
+
+'''
+Streams parking_events out for offline analysis without loading the result into memory.
+Rows come from a named (server-side) cursor EXPORT_BATCH at a time and are encoded batch by batch as NDJSON or CSV,
+so the API response (chunked) and the CLI output grow while memory stays flat whatever the size of the export.
+Rows are ordered by (dt, event_id), event_id breaking ties in insert order once `rollups.py --init` has added it.
+
+An export holds a pooled connection until the stream finishes or the client goes away, so at most
+EXPORT_MAX_CONCURRENT run per worker and further requests get ExportBusyError (a 503). In the API every fetch runs
+on the bounded DB executor like any other query, and the first batch is read before the response starts, so a busy
+pool or executor also answers 503 instead of a broken stream. Closing waits for a fetch still in flight and rolls
+the cursor back, so it runs off the event loop too (aclose()), even when the request was cancelled.
+'''
+
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "5000"))
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "2"))
+COLUMNS = ("dt", "is_entering", "lot_id")
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+ExportFormat = Literal["ndjson", "csv"]
+
+
+class ExportBusyError(RuntimeError):
+    pass
+
+
+_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+
+def _export_query(lot_id: Optional[int], start: Optional[datetime], end: Optional[datetime], order_by: str = "dt") -> tuple[str, list]:
+    conditions, params = [], []
+    if lot_id is not None:
+        conditions.append("lot_id = %s")
+        params.append(lot_id)
+    if start is not None:
+        conditions.append("dt >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("dt < %s")
+        params.append(end)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT {', '.join(COLUMNS)} FROM {EVENTS_TABLE} {where} ORDER BY {order_by};", params
+
+def _order_by(connection) -> str:
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'event_id';
+        """, (EVENTS_TABLE,))
+        return "dt, event_id" if cursor.fetchone() else "dt"
+
+# Yields lists of (dt, is_entering, lot_id) rows, batch_size at a time, from a server-side cursor
+def iter_event_batches(lot_id: Optional[int] = None, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                       batch_size: int = EXPORT_BATCH) -> Iterator[list[tuple]]:
+    with lh.get_connection() as connection:
+        # Named cursors only live inside a transaction
+        connection.autocommit = False
+        try:
+            query, params = _export_query(lot_id, start, end, _order_by(connection))
+            with connection.cursor(name="parking_events_export") as cursor:
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+        finally:
+            if not connection.closed:
+                connection.rollback()
+
+
+def _ndjson(rows: list[tuple]) -> bytes:
+    return "".join(
+        json.dumps({"dt": dt.isoformat(), "is_entering": is_entering, "lot_id": lot_id}) + "\n"
+        for dt, is_entering, lot_id in rows
+    ).encode()
+
+def _csv(rows: list[tuple]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows((dt.isoformat(), is_entering, lot_id) for dt, is_entering, lot_id in rows)
+    return buffer.getvalue().encode()
+
+def _encoder(format: ExportFormat):
+    if format not in MEDIA_TYPES:
+        raise ValueError(f"format must be one of {', '.join(MEDIA_TYPES)}, got {format!r}")
+    return _csv if format == "csv" else _ndjson
+
+def _header(format: ExportFormat) -> bytes:
+    return (",".join(COLUMNS) + "\r\n").encode() if format == "csv" else b""
+
+# Encoded chunks of the export, one per fetched batch (the csv header comes first)
+def export_events(format: ExportFormat = "ndjson", lot_id: Optional[int] = None, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None, batch_size: int = EXPORT_BATCH) -> Iterator[bytes]:
+    encode = _encoder(format)
+    if format == "csv":
+        yield _header(format)
+    for rows in iter_event_batches(lot_id, start, end, batch_size):
+        yield encode(rows)
+
+
+# One running export in the API: the batches generator is advanced on DB executor threads and closed from the event
+# loop, never at the same time. close() is idempotent and runs when the stream ends and again as the response's
+# background task, so a stream that never started still gives its slot and connection back.
+class ExportStream:
+    def __init__(self, format: ExportFormat, batches: Iterator[list[tuple]]):
+        self.format = format
+        self.batches = batches
+        self.first: Optional[list[tuple]] = None
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def next_batch(self) -> Optional[list[tuple]]:
+        with self.lock:
+            return None if self.closed else next(self.batches, None)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            # Rolls back and returns the connection
+            self.batches.close()
+        _slots.release()
+
+    # close() on the DB executor, shielded so a cancelled request still finishes it without blocking the loop
+    async def aclose(self):
+        try:
+            await asyncio.shield(db_pool.run_in_executor(self.close))
+        except db_pool.DatabaseBusyError:
+            await asyncio.shield(asyncio.to_thread(self.close))
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        encode = _encoder(self.format)
+        try:
+            if self.format == "csv":
+                yield _header(self.format)
+            rows = self.first
+            while rows is not None:
+                yield encode(rows)
+                rows = await db_pool.run_in_executor(self.next_batch)
+        finally:
+            await self.aclose()
+
+# Takes an export slot and reads the first batch on the DB executor. ExportBusyError / DatabaseBusyError /
+# PoolTimeoutError surface here, before any response is sent
+async def open_export_async(format: ExportFormat = "ndjson", lot_id: Optional[int] = None, start: Optional[datetime] = None,
+                            end: Optional[datetime] = None, batch_size: int = EXPORT_BATCH) -> ExportStream:
+    _encoder(format)
+    if not _slots.acquire(blocking=False):
+        raise ExportBusyError(f"{EXPORT_MAX_CONCURRENT} exports already running, try again shortly")
+    export = ExportStream(format, iter_event_batches(lot_id, start, end, batch_size))
+    try:
+        export.first = await db_pool.run_in_executor(export.next_batch)
+    except BaseException:
+        await export.aclose()
+        raise
+    return export
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream parking_events as NDJSON or CSV.")
+    parser.add_argument("--format", choices=list(MEDIA_TYPES), default="ndjson")
+    parser.add_argument("--lot-id", type=int, default=None)
+    parser.add_argument("--start", type=datetime.fromisoformat, default=None, help="ISO timestamp, inclusive")
+    parser.add_argument("--end", type=datetime.fromisoformat, default=None, help="ISO timestamp, exclusive")
+    parser.add_argument("--output", default="-", help="Output path, - for stdout")
+    args = parser.parse_args()
+
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        for chunk in export_events(args.format, args.lot_id, args.start, args.end):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
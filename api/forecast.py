@@ -0,0 +1,102 @@
+import calendar
+import json
+import os
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel
+
+'''
+Serves the occupancy forecast table built by `python train_model.py --train`.
+The table holds, per lot, weekday (Monday = 0) and opening hour, the mean occupancy fraction and a few quantiles.
+It is read once into memory, every lookup after that is a couple of list indexes; nothing on the request path touches
+the database or refits anything. load() picks up a freshly trained table without restarting the server.
+A relative FORECAST_PATH is taken from this directory, not the working directory the server was started from.
+Weekdays the table has no training days for (weekends, the simulator only produces Monday-Friday) are a
+NoForecastDataError, the endpoint answers 404 for them; ForecastUnavailableError (503) is only a missing table.
+'''
+
+FORECAST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("FORECAST_PATH", "occupancy_forecast.json"))
+
+
+class ForecastPoint(BaseModel):
+    hour: int
+    mean: float                     # occupancy fraction, 0 to 1
+    quantiles: dict[str, float]     # "p10" -> fraction
+    expected_current: int           # mean scaled to the lot's capacity
+    samples: int                    # training days behind the estimate
+
+class LotForecast(BaseModel):
+    lot_id: int
+    weekday: int
+    total_capacity: int
+    source: str                     # "lot" when the lot has its own history, "default" for the shared profile
+    trained_at: datetime
+    points: list[ForecastPoint]
+
+
+class ForecastUnavailableError(RuntimeError):
+    pass
+
+class NoForecastDataError(LookupError):
+    pass
+
+
+_table = None
+
+
+def load(path: str = FORECAST_PATH) -> dict:
+    global _table
+    with open(path) as file:
+        table = json.load(file)
+    table["lots"] = {int(lot_id): entry for lot_id, entry in table["lots"].items()}
+    _table = table
+    return table
+
+def _get_table() -> dict:
+    if _table is None:
+        try:
+            load()
+        except FileNotFoundError:
+            raise ForecastUnavailableError(f"No forecast table at {FORECAST_PATH}, run `python train_model.py --train` first.") from None
+    return _table
+
+def is_loaded() -> bool:
+    return _table is not None
+
+
+# Forecast for one weekday, every opening hour or just the given one
+def predict(lot_id: int, total_capacity: int, weekday: int, hour: Optional[int] = None) -> LotForecast:
+    table = _get_table()
+    hours = table["hours"]
+    if hour is not None and hour not in hours:
+        raise ValueError(f"hour must be one of the opening hours {hours[0]}-{hours[-1]}, got {hour}")
+
+    source = "lot"
+    entry = table["lots"].get(lot_id)
+    if entry is None or not entry["samples"][weekday]:
+        source = "default"
+        entry = table["default"]
+    if not entry["samples"][weekday]:
+        raise NoForecastDataError(f"No training data for {calendar.day_name[weekday]} (weekday {weekday}), nothing to forecast.")
+
+    points = []
+    for index, point_hour in enumerate(hours):
+        if hour is not None and point_hour != hour:
+            continue
+        mean = entry["mean"][weekday][index]
+        points.append(ForecastPoint(
+            hour=point_hour,
+            mean=mean,
+            quantiles={label: values[weekday][index] for label, values in entry["quantiles"].items()},
+            expected_current=round(mean * total_capacity),
+            samples=entry["samples"][weekday],
+        ))
+
+    return LotForecast(
+        lot_id=lot_id,
+        weekday=weekday,
+        total_capacity=total_capacity,
+        source=source,
+        trained_at=table["trained_at"],
+        points=points,
+    )
@@ -0,0 +1,257 @@
+import os
+import threading
+import time
+import uuid
+import lot_helper as lh
+import lot_index
+
+'''
+In-process lot state, so the read endpoints don't go to Postgres on every request.
+Static lot metadata (name, type, hours) is held until invalidate() is called, occupancy (current / total_capacity)
+is re-read in one query once it is older than LOT_CACHE_TTL seconds. The write paths in lot_database,
+detection_database and lot_helper update entries in place after they commit, so a worker sees its own writes immediately.
+While lot_listener is connected, other workers' writes arrive through LISTEN/NOTIFY and the TTL is stretched to
+LOT_CACHE_LIVE_TTL, which only remains as a safety net for writes made outside the API.
+Every change bumps a version that the read endpoints hand out as an ETag; it is prefixed with a per-process token so
+versions from different workers never compare equal.
+'''
+
+OCCUPANCY_TTL = float(os.getenv("LOT_CACHE_TTL", "5"))
+LIVE_OCCUPANCY_TTL = float(os.getenv("LOT_CACHE_LIVE_TTL", "60"))
+
+_lock = threading.RLock()
+_lots: dict[int, lh.Lot] = {}       # lot_id -> Lot, kept in lot_id order
+_catalog_loaded = False
+_catalog_generation = 0             # bumped whenever names / types / the set of lots may have changed
+_occupancy_loaded_at = 0.0
+_live = False                       # True while lot_listener is receiving notifications
+_change_listeners = []              # callables taking the updated Lot, see add_change_listener()
+_pending: dict[int, int] = {}       # lot_id -> delta accepted by event_buffer but not flushed to the db yet
+_version = 0                        # bumped on every change to _lots
+_index = lot_index.LotIndex()       # type / sort order views over _lots
+_instance = uuid.uuid4().hex[:12]
+
+
+def _row_to_lot(row) -> lh.Lot:
+    return lh.Lot(
+        lot_id=row[0],
+        lot_name=row[1],
+        total_capacity=row[2],
+        current=row[3],
+        type=row[4],
+        hours=row[5]
+    )
+
+def _load_catalog():
+    global _lots, _catalog_loaded, _catalog_generation, _occupancy_loaded_at, _version
+    with lh.get_cursor() as cursor:
+        cursor.execute("SELECT lot_id, lot_name, total_capacity, current, type, hours FROM lots ORDER BY lot_id;")
+        rows = cursor.fetchall()
+
+    previous = _lots
+    _lots = {row[0]: _row_to_lot(row) for row in rows}
+    for lot_id, delta in _pending.items():
+        if lot_id in _lots:
+            _lots[lot_id] = _lots[lot_id].model_copy(update={"current": _lots[lot_id].current + delta})
+    _index.rebuild(_lots.values())
+    _catalog_loaded = True
+    _catalog_generation += 1
+    _occupancy_loaded_at = time.monotonic()
+    _version += 1
+
+    if previous:
+        for lot in _lots.values():
+            if previous.get(lot.lot_id) != lot:
+                _notify(lot)
+
+def _refresh_occupancy():
+    global _occupancy_loaded_at
+    with lh.get_cursor() as cursor:
+        cursor.execute("SELECT lot_id, current, total_capacity FROM lots;")
+        rows = cursor.fetchall()
+
+    for lot_id, current, total_capacity in rows:
+        if lot_id not in _lots:
+            # A lot was added behind our back, pick up its metadata too
+            _load_catalog()
+            return
+        _set(lot_id, current + _pending.get(lot_id, 0), total_capacity)
+    _occupancy_loaded_at = time.monotonic()
+
+def _ttl() -> float:
+    return LIVE_OCCUPANCY_TTL if _live else OCCUPANCY_TTL
+
+def is_fresh() -> bool:
+    return _catalog_loaded and time.monotonic() - _occupancy_loaded_at < _ttl()
+
+# Make sure the catalog is loaded and occupancy is within the TTL
+def _ensure_fresh():
+    if is_fresh():
+        return
+    with _lock:
+        # Another thread may have refreshed while we waited on the lock
+        if not _catalog_loaded:
+            _load_catalog()
+        elif time.monotonic() - _occupancy_loaded_at >= _ttl():
+            _refresh_occupancy()
+
+def _set(lot_id: int, current: int, total_capacity: int | None = None):
+    global _version
+    lot = _lots.get(lot_id)
+    if lot is None:
+        return
+    if total_capacity is None:
+        total_capacity = lot.total_capacity
+    if lot.current == current and lot.total_capacity == total_capacity:
+        return
+    # Swap in a new object so lots handed out earlier are never mutated under the caller
+    previous, lot = lot, lot.model_copy(update={"current": current, "total_capacity": total_capacity})
+    _lots[lot_id] = lot
+    _index.update(previous, lot)
+    _version += 1
+    _notify(lot)
+
+def _notify(lot: lh.Lot):
+    for callback in _change_listeners:
+        try:
+            callback(lot)
+        except Exception as exc:
+            print(f"Lot change listener failed: {exc}")
+
+
+def get_all_lots() -> list[lh.Lot]:
+    _ensure_fresh()
+    return list(_lots.values())
+
+def get_lot(lot_id: int) -> lh.Lot | None:
+    _ensure_fresh()
+    return _lots.get(lot_id)
+
+# One page of lots in sort_field order, optionally of one type and/or passing matches(lot)
+# after is the sort key of the last lot of the previous page, the returned key (None on the last page) continues it
+def page_lots(lot_type: str | None = None, sort_field: str = "percent_full", descending: bool = False, limit: int | None = None,
+              offset: int = 0, after: tuple | None = None, matches=None) -> tuple[list[lh.Lot], tuple | None]:
+    _ensure_fresh()
+    with _lock:
+        page, last_key = [], None
+        # Without a filter the offset is skipped by position in the index
+        keys = _index.ordered(lot_type, sort_field, descending, after, offset if matches is None else 0)
+        skip = offset if matches is not None else 0
+        for key in keys:
+            lot = _lots[key[-1]]
+            if matches is not None and not matches(lot):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            if limit is not None and len(page) == limit:
+                return page, last_key
+            page.append(lot)
+            last_key = key
+        return page, None
+
+# Changes only when the catalog is reloaded, for indexes built over lot names / types
+def catalog_generation() -> int:
+    _ensure_fresh()
+    return _catalog_generation
+
+# Weak ETag for the current lot state, changes whenever any lot does
+def etag() -> str:
+    _ensure_fresh()
+    return f'W/"{_instance}-{_version}"'
+
+# Lots for lot_ids in the given order (None where there is no such lot), read from one consistent snapshot
+def get_lots(lot_ids: list[int]) -> list[lh.Lot | None]:
+    _ensure_fresh()
+    with _lock:
+        return [_lots.get(lot_id) for lot_id in lot_ids]
+
+def get_lot_by_name(lot_name: str) -> lh.Lot | None:
+    _ensure_fresh()
+    for lot in _lots.values():
+        if lot.lot_name == lot_name:
+            return lot
+    return None
+
+# Write-through hooks, called after the DB write has committed
+# current is the committed db value, deltas still waiting in event_buffer are added on top
+def set_occupancy(lot_id: int, current: int, total_capacity: int | None = None):
+    with _lock:
+        _set(lot_id, current + _pending.get(lot_id, 0), total_capacity)
+
+def apply_delta(lot_id: int, delta: int):
+    with _lock:
+        lot = _lots.get(lot_id)
+        if lot is not None:
+            _set(lot_id, lot.current + delta)
+
+# Write-behind hooks used by event_buffer.
+# reserve() checks bounds and applies the delta to the cached lot in one step, the delta stays pending until
+# settle() is called with the committed db value after the flush (or release() if it never got queued)
+def reserve(lot_id: int, delta: int) -> tuple[str, lh.Lot | None]:
+    _ensure_fresh()
+    with _lock:
+        lot = _lots.get(lot_id)
+        if lot is None:
+            return "unknown_lot", None
+        if lot.current + delta > lot.total_capacity:
+            return "lot_full", lot
+        if lot.current + delta < 0:
+            return "lot_empty", lot
+        _add_pending(lot_id, delta)
+        _set(lot_id, lot.current + delta)
+        return "accepted", _lots[lot_id]
+
+def release(lot_id: int, delta: int):
+    with _lock:
+        _add_pending(lot_id, -delta)
+        apply_delta(lot_id, -delta)
+
+def settle(lot_id: int, delta: int, current: int, total_capacity: int):
+    with _lock:
+        _add_pending(lot_id, -delta)
+        set_occupancy(lot_id, current, total_capacity)
+
+def _add_pending(lot_id: int, delta: int):
+    remaining = _pending.get(lot_id, 0) + delta
+    if remaining:
+        _pending[lot_id] = remaining
+    else:
+        _pending.pop(lot_id, None)
+
+def pending_deltas() -> dict[int, int]:
+    with _lock:
+        return dict(_pending)
+
+# Register a callback run with the new Lot whenever a lot's occupancy changes
+# Callbacks run on the writer's thread while the cache lock is held, so they must be quick and must not block
+def add_change_listener(callback):
+    with _lock:
+        if callback not in _change_listeners:
+            _change_listeners.append(callback)
+
+def remove_change_listener(callback):
+    with _lock:
+        if callback in _change_listeners:
+            _change_listeners.remove(callback)
+
+# Called by lot_listener when it (re)connects or loses its connection
+def set_live(live: bool):
+    global _live, _occupancy_loaded_at
+    with _lock:
+        _live = live
+        # Notifications may have been missed while we weren't listening, re-read occupancy on the next access
+        _occupancy_loaded_at = 0.0
+
+def is_live() -> bool:
+    return _live
+
+# Drop everything, the next read reloads the catalog from the db
+def invalidate():
+    global _catalog_loaded, _occupancy_loaded_at, _version
+    with _lock:
+        _version += 1
+        _lots.clear()
+        _index.clear()
+        _catalog_loaded = False
+        _occupancy_loaded_at = 0.0
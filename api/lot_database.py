@@ -1,5 +1,6 @@
-from random import random
+from random import Random, random
 import lot_helper as lh
+import lot_cache as lc
 
 '''
 Quite a bit of technical debt stacking up here, idealy, we would probably have a fast call to a specific attribute (col) 
@@ -7,160 +8,122 @@ or a record from a specific lot (row). There's a bit of mix and matching and ove
 '''
 
 def printTableContents():
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-
-    cursor.execute("SELECT * FROM lots ORDER BY lot_id;")
-    rows = cursor.fetchall()
+    with lh.get_cursor() as cursor:
+        cursor.execute("SELECT * FROM lots ORDER BY lot_id;")
+        rows = cursor.fetchall()
     for row in rows:
         print(row)
 
-    cursor.close()
-    connection.close()
-
+# Lot reads are served from the in-process lot cache (lot_cache), only writes go to the db
 def fetch_all_lots():
-    # Establish a cursor in the db, cursor is akin to a pointer
-    # This cursor will be used to execute SQL queries
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-
-    cursor.execute("SELECT * FROM lots ORDER BY lot_id;")   # Execute SQL Query
-    rows = cursor.fetchall()
-    
-    #connection.commit() # Not needed for non-modified queries
-    cursor.close()    # Close endpoints
-    connection.close()
-
-    # Construct a dict from data_type and row tuples
-    data_type = ["lot_id", "lot_name", "total_capacity", "current_type", "type", "hours"]
-    joined_data = []
-    
-    # for tups in rows:
-    #     temp_dict = {}
-    #     for x in range(len(tups)):
-    #         temp_dict[data_type[x]] = tups[x]
-    #     joined_data.append(temp_dict)
-
-    for tups in rows:
-        lot = lh.Lot(
-        lot_id = tups[0],
-        lot_name = tups[1],
-        total_capacity = tups[2],
-        current = tups[3],
-        type = tups[4],      
-        hours = tups[5]
-        )
-        joined_data.append(lot)
-
-    return joined_data
-
-# Fetch lot by id is used on the frontend, a caching approach would help reduce need to recall EXPENSIVE
-def fetch_lot_by_id(lot_id: int):
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-
-
-    cursor.execute("SELECT lot_id, lot_name, total_capacity, current, type, hours FROM lots WHERE lot_id = %s;", (lot_id,)) # Psycopg2 does NOT like f string
-
-    row = cursor.fetchone()
-
-    cursor.close()
-    connection.close()
-
-    if row is None:
-        return None
-
-    lot = lh.Lot(
-        lot_id=row[0],
-        lot_name=row[1],
-        total_capacity=row[2],
-        current=row[3],
-        type=row[4],
-        hours=row[5]
-    )
+    return lc.get_all_lots()
 
-    return lot
+# Fetch lot by id is used on the frontend, served from the cache so it's no longer EXPENSIVE
+def fetch_lot_by_id(lot_id: int):
+    return lc.get_lot(lot_id)
 
+# Many lots in one call, in the order of lot_ids with None for the missing ones
+def fetch_lots_by_ids(lot_ids: list[int]) -> list[lh.Lot | None]:
+    return lc.get_lots(lot_ids)
 
 def fetch_lot_by_name(lot_name: str) -> lh.Lot:
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-
-    # For some reason lot_id requires , even though it's a single param
-    cursor.execute("SELECT * FROM lots WHERE lot_name = %s;", (lot_name,))
-    row = cursor.fetchone()
-    
-    cursor.close()
-    connection.close()
-
-    if row is None:
-        return None
-
-    lot = lh.Lot(
-    lot_id = row[0],
-    lot_name = row[1],
-    total_capacity = row[2],
-    current = row[3],
-    type = row[4],      
-    hours = row[5]
-    )
-
-    return lot
+    return lc.get_lot_by_name(lot_name)
 
 # Faster call 
 def fetch_lot_percent_full():
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-
-    cursor.execute("SELECT lot_id, current, total_capacity FROM lots")
-    rows = cursor.fetchall()
-
-    cursor.close()
-    connection.close()
-
     res = []
-    for r in rows:
-        id = r[0]
-        curr = r[1]
-        cap = r[2]
+    for lot in lc.get_all_lots():
+        curr = lot.current
+        cap = lot.total_capacity
 
         percent_full = round(100.0 * curr / cap, 1) if cap > 0 else 0.0
 
-        res.append(lh.LotPercentFull(lot_id=id, percent_full=percent_full))
+        res.append(lh.LotPercentFull(lot_id=lot.lot_id, percent_full=percent_full))
     return res
 
-
-def rand_capacity():
-    return int(random() * 500) + 50
-
-def rand_current(capacity: int):
-    return int(random() * capacity)
+# One sorted / filtered page of lots, served from the catalog index (see lc.page_lots)
+def fetch_lot_page(lot_type: str | None = None, sort_field: str = "percent_full", descending: bool = False,
+                   limit: int | None = None, offset: int = 0, after: tuple | None = None, matches=None):
+    return lc.page_lots(lot_type, sort_field, descending, limit, offset, after, matches)
+
+# Version of the cached lot state, the ETag of the lot read endpoints
+def fetch_lots_etag() -> str:
+    return lc.etag()
+
+
+def rand_capacity(rng: Random | None = None):
+    return int((rng.random() if rng else random()) * 500) + 50
+
+def rand_current(capacity: int, rng: Random | None = None):
+    return int((rng.random() if rng else random()) * capacity)
+
+# Postgres setseed() takes a double in [-1, 1], fold any integer seed into that range
+def _pg_seed(seed: int) -> float:
+    return (seed % 2**31) / 2**31
+
+# Every lot is re-rolled server side in one statement: capacity in [50, 550), current in [0, capacity), the same
+# distribution as rand_capacity / rand_current. Lots are walked in lot_id order so a seed gives reproducible resets.
+RANDOMIZE_ALL_QUERY = """
+WITH rolled AS (
+    SELECT lot_id, floor(random() * 500)::int + 50 AS total_capacity, random() AS fill
+    FROM (SELECT lot_id FROM lots ORDER BY lot_id) AS ordered
+), moved AS (
+    UPDATE lots
+    SET total_capacity = rolled.total_capacity,
+        current = floor(rolled.fill * rolled.total_capacity)::int
+    FROM rolled
+    WHERE lots.lot_id = rolled.lot_id
+    RETURNING lots.lot_id, lots.lot_name, lots.total_capacity, lots.current, lots.type, lots.hours
+)
+SELECT moved.*,
+       pg_notify(%(channel)s, json_build_object('lot_id', lot_id, 'current', current, 'total_capacity', total_capacity)::text)
+FROM moved
+ORDER BY lot_id;
+"""
 
 # lot_id|lot_name|total_capacity|current|type|hours
-def randomize_lot_data(lot_id: int = -1, all_lots: bool = False):
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-
-    if all_lots:
-        cursor.execute("SELECT * FROM lots;")
-        rows = cursor.fetchall() # Grab every tuple in the table
-        for row in rows: # Iterate through each tuple
-            lot_id = row[0] # First element is lot_id
-            total_capacity = rand_capacity()
-            current = rand_current(total_capacity)
+# Returns the re-rolled lots, pass seed for a reproducible reset
+def randomize_lot_data(lot_id: int = -1, all_lots: bool = False, seed: int | None = None) -> list[lh.Lot]:
+    with lh.get_cursor() as cursor:
+        if all_lots:
+            query = RANDOMIZE_ALL_QUERY
+            if seed is not None:
+                # Same round trip, setseed only affects this session's random()
+                query = "SELECT setseed(%(seed)s);" + query
+            cursor.execute(query, {"channel": lh.LOT_CHANNEL, "seed": _pg_seed(seed) if seed is not None else None})
+        else:
+            rng = Random(seed) if seed is not None else None
+            total_capacity = rand_capacity(rng)
+            current = rand_current(total_capacity, rng)
             cursor.execute(
-                "UPDATE lots SET total_capacity = %s, current = %s WHERE lot_id = %s;",
-                (total_capacity, current, lot_id)
-            ) # Overwrite with new random values
-    else:
-            total_capacity = rand_capacity()
-            current = rand_current(total_capacity)
-            cursor.execute(
-                "UPDATE lots SET total_capacity = %s, current = %s WHERE lot_id = %s;",
-                (total_capacity, current, lot_id)
+                """
+                WITH moved AS (
+                    UPDATE lots SET total_capacity = %(total_capacity)s, current = %(current)s WHERE lot_id = %(lot_id)s
+                    RETURNING lot_id, lot_name, total_capacity, current, type, hours
+                )
+                SELECT moved.*,
+                       pg_notify(%(channel)s, json_build_object('lot_id', lot_id, 'current', current, 'total_capacity', total_capacity)::text)
+                FROM moved;
+                """,
+                {"total_capacity": total_capacity, "current": current, "lot_id": lot_id, "channel": lh.LOT_CHANNEL},
             )
+        rows = cursor.fetchall()
 
-    connection.commit()
-    cursor.close()
-    connection.close()
-    return
+    # Write through to the cache once committed
+    updated = []
+    for row in rows:
+        lot = lh.Lot(lot_id=row[0], lot_name=row[1], total_capacity=row[2], current=row[3], type=row[4], hours=row[5])
+        lc.set_occupancy(lot.lot_id, lot.current, lot.total_capacity)
+        updated.append(lot)
+    return updated
+
+
+# Awaitable versions for the async endpoints, these run on the DB executor so the event loop never blocks
+fetch_all_lots_async = lh.awaitable(fetch_all_lots)
+fetch_lot_by_id_async = lh.awaitable(fetch_lot_by_id)
+fetch_lot_by_name_async = lh.awaitable(fetch_lot_by_name)
+fetch_lots_by_ids_async = lh.awaitable(fetch_lots_by_ids)
+fetch_lot_percent_full_async = lh.awaitable(fetch_lot_percent_full)
+fetch_lot_page_async = lh.awaitable(fetch_lot_page)
+fetch_lots_etag_async = lh.awaitable(fetch_lots_etag)
+randomize_lot_data_async = lh.awaitable(randomize_lot_data)
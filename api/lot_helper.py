@@ -1,13 +1,19 @@
+import json
 import os
+from contextlib import contextmanager
 from pathlib import Path
 import psycopg2
+import db_pool
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from typing import Literal
+from typing import List, Literal, Optional
 
 load_dotenv()
 load_dotenv(Path(__file__).resolve().parent.parent / ".env")
 
+# NOTIFY channel every worker LISTENs on for lot occupancy changes (see lot_listener)
+LOT_CHANNEL = "lot_occupancy"
+
 # Enforce types with BModels
 
 # lot class with limited info
@@ -34,6 +40,17 @@ class LotSummary(BaseModel):
     type: str
     hours: str
 
+# One requested ID of a /lots/batch lookup, lot is None when no lot has that ID
+class LotBatchEntry(BaseModel):
+    lot_id: int
+    found: bool
+    lot: Optional[LotSummary] = None
+
+# Entries in request order, plus the requested IDs that don't exist
+class LotBatch(BaseModel):
+    lots: List[LotBatchEntry]
+    missing: List[int]
+
 # Exposes this BM for fast loading percentage full-ness
 class LotPercentFull(BaseModel):
     lot_id: int
@@ -45,48 +62,84 @@ def lot_dict():
     return lot_dict
 
 def get_lot_current_and__total_capacity(lot_id: int) -> int:
-    connection = establish_connection()
-    cursor = connection.cursor()
-
-    cursor.execute("SELECT current, total_capacity FROM lots WHERE lot_id = %s;", (lot_id,))
-    row = cursor.fetchone()
-
-    cursor.close()
-    connection.close()
+    with get_cursor() as cursor:
+        cursor.execute("SELECT current, total_capacity FROM lots WHERE lot_id = %s;", (lot_id,))
+        row = cursor.fetchone()
 
     if row is None:
         return None
 
     return row[0], row[1]
 
-def update_lots_current(is_entering: bool, lot_id: int):
-    import lot_database as ldb
-    connection = establish_connection()
-    cursor = connection.cursor()
-
-    # Check if updating would exceed capacity or go below 0
-    lot = ldb.fetch_lot_by_id(lot_id)
-    total_capacity = lot.total_capacity
-    current = lot.current
-    if is_entering and (current + 1) > total_capacity:
-        print("Error lot_capacity can not exceed total capacity.")
-        return
-    if not is_entering and (current - 1) < 0:
-        print("Error lot_capacity can not be less than 0.")
-        return
-
-    if is_entering:
-        cursor.execute(f"UPDATE lots SET current = current + 1 WHERE lot_id = {lot_id};")
-    else:
-        cursor.execute(f"UPDATE lots SET current = current - 1 WHERE lot_id = {lot_id};")
-
-    connection.commit()
-
-    cursor.close()
-    connection.close()
-
-
-
+# Moves the lot by one car, returns the new (current, total_capacity), or None when the lot doesn't exist or the move
+# would take it outside [0, total_capacity] (nothing is changed then)
+def update_lots_current(is_entering: bool, lot_id: int) -> Optional[tuple[int, int]]:
+    import lot_cache as lc
+
+    # The WHERE clause keeps the count within [0, total_capacity], checked atomically with the update
+    delta = 1 if is_entering else -1
+    with get_cursor(transaction=True) as cursor:
+        cursor.execute(
+            """
+            UPDATE lots SET current = current + %s
+            WHERE lot_id = %s AND current + %s BETWEEN 0 AND total_capacity
+            RETURNING current, total_capacity;
+            """,
+            (delta, lot_id, delta),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        current, total_capacity = row
+        notify_lot_change(cursor, lot_id, current, total_capacity)
+
+    # Keep the cached lot state in step with what was just committed
+    lc.set_occupancy(lot_id, current, total_capacity)
+    return current, total_capacity
+
+
+
+# Queue a NOTIFY with the lot's new counts, Postgres delivers it to the other workers when the transaction commits
+def notify_lot_change(cursor, lot_id: int, current: int, total_capacity: int):
+    payload = json.dumps({"lot_id": lot_id, "current": current, "total_capacity": total_capacity})
+    cursor.execute("SELECT pg_notify(%s, %s);", (LOT_CHANNEL, payload))
+
+
+# Borrow a pooled connection, it goes back to the pool (not closed) when the block exits
+@contextmanager
+def get_connection():
+    with db_pool.get_pool().connection() as connection:
+        yield connection
+
+# Borrow a pooled connection and cursor
+# transaction=False runs in autocommit mode (no BEGIN/ROLLBACK round trips), meant for reads and single statements
+# transaction=True commits when the block exits cleanly and rolls back on error
+@contextmanager
+def get_cursor(transaction: bool = False):
+    with get_connection() as connection:
+        connection.autocommit = not transaction
+        cursor = connection.cursor()
+        try:
+            yield cursor
+            if transaction:
+                connection.commit()
+        except Exception:
+            if transaction and not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+def pool_stats() -> dict:
+    stats = db_pool.pool_stats()
+    stats["executor"] = db_pool.executor_stats()
+    return stats
+
+# Turns a blocking DB function into an awaitable one that runs on the bounded DB executor
+def awaitable(func):
+    return db_pool.awaitable(func)
+
+# Opens a dedicated, unpooled connection. Prefer get_cursor() for anything on the request path
 def establish_connection():
     database_url = os.getenv("DATABASE_URL")
     if not database_url:
@@ -0,0 +1,88 @@
+import base64
+import json
+from bisect import bisect_left, bisect_right, insort
+from typing import Iterator, Optional
+import lot_helper as lh
+
+'''
+Sorted views of the cached lot catalog, so GET /lots can page through lots without sorting or scanning all of them.
+For every sort field there is one ordered list of keys over all lots and one per lot type; a key is
+(sort value, lot_id), so ties break on lot_id. Occupancy changes move a lot's percent_full key with one bisect
+delete + insort per list, the whole index is only rebuilt when the catalog is (re)loaded. Not thread-safe on its own,
+lot_cache calls it with its lock held.
+'''
+
+SORT_FIELDS = ("percent_full", "lot_name")
+
+
+def percent_full(lot: lh.Lot) -> int:
+    return int((lot.current / lot.total_capacity) * 100) if lot.total_capacity > 0 else 0
+
+def sort_key(lot: lh.Lot, field: str) -> tuple:
+    if field == "percent_full":
+        return (percent_full(lot), lot.lot_id)
+    return (lot.lot_name.lower(), lot.lot_id)
+
+def _type_key(lot_type: Optional[str]) -> Optional[str]:
+    return lot_type.lower() if lot_type else None
+
+
+# Opaque pagination cursor: the sort field and the key of the last lot on the previous page
+def encode_cursor(field: str, key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps([field, *key]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, field: str) -> tuple:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        cursor_field, value, lot_id = decoded
+    except ValueError:
+        raise ValueError("Malformed cursor") from None
+    expected = int if field == "percent_full" else str
+    if cursor_field != field or not isinstance(value, expected) or not isinstance(lot_id, int):
+        raise ValueError(f"Cursor does not belong to a {field} listing")
+    return (value, lot_id)
+
+
+class LotIndex:
+    def __init__(self):
+        self._orders: dict[tuple[Optional[str], str], list[tuple]] = {}    # (type or None, field) -> sorted keys
+
+    def rebuild(self, lots):
+        orders = {}
+        for lot in lots:
+            for group in (None, _type_key(lot.type)):
+                for field in SORT_FIELDS:
+                    orders.setdefault((group, field), []).append(sort_key(lot, field))
+        for keys in orders.values():
+            keys.sort()
+        self._orders = orders
+
+    def clear(self):
+        self._orders = {}
+
+    # Move a lot whose occupancy (or capacity) changed, old and new are the cached objects before / after the change
+    def update(self, old: lh.Lot, new: lh.Lot):
+        for field in SORT_FIELDS:
+            old_key, new_key = sort_key(old, field), sort_key(new, field)
+            if old_key == new_key:
+                continue
+            for group in (None, _type_key(old.type)):
+                keys = self._orders[(group, field)]
+                del keys[bisect_left(keys, old_key)]
+                insort(keys, new_key)
+
+    def count(self, lot_type: Optional[str] = None) -> int:
+        return len(self._orders.get((_type_key(lot_type), SORT_FIELDS[0]), ()))
+
+    # Keys in the requested order, starting after the cursor key (if any) and skipping offset entries
+    def ordered(self, lot_type: Optional[str], field: str, descending: bool = False, after: Optional[tuple] = None,
+                offset: int = 0) -> Iterator[tuple]:
+        keys = self._orders.get((_type_key(lot_type), field), [])
+        if descending:
+            start = (bisect_left(keys, after) if after is not None else len(keys)) - 1 - offset
+            for position in range(start, -1, -1):
+                yield keys[position]
+        else:
+            start = (bisect_right(keys, after) if after is not None else 0) + offset
+            for position in range(start, len(keys)):
+                yield keys[position]
@@ -0,0 +1,73 @@
+import json
+import select
+import threading
+import psycopg2
+import lot_helper as lh
+import lot_cache as lc
+
+'''
+Background LISTEN on lh.LOT_CHANNEL so every API worker applies occupancy changes written by the others.
+Write paths queue a NOTIFY inside their transaction (lh.notify_lot_change), Postgres delivers them in commit order
+and the payload carries absolute counts, so re-applying this worker's own notifications is harmless.
+Uses its own dedicated connection since a LISTENing session can't be returned to the pool.
+'''
+
+POLL_SECONDS = 1.0          # how long select() waits before checking the stop flag
+RECONNECT_MAX_SECONDS = 30.0
+
+_thread = None
+_stop = threading.Event()
+
+
+def _apply(payload: str):
+    try:
+        change = json.loads(payload)
+        lc.set_occupancy(int(change["lot_id"]), int(change["current"]), int(change["total_capacity"]))
+    except (ValueError, KeyError, TypeError):
+        print(f"Ignoring malformed {lh.LOT_CHANNEL} notification: {payload!r}")
+
+def _listen_once():
+    connection = lh.establish_connection()
+    try:
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {lh.LOT_CHANNEL};")
+        lc.set_live(True)
+
+        while not _stop.is_set():
+            readable, _, _ = select.select([connection], [], [], POLL_SECONDS)
+            if not readable:
+                continue
+            connection.poll()
+            while connection.notifies:
+                _apply(connection.notifies.pop(0).payload)
+    finally:
+        lc.set_live(False)
+        connection.close()
+
+def _run():
+    backoff = 1.0
+    while not _stop.is_set():
+        try:
+            _listen_once()
+            backoff = 1.0
+        except (psycopg2.Error, OSError, RuntimeError) as exc:
+            print(f"Lot listener disconnected ({exc}), retrying in {backoff:.0f}s")
+            _stop.wait(backoff)
+            backoff = min(backoff * 2, RECONNECT_MAX_SECONDS)
+
+
+def start():
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="lot-listener", daemon=True)
+    _thread.start()
+
+def stop(timeout: float = POLL_SECONDS + 1):
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+    _thread = None
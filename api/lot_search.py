@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import threading
+from bisect import bisect_left
+from itertools import chain
+from typing import Optional
+from pydantic import BaseModel
+import lot_helper as lh
+import lot_cache as lc
+
+'''
+Typo-tolerant lookup over lot names, IDs and aliases, behind /lots?search_query= and /lots/search autocomplete.
+Every searchable string is normalized to lowercase letters and digits only ("P 15", "p-15" and "P15" are all "p15").
+Names like "P15" also get the aliases "15", "lot15", "parking15" and "parkinglot15"; extra aliases can be listed per
+lot_id in the JSON file at LOT_ALIASES_PATH. Matches rank exact > lot_id > prefix > substring > trigram similarity,
+prefixes come from bisecting the sorted strings, substrings / near misses from a trigram inverted index and single
+typos ("pl5" for "p15") from an index of every string with one character deleted. /lots?search_query= is a filter, so it
+only keeps the exact / lot_id / prefix / substring tiers: typos and trigram near misses would let "P13" pull in P1, P3
+and P15, they are left to the ranked, limited /lots/search.
+The index is rebuilt only when lot_cache reloads the catalog, occupancy changes don't touch it.
+'''
+
+ALIASES_PATH = os.getenv("LOT_ALIASES_PATH")
+FUZZY_MIN_SCORE = 0.3           # trigram Jaccard similarity below this is not a match
+FUZZY_COMMON_GRAM = 0.02        # trigrams in more than this share of strings don't nominate fuzzy candidates
+TYPO_MIN_LENGTH = 3             # shorter queries only match exactly / as prefix or substring
+NUMBERED_NAME = re.compile(r"^([a-z]+)(\d+)$")
+
+
+class LotSearchHit(BaseModel):
+    lot_id: int
+    lot_name: str
+    type: str
+    matched: str        # the name / alias that matched
+    score: float
+
+
+def normalize(text: str) -> str:
+    return "".join(character for character in text.lower() if character.isalnum())
+
+def trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# The string with each character removed in turn, two strings within one edit share at least one of these (or itself)
+def deletions(text: str) -> set[str]:
+    return {text[:i] + text[i + 1:] for i in range(len(text))} - {""}
+
+def _load_extra_aliases() -> dict[int, list[str]]:
+    if not ALIASES_PATH:
+        return {}
+    with open(ALIASES_PATH) as file:
+        return {int(lot_id): aliases for lot_id, aliases in json.load(file).items()}
+
+def aliases_for(lot: lh.Lot, extra: dict[int, list[str]]) -> list[str]:
+    aliases = list(extra.get(lot.lot_id, []))
+    match = NUMBERED_NAME.match(normalize(lot.lot_name))
+    if match:
+        number = match.group(2)
+        aliases += [number, f"lot{number}", f"parking{number}", f"parkinglot{number}"]
+    return aliases
+
+
+class SearchIndex:
+    def __init__(self, lots: list[lh.Lot], extra_aliases: Optional[dict[int, list[str]]] = None):
+        extra_aliases = extra_aliases or {}
+        self.lots = {lot.lot_id: lot for lot in lots}
+        self.strings: list[tuple[str, int, str]] = []       # (normalized, lot_id, original text)
+        for lot in lots:
+            seen = set()
+            for text in [lot.lot_name, *aliases_for(lot, extra_aliases)]:
+                key = normalize(text)
+                if key and key not in seen:
+                    seen.add(key)
+                    self.strings.append((key, lot.lot_id, text))
+
+        self.types = {lot.lot_id: lot.type.lower() for lot in lots}
+        self.lengths = [len(key) for key, _, _ in self.strings]
+        ordered = sorted((key, position) for position, (key, _, _) in enumerate(self.strings))
+        self.sorted_keys = [key for key, _ in ordered]
+        self.sorted_positions = [position for _, position in ordered]
+        self.grams = [trigrams(key) for key, _, _ in self.strings]
+        self.postings: dict[str, list[int]] = {}
+        for position, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(position)
+        self.variants: dict[str, list[int]] = {}
+        for position, (key, _, _) in enumerate(self.strings):
+            for variant in deletions(key) | {key}:
+                self.variants.setdefault(variant, []).append(position)
+
+    # lot_id -> (score, matched text) for every lot matching the query, at least the best limit of them.
+    # fuzzy=False stops after the substring tier (scores >= 2), no typos or trigram near misses
+    def matches(self, query: str, limit: Optional[int] = None, lot_type: Optional[str] = None,
+                fuzzy: bool = True) -> dict[int, tuple[float, str]]:
+        needle = normalize(query)
+        if not needle:
+            return {}
+        wanted_type = lot_type.lower() if lot_type else None
+        best: dict[int, tuple[float, str]] = {}     # lot_id -> (score, matched text)
+
+        def offer(position: int, score: float):
+            _, lot_id, text = self.strings[position]
+            if wanted_type and self.types[lot_id] != wanted_type:
+                return
+            if lot_id not in best or score > best[lot_id][0]:
+                best[lot_id] = (score, text)
+
+        # Each tier scores below the one before it, so once limit lots are found the rest can't make the cut
+        def full() -> bool:
+            return limit is not None and len(best) >= limit
+
+        if needle.isdigit() and int(needle) in self.lots:
+            lot = self.lots[int(needle)]
+            if not wanted_type or self.types[lot.lot_id] == wanted_type:
+                best[lot.lot_id] = (3.5, str(lot.lot_id))
+
+        # Exact and prefix matches: one contiguous run of the sorted strings, shortest (best) first
+        first = bisect_left(self.sorted_keys, needle)
+        last = bisect_left(self.sorted_keys, needle + "\U0010ffff", first)
+        for position in sorted(self.sorted_positions[first:last], key=self.lengths.__getitem__):
+            if full():
+                break
+            offer(position, 4.0 if self.lengths[position] == len(needle) else 3.0 + len(needle) / self.lengths[position])
+
+        # Substrings: strings holding every inner trigram of the query, rarest trigram first. Needles too short to have
+        # one ("7", "p2") scan every string instead, cheap at catalog scale
+        inner = sorted({needle[i:i + 3] for i in range(len(needle) - 2)}, key=lambda gram: len(self.postings.get(gram, ())))
+        if not full():
+            if inner:
+                candidates = set(self.postings.get(inner[0], ()))
+                for gram in inner[1:]:
+                    candidates.intersection_update(self.postings.get(gram, ()))
+            else:
+                candidates = range(len(self.strings))
+            for position in sorted(candidates, key=self.lengths.__getitem__):
+                if full():
+                    break
+                key = self.strings[position][0]
+                if needle in key and not key.startswith(needle):
+                    offer(position, 2.0 + len(needle) / len(key))
+
+        if not fuzzy:
+            return best
+
+        # Single typos: a dropped, extra, swapped or replaced character
+        if len(needle) >= TYPO_MIN_LENGTH and not full():
+            for variant in deletions(needle) | {needle}:
+                for position in self.variants.get(variant, ()):
+                    offer(position, 1.5)
+
+        # Near misses: Jaccard similarity of trigram sets. Candidates come from the query's selective trigrams only,
+        # ones shared by more than FUZZY_COMMON_GRAM of all strings ("  p", "gar") say little and are costly to read
+        if not full():
+            query_grams = trigrams(needle)
+            by_rarity = sorted(query_grams, key=lambda gram: len(self.postings.get(gram, ())))
+            common = max(64, int(len(self.strings) * FUZZY_COMMON_GRAM))
+            selective = [gram for gram in by_rarity if len(self.postings.get(gram, ())) <= common] or by_rarity[:1]
+            for position in set(chain.from_iterable(self.postings.get(gram, ()) for gram in selective)):
+                count = len(query_grams & self.grams[position])
+                similarity = count / (len(query_grams) + len(self.grams[position]) - count)
+                if similarity >= FUZZY_MIN_SCORE:
+                    offer(position, similarity)
+
+        return best
+
+    def search(self, query: str, limit: Optional[int] = 10, lot_type: Optional[str] = None) -> list[LotSearchHit]:
+        best = self.matches(query, limit, lot_type)
+        ranked = sorted(best.items(), key=lambda item: (-item[1][0], len(self.lots[item[0]].lot_name), item[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [
+            LotSearchHit(lot_id=lot_id, lot_name=self.lots[lot_id].lot_name, type=self.lots[lot_id].type, matched=text,
+                         score=round(score, 3))
+            for lot_id, (score, text) in ranked
+        ]
+
+
+_lock = threading.Lock()
+_index: Optional[SearchIndex] = None
+_generation = None
+
+def get_index() -> SearchIndex:
+    global _index, _generation
+    generation = lc.catalog_generation()
+    if _index is None or _generation != generation:
+        with _lock:
+            if _index is None or _generation != generation:
+                _index = SearchIndex(lc.get_all_lots(), _load_extra_aliases())
+                _generation = generation
+    return _index
+
+def search(query: str, limit: Optional[int] = 10, lot_type: Optional[str] = None) -> list[LotSearchHit]:
+    return get_index().search(query, limit, lot_type)
+
+# lot_ids matching the query exactly, by lot_id, as a prefix or as a substring, for filtering /lots
+def matching_lot_ids(query: str) -> set[int]:
+    return set(get_index().matches(query, fuzzy=False))
+
+
+# Awaitable versions for the async endpoints (the first call after a catalog reload may hit the db)
+search_async = lh.awaitable(search)
+matching_lot_ids_async = lh.awaitable(matching_lot_ids)
@@ -1,19 +1,101 @@
 # Run: fastapi dev main.py
 # Swagger: http://127.0.0.1:8000/docs
-from fastapi import FastAPI, HTTPException, Query, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
-from datetime import datetime
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, EmailStr, TypeAdapter, ValidationError
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from typing import List, Literal, Optional
 from uuid import UUID
+import asyncio
+import json
 import os
-import httpx
 import lot_helper as lh
 import lot_database as ldb
+import lot_cache as lc
+import lot_index
+import lot_search
 import detection_database as ddb
 import users_database as udb
+import db_pool
+import lot_listener
+import occupancy_stream
+import event_buffer
+import ensemble
+import forecast
+import rollups
+import event_export
+import partitions
+import response_cache
+import supabase_client
+import auth_tokens
+
+# Startup / shutdown hooks for process-wide resources
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep this worker's lot cache in sync with writes made by other workers
+    if os.getenv("LOT_LISTENER", "1") != "0":
+        lot_listener.start()
+    # Keep-alive connections to Supabase for the auth proxy
+    supabase_client.start()
+    # Background refresh of the signing keys access tokens are verified against
+    if os.getenv("EXPO_PUBLIC_SUPABASE_URL"):
+        auth_tokens.start()
+    # Lot changes fan out to /lots/stream and /ws/lots subscribers from this loop
+    occupancy_stream.hub.attach(asyncio.get_running_loop())
+    if event_buffer.enabled():
+        event_buffer.start()
+    # Fold new parking_events into the per-minute / per-hour rollups behind /lots/{lot_id}/history
+    if os.getenv("EVENT_ROLLUPS", "1") != "0":
+        rollups.start()
+    # Premake / expire parking_events partitions (no-op until partitions.py --migrate has run)
+    if os.getenv("PARTITION_MAINTENANCE", "1") != "0":
+        partitions.start()
+    # One bounded process pool for /simulation/ensemble
+    ensemble.start()
+    yield
+    # Drain buffered events before the pool goes away
+    await asyncio.to_thread(event_buffer.stop)
+    rollups.stop()
+    partitions.stop()
+    await asyncio.to_thread(ensemble.stop)
+    occupancy_stream.hub.detach()
+    lot_listener.stop()
+    await auth_tokens.stop()
+    await supabase_client.stop()
+    db_pool.shutdown_executor()
+    db_pool.close_pool()
+
+app = FastAPI(title="ParkingPal API", lifespan=lifespan)
+
+# Too many DB calls queued (or no free connection in time): shed load instead of letting requests pile up
+@app.exception_handler(db_pool.DatabaseBusyError)
+@app.exception_handler(db_pool.PoolTimeoutError)
+@app.exception_handler(event_buffer.BufferFullError)
+@app.exception_handler(event_export.ExportBusyError)
+async def database_busy_handler(request: Request, exc: Exception):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "1"},
+    )
+
+# Every ensemble slot is taken, the client should come back later rather than queue CPU-bound work
+@app.exception_handler(ensemble.EnsembleBusyError)
+async def ensemble_busy_handler(request: Request, exc: ensemble.EnsembleBusyError):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "5"},
+    )
 
-app = FastAPI(title="ParkingPal API")
+# Supabase unreachable, too slow or too busy (after retries): 502 / 504 / 503 instead of holding the worker
+@app.exception_handler(supabase_client.UpstreamError)
+async def upstream_error_handler(request: Request, exc: supabase_client.UpstreamError):
+    headers = {"Retry-After": "1"} if exc.status_code == status.HTTP_503_SERVICE_UNAVAILABLE else None
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc)}, headers=headers)
 
 class UserCredentials(BaseModel):
     email: EmailStr
@@ -28,6 +110,9 @@ class SimulatedVehicleEvent(BaseModel):
     percent_full: float
     lot: lh.LotSummary
 
+class LotBatchRequest(BaseModel):
+    ids: List[int]
+
 # compute crowd state
 def full_type(p: float) -> str:
     if p == 0: return "EMPTY"
@@ -38,7 +123,7 @@ def full_type(p: float) -> str:
 
 # Create LotSummary from Lot
 def to_summary(obj: lh.Lot) -> lh.LotSummary:
-    pf = int((obj.current / obj.total_capacity) * 100)
+    pf = lot_index.percent_full(obj)
     return lh.LotSummary(
         lot_id=obj.lot_id,
         lot_name=obj.lot_name,
@@ -50,6 +135,36 @@ def to_summary(obj: lh.Lot) -> lh.LotSummary:
         hours=obj.hours
     )
 
+# Selectable LotSummary fields for the fields= parameter, in response order
+LOT_FIELDS = tuple(lh.LotSummary.model_fields)
+
+# Validates a comma separated fields= value, None (everything) when it is omitted
+def parse_fields(fields: Optional[str]) -> Optional[tuple]:
+    if not fields:
+        return None
+    wanted = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = wanted.difference(LOT_FIELDS)
+    if unknown or not wanted:
+        raise HTTPException(status_code=400, detail=f"fields must be a comma separated subset of {', '.join(LOT_FIELDS)}")
+    return tuple(name for name in LOT_FIELDS if name in wanted)
+
+# Only the requested fields of a lot's summary, percent_full / state are only computed when asked for
+def project_summary(obj: lh.Lot, fields: tuple) -> dict:
+    projected = {}
+    pf = lot_index.percent_full(obj) if "percent_full" in fields or "state" in fields else None
+    for name in fields:
+        if name == "percent_full":
+            projected[name] = pf
+        elif name == "state":
+            projected[name] = full_type(pf)
+        else:
+            projected[name] = getattr(obj, name)
+    return projected
+
+# Full LotSummary, or a plain dict of the selected fields
+def to_view(obj: lh.Lot, fields: Optional[tuple]):
+    return to_summary(obj) if fields is None else project_summary(obj, fields)
+
 # CORS (Cross-Origin Resource Sharing) settings
 # Add CORS for expo development servers
 # Some ports are redundant to run locally
@@ -65,191 +180,522 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to the ParkingPal API!"}
 
-@app.post("/auth/login")
-async def login(user_credentials: UserCredentials):
-    supabase_url = os.getenv("EXPO_PUBLIC_SUPABASE_URL")
-    supabase_anon_key = os.getenv("EXPO_PUBLIC_SUPABASE_ANON_KEY")
-    supabase_auth_url = f"{supabase_url}/auth/v1/token?grant_type=password"
-    async with httpx.AsyncClient() as client:
-        supabase_response = await client.post(
-            supabase_auth_url,
-            headers={
-                "apikey": supabase_anon_key,
-                "Authorization": f"Bearer {supabase_anon_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "email": user_credentials.email,
-                "password": user_credentials.password,
-            },
-        )
-
-    response_data = supabase_response.json()
+# Connection pool usage for this worker, used to size DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE
+@app.get("/db/pool_stats")
+async def get_pool_stats():
+    return lh.pool_stats()
+
+# Write-behind buffer usage (queued / flushed counts and current backlog)
+@app.get("/vehicle_events/buffer_stats")
+async def get_event_buffer_stats():
+    return event_buffer.stats()
+
+# Shared Supabase client usage (retries, timeouts, calls turned away at the concurrency limit)
+@app.get("/auth/client_stats")
+async def get_auth_client_stats():
+    return supabase_client.stats() | {"tokens": auth_tokens.stats()}
+
+# Supabase answer passed through as is, its error status included
+def supabase_result(supabase_response):
+    try:
+        response_data = supabase_response.json()
+    except ValueError:
+        response_data = {"error": supabase_response.text}
     if supabase_response.status_code >= 400:
         raise HTTPException(status_code=supabase_response.status_code, detail=response_data)
-
     return response_data
 
+# Password grants don't change anything upstream, so a failed one may be retried
+@app.post("/auth/login")
+async def login(user_credentials: UserCredentials):
+    supabase_response = await supabase_client.post(
+        supabase_client.auth_url("token?grant_type=password"),
+        headers=supabase_client.auth_headers(),
+        json={
+            "email": user_credentials.email,
+            "password": user_credentials.password,
+        },
+        idempotent=True,
+    )
+    return supabase_result(supabase_response)
+
 @app.post("/auth/register")
 async def register(user_credentials: UserCredentials):
-    supabase_url = os.getenv("EXPO_PUBLIC_SUPABASE_URL")
-    supabase_anon_key = os.getenv("EXPO_PUBLIC_SUPABASE_ANON_KEY")
-    supabase_auth_url = f"{supabase_url}/auth/v1/signup"
-    async with httpx.AsyncClient() as client:
-        supabase_response = await client.post(
-            supabase_auth_url,
-            headers={
-                "apikey": supabase_anon_key,
-                "Authorization": f"Bearer {supabase_anon_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "email": user_credentials.email,
-                "password": user_credentials.password,
-            },
-        )
-
-    response_data = supabase_response.json()
-    if supabase_response.status_code >= 400:
-        raise HTTPException(status_code=supabase_response.status_code, detail=response_data)
-
-    return response_data
+    supabase_response = await supabase_client.post(
+        supabase_client.auth_url("signup"),
+        headers=supabase_client.auth_headers(),
+        json={
+            "email": user_credentials.email,
+            "password": user_credentials.password,
+        },
+    )
+    return supabase_result(supabase_response)
+
+# ETag of the current lot state. Computed inline while the cache is fresh, so a 304 costs no DB call or thread hop
+async def lots_etag() -> str:
+    if lc.is_fresh():
+        return lc.etag()
+    return await ldb.fetch_lots_etag_async()
+
+def etag_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+# 304 response when the client already holds this version (If-None-Match)
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = {tag.strip() for tag in if_none_match.split(",")}
+        if "*" in candidates or etag in candidates or etag.removeprefix("W/") in candidates:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag))
+    return None
+
+def to_jsonable(content):
+    if isinstance(content, BaseModel):
+        return content.model_dump(mode="json")
+    if isinstance(content, dict):
+        return content
+    return [item.model_dump(mode="json") if isinstance(item, BaseModel) else item for item in content]
+
+# Pre-encoded JSON for a lot read endpoint: build() only runs when the lots changed since the body for key was cached,
+# otherwise the response is the stored bytes (gzip / brotli when the client accepts them)
+async def cached_lot_response(request: Request, key: tuple, build) -> Response:
+    # Tag before reading, a change in between only makes the next request a full one
+    etag = await lots_etag()
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    entry = response_cache.lot_responses.get(key, etag)
+    if entry is None:
+        # build() may return (content, extra headers) for headers that belong to the cached body
+        content = await build()
+        content, extra_headers = content if isinstance(content, tuple) else (content, {})
+        entry = response_cache.lot_responses.put(key, etag, to_jsonable(content), extra_headers)
+    body, encoding = entry.encoded(response_cache.pick_encoding(request.headers.get("accept-encoding")))
+    headers = etag_headers(etag) | entry.headers | {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
 
 # Returns all lots that match the given filters
 # Filters by optional name/ID search and lot type
-# Sorts by percent full or name (asc/desc)
-# Converts full lot data to summarized form before returning
+# Sorts by percent full or name (asc/desc), ties in lot_id order
+# Pages with limit + offset or limit + cursor (the X-Next-Cursor header of the previous page)
+# Converts full lot data to summarized form before returning, fields=lot_id,percent_full trims it to those fields
 @app.get("/lots", response_model=List[lh.LotSummary])
-def list_lots(
+async def list_lots(
+    request: Request,
     search_query: Optional[str] = Query(None, description="Search by name or ID"),
     lot_category: Optional[str] = Query(None, description="student|faculty|visitor"),
     sort_option: str = Query("percent_full", description="percent_full|lot_name|-percent_full|-lot_name"),
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Page size, every matching lot if omitted"),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    fields: Optional[str] = Query(None, description="Comma separated LotSummary fields, all of them if omitted"),
     ):
-    parking_lots = ldb.fetch_all_lots()
-    def lot_matches(lot: lh.Lot) -> bool:
-        if lot_category and lot.type.lower() != lot_category.lower():
-            return False
-        if search_query:
-            if search_query.isdigit() and int(search_query) == lot.lot_id:
-                return True
-            if search_query.lower() not in lot.lot_name.lower():
-                return False
-        return True
-
-    matching_lots = []
-    for lot in parking_lots:
-        if lot_matches(lot):
-            matching_lots.append(lot)
+    selected = parse_fields(fields)
+    key = ("lots", search_query, lot_category, sort_option, limit, offset, cursor, selected)
+    return await cached_lot_response(
+        request, key, lambda: build_lot_list(search_query, lot_category, sort_option, limit, offset, cursor, selected),
+    )
 
+async def build_lot_list(search_query: Optional[str], lot_category: Optional[str], sort_option: str,
+                         limit: Optional[int] = None, offset: int = 0, cursor: Optional[str] = None,
+                         fields: Optional[tuple] = None):
     # Grab sort option and char[0] for descending
-    sort_field = sort_option.lstrip("-")
+    sort_field = "percent_full" if sort_option.lstrip("-") == "percent_full" else "lot_name"
     descending_order = sort_option.startswith("-")
+    try:
+        after = lot_index.decode_cursor(cursor, sort_field) if cursor else None
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
 
-    def sort_key_function(lot: lh.Lot):
-        if sort_field == "percent_full":
-            return int((lot.current / lot.total_capacity) * 100)
-        else:
-            return lot.lot_name.lower()
+    # Names, IDs and aliases are looked up in the search index (typos included), then paged in the requested order
+    lot_matches = None
+    if search_query:
+        matching_ids = await lot_search.matching_lot_ids_async(search_query)
+        lot_matches = lambda lot: lot.lot_id in matching_ids
 
-    matching_lots.sort(key=sort_key_function, reverse=descending_order)
+    # Type filter and order come from the catalog index
+    page, next_key = await ldb.fetch_lot_page_async(
+        lot_category, sort_field, descending_order, limit, offset, after, lot_matches,
+    )
+    headers = {"X-Next-Cursor": lot_index.encode_cursor(sort_field, next_key)} if next_key else {}
+    return [to_view(lot, fields) for lot in page], headers
 
-    summarized_lots = []
-    for lot in matching_lots:
-        summarized_lot = to_summary(lot)
-        summarized_lots.append(summarized_lot)
 
-    return summarized_lots
+# Seconds between keepalives on idle streams, keeps proxies from closing the connection
+STREAM_KEEPALIVE_SECONDS = 15
 
+# Payload for one lot on the occupancy streams, view picks the LotSummary or the light LotPercentFull shape
+def stream_payload(lot: lh.Lot, view: str) -> BaseModel:
+    if view == "percent_full":
+        percent_full = round(100.0 * lot.current / lot.total_capacity, 1) if lot.total_capacity > 0 else 0.0
+        return lh.LotPercentFull(lot_id=lot.lot_id, percent_full=percent_full)
+    return to_summary(lot)
+
+def stream_snapshot(lots: List[lh.Lot], wanted: Optional[set], view: str) -> list:
+    return [stream_payload(lot, view).model_dump(mode="json") for lot in lots if wanted is None or lot.lot_id in wanted]
 
-# Get lot by ID
-@app.get("/lots/{lot_id}", response_model=lh.LotSummary)
-async def get_lot(lot_id: int):
-    print("Fetching lot ID:", lot_id)
-    lot = ldb.fetch_lot_by_id(lot_id)
+# Server-Sent Events: one "snapshot" event with the current lots, then a "delta" event per lot whenever it changes
+# Replaces polling /lots_percent_full and /lots/{lot_id}
+@app.get("/lots/stream")
+async def stream_lots(
+    lot_ids: Optional[str] = Query(None, description="Comma separated lot IDs to watch, all lots if omitted"),
+    view: Literal["summary", "percent_full"] = Query("summary", description="summary|percent_full"),
+    ):
+    try:
+        wanted = occupancy_stream.parse_lot_ids(lot_ids)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+    # Subscribe before reading the snapshot so no change can slip in between
+    subscription = occupancy_stream.hub.subscribe(wanted)
+    try:
+        lots = await ldb.fetch_all_lots_async()
+    except Exception:
+        occupancy_stream.hub.unsubscribe(subscription)
+        raise
+
+    async def events():
+        try:
+            yield f"event: snapshot\ndata: {json.dumps(stream_snapshot(lots, wanted, view))}\n\n"
+            while True:
+                changes = await subscription.next_changes(STREAM_KEEPALIVE_SECONDS)
+                if not changes:
+                    yield ": keepalive\n\n"
+                    continue
+                for lot in changes:
+                    yield f"event: delta\ndata: {stream_payload(lot, view).model_dump_json()}\n\n"
+        finally:
+            occupancy_stream.hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# WebSocket version of /lots/stream, messages are {"type": "snapshot", "lots": [...]}, {"type": "delta", "lot": {...}}
+# and {"type": "keepalive"}
+@app.websocket("/ws/lots")
+async def websocket_lots(
+    websocket: WebSocket,
+    lot_ids: Optional[str] = None,
+    view: Literal["summary", "percent_full"] = "summary",
+    ):
+    try:
+        wanted = occupancy_stream.parse_lot_ids(lot_ids)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    subscription = occupancy_stream.hub.subscribe(wanted)
+    try:
+        lots = await ldb.fetch_all_lots_async()
+        await websocket.send_json({"type": "snapshot", "lots": stream_snapshot(lots, wanted, view)})
+        while True:
+            changes = await subscription.next_changes(STREAM_KEEPALIVE_SECONDS)
+            if not changes:
+                await websocket.send_json({"type": "keepalive"})
+                continue
+            for lot in changes:
+                await websocket.send_json({"type": "delta", "lot": stream_payload(lot, view).model_dump(mode="json")})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        occupancy_stream.hub.unsubscribe(subscription)
+
+
+# Autocomplete over lot names, IDs and aliases ("P 15", "lot15", "15"), best match first, tolerates small typos
+@app.get("/lots/search", response_model=List[lot_search.LotSearchHit])
+async def search_lots(
+    q: str = Query(..., min_length=1, max_length=100, description="Partial name, alias or ID"),
+    limit: int = Query(10, ge=1, le=100),
+    lot_category: Optional[str] = Query(None, description="student|faculty|visitor"),
+    ):
+    return await lot_search.search_async(q, limit, lot_category)
+
+# Largest ID list /lots/batch accepts in one request
+MAX_BATCH_IDS = 1000
+
+# Comma separated IDs in request order, duplicates kept
+def parse_batch_ids(ids: str) -> List[int]:
+    try:
+        lot_ids = [int(part) for part in ids.split(",") if part.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"ids must be a comma separated list of integers, got {ids!r}") from None
+    return check_batch_ids(lot_ids)
+
+def check_batch_ids(lot_ids: List[int]) -> List[int]:
+    if not lot_ids:
+        raise HTTPException(status_code=400, detail="ids must name at least one lot")
+    if len(lot_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per request")
+    return lot_ids
+
+async def build_lot_batch(lot_ids: List[int]) -> lh.LotBatch:
+    lots = await ldb.fetch_lots_by_ids_async(lot_ids)
+    entries = [
+        lh.LotBatchEntry(lot_id=lot_id, found=lot is not None, lot=to_summary(lot) if lot is not None else None)
+        for lot_id, lot in zip(lot_ids, lots)
+    ]
+    missing = list(dict.fromkeys(entry.lot_id for entry in entries if not entry.found))
+    return lh.LotBatch(lots=entries, missing=missing)
+
+# Many lots in one request, entries follow the order of ids and unknown IDs come back with found=false
+# GET /lots/batch?ids=0,3,7 is cached and answers 304 like /lots, POST takes {"ids": [...]} for long lists
+@app.get("/lots/batch", response_model=lh.LotBatch)
+async def get_lot_batch(request: Request, ids: str = Query(..., description="Comma separated lot IDs, e.g. 0,3,7")):
+    lot_ids = parse_batch_ids(ids)
+    return await cached_lot_response(request, ("batch", tuple(lot_ids)), lambda: build_lot_batch(lot_ids))
+
+@app.post("/lots/batch", response_model=lh.LotBatch)
+async def post_lot_batch(batch: LotBatchRequest):
+    return await build_lot_batch(check_batch_ids(batch.ids))
+
+# Get lot by ID, fields= picks a subset of the LotSummary fields like on /lots, 404 for unknown IDs (/lots/batch
+# reports those as found: false instead)
+@app.get("/lots/{lot_id}", response_model=lh.LotSummary, responses={404: {"description": "Lot not found"}})
+async def get_lot(
+    lot_id: int,
+    request: Request,
+    fields: Optional[str] = Query(None, description="Comma separated LotSummary fields, all of them if omitted"),
+    ):
+    selected = parse_fields(fields)
+
+    async def build():
+        lot = await ldb.fetch_lot_by_id_async(lot_id)
+        if not lot:
+            raise HTTPException(status_code=404, detail="Lot not found")
+        return to_view(lot, selected)
+
+    return await cached_lot_response(request, ("lot", lot_id, selected), build)
+
+# Forecast occupancy for a lot from the trained table (see train_model.py --train), defaults to today's weekday
+@app.get("/lots/{lot_id}/forecast", response_model=forecast.LotForecast)
+async def get_lot_forecast(
+    lot_id: int,
+    weekday: Optional[int] = Query(None, ge=0, le=6, description="0 = Monday, defaults to today"),
+    hour: Optional[int] = Query(None, ge=0, le=23, description="Single opening hour, every hour if omitted"),
+):
+    lot = await ldb.fetch_lot_by_id_async(lot_id)
     if not lot:
-        return lh.LotSummary(
-            lot_id=lot_id,
-            lot_name='N/A',
-            total_capacity=0,
-            current=0,
-            percent_full=0,
-            state="N/A",
-            type="N/A",
-            hours="N/A"
-        )
-    return to_summary(lot)
+        raise HTTPException(status_code=404, detail="Lot not found")
+    try:
+        return forecast.predict(lot_id, lot.total_capacity, datetime.now().weekday() if weekday is None else weekday, hour)
+    except forecast.NoForecastDataError as exc:
+        raise HTTPException(status_code=404, detail=str(exc)) from exc
+    except forecast.ForecastUnavailableError as exc:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc)) from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+# Entries, exits and occupancy per minute or hour from the rollup tables, defaults to the last day (hour) or hour (minute)
+@app.get("/lots/{lot_id}/history", response_model=rollups.LotHistory)
+async def get_lot_history(
+    lot_id: int,
+    resolution: Literal["minute", "hour"] = Query("hour", description="minute|hour"),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+):
+    if not await ldb.fetch_lot_by_id_async(lot_id):
+        raise HTTPException(status_code=404, detail="Lot not found")
+    end = end or datetime.now().astimezone()
+    start = start or end - (timedelta(hours=1) if resolution == "minute" else timedelta(days=1))
+    try:
+        return await rollups.history_async(lot_id, resolution, start, end)
+    except rollups.RollupsUnavailableError as exc:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc)) from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
 
 # Get all lot fullness values
 # This function was created because calling all lots and parsing just their % full didn't work and individual calls were too slow.
 @app.get("/lots_percent_full", response_model=List[lh.LotPercentFull])
-async def get_lots_percent_full():
-    return ldb.fetch_lot_percent_full()
+async def get_lots_percent_full(request: Request):
+    return await cached_lot_response(request, ("lots_percent_full",), ldb.fetch_lot_percent_full_async)
 
 # Endpoint to randomize lot data for all or specific lot
-@app.post("/randomize_all_lot_events/{lot_num}/{all_lots}", status_code=status.HTTP_204_NO_CONTENT)
-async def randomize_all_lot_events(lot_num: int, all_lots: bool):
-    ldb.randomize_lot_data(lot_num, all_lots)
+# Returns the new state of the randomized lots so clients don't have to refetch, seed makes the reset reproducible
+@app.post("/randomize_all_lot_events/{lot_num}/{all_lots}", response_model=List[lh.LotSummary])
+async def randomize_all_lot_events(lot_num: int, all_lots: bool, seed: Optional[int] = Query(None, description="Seed for a reproducible reset")):
+    updated_lots = await ldb.randomize_lot_data_async(lot_num, all_lots, seed)
+    return [to_summary(lot) for lot in updated_lots]
+
+
+# Caller's user UUID from "Authorization: Bearer <access token>", verified locally (see auth_tokens)
+# Without a header the caller is None, which is only accepted while AUTH_REQUIRED is off
+async def caller_uuid(authorization: Optional[str] = Header(None)) -> Optional[UUID]:
+    if not authorization:
+        if auth_tokens.required():
+            raise HTTPException(status_code=401, detail="Missing access token", headers={"WWW-Authenticate": "Bearer"})
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Expected a Bearer token", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return await auth_tokens.verify(token.strip())
+    except auth_tokens.InvalidTokenError as exc:
+        raise HTTPException(status_code=401, detail=str(exc), headers={"WWW-Authenticate": "Bearer"}) from exc
 
+# Authenticated callers may only touch their own profile / vehicle pin
+def ensure_caller(caller: Optional[UUID], user_uuid: UUID):
+    if caller is not None and caller != user_uuid:
+        raise HTTPException(status_code=403, detail="Token does not belong to this user")
 
 @app.get("/profile/{user_uuid}", response_model=udb.UserProfile)
-async def get_user_profile(user_uuid: UUID):
-    return udb.fetch_user_profile(user_uuid)
+async def get_user_profile(user_uuid: UUID, caller: Optional[UUID] = Depends(caller_uuid)):
+    ensure_caller(caller, user_uuid)
+    return await udb.fetch_user_profile_async(user_uuid)
 
 
 @app.post("/profile", response_model=udb.UserProfile)
-async def upsert_user_profile(profile: udb.UserProfile):
-    return udb.upsert_user_profile(profile)
+async def upsert_user_profile(profile: udb.UserProfile, caller: Optional[UUID] = Depends(caller_uuid)):
+    ensure_caller(caller, profile.uuid)
+    return await udb.upsert_user_profile_async(profile)
 
 
 @app.post("/vehicle-pin", response_model=udb.VehiclePin)
-async def upsert_vehicle_pin(pin: udb.VehiclePin):
-    return udb.upsert_vehicle_pin(pin)
+async def upsert_vehicle_pin(pin: udb.VehiclePin, caller: Optional[UUID] = Depends(caller_uuid)):
+    ensure_caller(caller, pin.uuid)
+    return await udb.upsert_vehicle_pin_async(pin)
 
 
 @app.get("/vehicle-pin/{user_uuid}", response_model=udb.VehiclePin)
-async def get_vehicle_pin(user_uuid: UUID):
-    pin = udb.fetch_vehicle_pin(user_uuid)
+async def get_vehicle_pin(user_uuid: UUID, caller: Optional[UUID] = Depends(caller_uuid)):
+    ensure_caller(caller, user_uuid)
+    pin = await udb.fetch_vehicle_pin_async(user_uuid)
     if pin is None:
         raise HTTPException(status_code=404, detail="Vehicle pin not found")
     return pin
 
 
 @app.delete("/vehicle-pin/{user_uuid}", status_code=status.HTTP_204_NO_CONTENT)
-async def remove_vehicle_pin(user_uuid: UUID):
-    udb.delete_vehicle_pin(user_uuid)
+async def remove_vehicle_pin(user_uuid: UUID, caller: Optional[UUID] = Depends(caller_uuid)):
+    ensure_caller(caller, user_uuid)
+    await udb.delete_vehicle_pin_async(user_uuid)
 
 # Endpoint to randomize lot data by ID in case lot is not populated
 @app.post("/randomize_lot/{lot_id}", response_model=lh.LotSummary)
 async def randomize_lot(lot_id: int):
-    lot = ldb.fetch_lot_by_id(lot_id)
+    lot = await ldb.fetch_lot_by_id_async(lot_id)
 
     if not lot:
         raise HTTPException(status_code=404, detail="Lot not found")
 
     # Randomize lot data
-    ldb.randomize_lot_data(lot_id, False)
+    await ldb.randomize_lot_data_async(lot_id, False)
 
-    updated_lot = ldb.fetch_lot_by_id(lot_id)
+    updated_lot = await ldb.fetch_lot_by_id_async(lot_id)
     return to_summary(updated_lot)
 
 
+# Record a single gate event (buffered when EVENT_WRITE_BEHIND=1), 201 when accepted, 409 when it would push the lot out of bounds, 404 for an unknown lot
+@app.post("/vehicle_events", response_model=ddb.IngestResult, status_code=status.HTTP_201_CREATED)
+async def record_vehicle_event(vehicle: ddb.Vehicle):
+    result = await ddb.record_vehicle_entry_async(vehicle)
+    if result.status == "accepted":
+        return result
+    status_code = status.HTTP_404_NOT_FOUND if result.reason == "unknown_lot" else status.HTTP_409_CONFLICT
+    return JSONResponse(status_code=status_code, content=result.model_dump(mode="json"))
+
+
+# Largest batch accepted by /vehicle_events/bulk, bigger uploads should be split by the client
+BULK_MAX_EVENTS = int(os.getenv("BULK_MAX_EVENTS", "100000"))
+vehicle_list_adapter = TypeAdapter(List[ddb.Vehicle])
+
+def too_many_events():
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Batches are limited to {BULK_MAX_EVENTS} events.")
+
+# Parses a JSON array of Vehicle records, or NDJSON (one record per line) which is read as it streams in
+async def read_vehicle_batch(request: Request) -> List[ddb.Vehicle]:
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" not in content_type and "jsonl" not in content_type:
+        try:
+            vehicles = vehicle_list_adapter.validate_json(await request.body())
+        except ValidationError as exc:
+            raise HTTPException(status_code=422, detail=json.loads(exc.json(include_url=False))) from exc
+        if len(vehicles) > BULK_MAX_EVENTS:
+            raise too_many_events()
+        return vehicles
+
+    vehicles = []
+    pending = b""
+    line_number = 0
+
+    def parse_line(line: bytes):
+        if not line.strip():
+            return
+        try:
+            vehicles.append(ddb.Vehicle.model_validate_json(line))
+        except ValidationError as exc:
+            raise HTTPException(status_code=422, detail={"line": line_number, "errors": json.loads(exc.json(include_url=False))}) from exc
+        if len(vehicles) > BULK_MAX_EVENTS:
+            raise too_many_events()
+
+    async for chunk in request.stream():
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            line_number += 1
+            parse_line(line)
+    line_number += 1
+    parse_line(pending)
+    return vehicles
+
+# Bulk upload from gate controllers: JSON array or NDJSON (Content-Type: application/x-ndjson) of Vehicle records.
+# Records are applied in order, out-of-bounds ones are skipped and listed in "rejected" by their index
+@app.post("/vehicle_events/bulk", response_model=ddb.BulkIngestResult)
+async def record_vehicle_events(request: Request):
+    vehicles = await read_vehicle_batch(request)
+    return await ddb.insert_vehicle_entries_async(vehicles)
+
+
+# Streams parking_events (optionally one lot and/or [start, end)) as NDJSON or CSV in a chunked response
+@app.get("/vehicle_events/export")
+async def export_vehicle_events(
+    format: event_export.ExportFormat = Query("ndjson", description="ndjson|csv"),
+    lot_id: Optional[int] = Query(None),
+    start: Optional[datetime] = Query(None, description="Inclusive"),
+    end: Optional[datetime] = Query(None, description="Exclusive"),
+):
+    filename = f"parking_events.{format}"
+    export = await event_export.open_export_async(format, lot_id, start, end)
+    return StreamingResponse(
+        export,
+        media_type=event_export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        background=BackgroundTask(export.close),
+    )
+
+
+# Monte Carlo bands (percentiles per lot and time bucket) for capacity planning, runs on the shared process pool
+@app.post("/simulation/ensemble", response_model=ensemble.EnsembleResult)
+async def run_simulation_ensemble(request: ensemble.EnsembleRequest):
+    lots = await ldb.fetch_all_lots_async()
+    return await asyncio.to_thread(ensemble.run_ensemble, request, lots)
+
+
 @app.post("/simulate_vehicle_event", response_model=SimulatedVehicleEvent)
 async def simulate_vehicle_event(lot_id: Optional[int] = Query(None, description="Optional lot ID to simulate")):
     try:
-        vehicle = ddb.simulate_single_entry(-1 if lot_id is None else lot_id)
+        vehicle = await ddb.simulate_single_entry_async(-1 if lot_id is None else lot_id)
     except ValueError as exc:
         raise HTTPException(status_code=404, detail=str(exc)) from exc
 
     if vehicle is None:
         raise HTTPException(status_code=409, detail="Could not simulate vehicle event for the selected lot.")
 
-    updated_lot = ldb.fetch_lot_by_id(vehicle.lot_id)
+    updated_lot = await ldb.fetch_lot_by_id_async(vehicle.lot_id)
     if not updated_lot:
         raise HTTPException(status_code=404, detail="Lot not found")
 
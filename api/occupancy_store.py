@@ -0,0 +1,136 @@
+import argparse
+import os
+import struct
+from datetime import date, datetime
+import numpy as np
+
+'''
+Binary, memory-mapped store for the simulated occupancy dataset (alternative to simulated_parking_data.csv).
+
+Layout: a 64 byte header followed by fixed-size records, one per date in ascending order
+    header  magic (8s) | version (u4) | hours (u4) | lots (u4) | count (u8) | reserved
+    record  date as days since 1970-01-01 (i4) | occupancy float32[hours][lots]
+Records are fixed size, so the last date is one seek away, a date lookup is a binary search over the memory-mapped
+date column, and appending writes the new records at the end and then bumps the count in the header, with no rewrite.
+'''
+
+MAGIC = b"PPOCC\x00\x00\x01"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIQ")
+HEADER_SIZE = 64
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+class OccupancyStore:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            magic, version, hours, lots, count = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not an occupancy store (version {VERSION}).")
+        self.hours = hours
+        self.lots = lots
+        self.count = count
+        self.dtype = np.dtype([("date", "<i4"), ("values", "<f4", (hours, lots))])
+
+    @classmethod
+    def create(cls, path: str, hours: int, lots: int = 1) -> "OccupancyStore":
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, hours, lots, 0).ljust(HEADER_SIZE, b"\0"))
+        return cls(path)
+
+    def _write_count(self, file, count: int):
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, self.hours, self.lots, count))
+
+    # O(1): read just the date field of the last record
+    def last_date(self) -> date | None:
+        if self.count == 0:
+            return None
+        with open(self.path, "rb") as file:
+            file.seek(HEADER_SIZE + (self.count - 1) * self.dtype.itemsize)
+            days = struct.unpack("<i", file.read(4))[0]
+        return (EPOCH + np.timedelta64(days, "D")).astype(date)
+
+    # dates: datetime64[D] array, days: float array shaped (len(dates), hours, lots) or (len(dates), hours) for one lot
+    def append(self, dates: np.ndarray, days: np.ndarray):
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        days = np.asarray(days, dtype=np.float32)
+        if days.ndim == 2:
+            days = days[:, :, None]
+        if days.shape != (len(dates), self.hours, self.lots):
+            raise ValueError(f"Expected data shaped ({len(dates)}, {self.hours}, {self.lots}), got {days.shape}.")
+        if len(dates) == 0:
+            return
+        if np.any(np.diff(dates.astype(np.int64)) <= 0):
+            raise ValueError("Dates must be strictly increasing.")
+        last = self.last_date()
+        if last is not None and dates[0] <= np.datetime64(last, "D"):
+            raise ValueError(f"New dates must start after the last stored date {last}.")
+
+        records = np.empty(len(dates), dtype=self.dtype)
+        records["date"] = (dates - EPOCH).astype(np.int32)
+        records["values"] = days
+
+        with open(self.path, "r+b") as file:
+            file.seek(HEADER_SIZE + self.count * self.dtype.itemsize)
+            file.write(records.tobytes())
+            file.flush()
+            # Count goes last, a crash mid-append leaves the old records intact
+            self._write_count(file, self.count + len(dates))
+        self.count += len(dates)
+
+    def records(self) -> np.ndarray:
+        if self.count == 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode="r", offset=HEADER_SIZE, shape=(self.count,))
+
+    def dates(self) -> np.ndarray:
+        return EPOCH + self.records()["date"].astype("timedelta64[D]")
+
+    # (count, hours, lots) float32 view backed by the file
+    def values(self) -> np.ndarray:
+        return self.records()["values"]
+
+    def lookup(self, day: date | datetime | str) -> np.ndarray | None:
+        target = (np.datetime64(day, "D") - EPOCH).astype(np.int32)
+        stored = self.records()["date"]
+        index = int(np.searchsorted(stored, target))
+        if index >= self.count or stored[index] != target:
+            return None
+        return np.array(self.values()[index])
+
+
+# Converts simulated_parking_data.csv (date, 7AM, ...) or its multi-lot form (date, lot, 7AM, ...) into a store
+def convert_csv(csv_path: str, store_path: str) -> OccupancyStore:
+    import pandas as pd
+    frame = pd.read_csv(csv_path)
+    hours = [column for column in frame.columns if column not in ("date", "lot")]
+
+    if "lot" in frame.columns:
+        lots = sorted(frame["lot"].unique())
+        pivot = frame.set_index(["date", "lot"])[hours].unstack("lot").sort_index()
+        dates = pivot.index.to_numpy(dtype="datetime64[D]")
+        # columns are (hour, lot) pairs, reshape to (dates, hours, lots)
+        days = pivot.to_numpy(dtype=np.float32).reshape(len(dates), len(hours), len(lots))
+    else:
+        lots = [0]
+        frame = frame.sort_values("date")
+        dates = frame["date"].to_numpy(dtype="datetime64[D]")
+        days = frame[hours].to_numpy(dtype=np.float32)[:, :, None]
+
+    if os.path.exists(store_path):
+        os.remove(store_path)
+    store = OccupancyStore.create(store_path, hours=len(hours), lots=len(lots))
+    store.append(dates, days)
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert simulated_parking_data.csv to the binary occupancy store.")
+    parser.add_argument("csv_path")
+    parser.add_argument("store_path")
+    args = parser.parse_args()
+
+    converted = convert_csv(args.csv_path, args.store_path)
+    print(f"Wrote {converted.count} days x {converted.hours} hours x {converted.lots} lots to {args.store_path}")
@@ -0,0 +1,101 @@
+import asyncio
+import lot_helper as lh
+import lot_cache as lc
+
+'''
+Fan-out hub behind the /lots/stream (SSE) and /ws/lots (WebSocket) endpoints.
+lot_cache reports every occupancy change (local writes and LISTEN/NOTIFY from other workers) to the hub, which hands
+the new Lot to the subscribers interested in that lot_id. A subscriber only keeps the latest Lot per lot_id until its
+connection picks it up, so a slow client costs at most one entry per lot and never queues an unbounded backlog.
+Idle subscribers are just an object in a set, a process can hold tens of thousands of them.
+'''
+
+
+class Subscription:
+    __slots__ = ("lot_ids", "pending", "ready")
+
+    def __init__(self, lot_ids: frozenset[int] | None):
+        self.lot_ids = lot_ids          # None means every lot
+        self.pending: dict[int, lh.Lot] = {}
+        self.ready = asyncio.Event()
+
+    def _push(self, lot: lh.Lot):
+        self.pending[lot.lot_id] = lot
+        self.ready.set()
+
+    # Wait until at least one watched lot changed (or timeout) and return the latest state of each changed lot
+    async def next_changes(self, timeout: float | None = None) -> list[lh.Lot]:
+        if not self.pending:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        self.ready.clear()
+        changes = list(self.pending.values())
+        self.pending.clear()
+        return changes
+
+
+class OccupancyHub:
+    def __init__(self):
+        self._loop = None
+        self._all_lots: set[Subscription] = set()
+        self._by_lot: dict[int, set[Subscription]] = {}
+
+    # Bind the hub to the server's event loop and start receiving lot_cache changes
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        lc.add_change_listener(self._on_change)
+
+    def detach(self):
+        lc.remove_change_listener(self._on_change)
+        self._loop = None
+
+    def subscribe(self, lot_ids: set[int] | None = None) -> Subscription:
+        subscription = Subscription(frozenset(lot_ids) if lot_ids else None)
+        if subscription.lot_ids is None:
+            self._all_lots.add(subscription)
+        else:
+            for lot_id in subscription.lot_ids:
+                self._by_lot.setdefault(lot_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription.lot_ids is None:
+            self._all_lots.discard(subscription)
+            return
+        for lot_id in subscription.lot_ids:
+            watchers = self._by_lot.get(lot_id)
+            if watchers is not None:
+                watchers.discard(subscription)
+                if not watchers:
+                    del self._by_lot[lot_id]
+
+    def subscriber_count(self) -> int:
+        return len(self._all_lots) + len({s for watchers in self._by_lot.values() for s in watchers})
+
+    # Runs on whichever thread wrote the change, so hop onto the event loop before touching subscribers
+    def _on_change(self, lot: lh.Lot):
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._fan_out, lot)
+
+    def _fan_out(self, lot: lh.Lot):
+        for subscription in self._all_lots:
+            subscription._push(lot)
+        for subscription in self._by_lot.get(lot.lot_id, ()):
+            subscription._push(lot)
+
+
+hub = OccupancyHub()
+
+
+# Parses the lot_ids query parameter ("1,4,7"), empty means every lot
+def parse_lot_ids(lot_ids: str | None) -> set[int] | None:
+    if not lot_ids:
+        return None
+    try:
+        return {int(part) for part in lot_ids.split(",") if part.strip()}
+    except ValueError:
+        raise ValueError(f"lot_ids must be a comma separated list of integers, got {lot_ids!r}") from None
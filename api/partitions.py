@@ -0,0 +1,226 @@
+import argparse
+import os
+import re
+import threading
+from datetime import datetime, timezone
+from typing import Literal
+import psycopg2
+import lot_helper as lh
+import rollups
+from detection_database import EVENTS_TABLE
+
+'''
+Time partitioning for parking_events (range on dt, one partition per day or month).
+migrate() converts the existing table once; after that maintain() keeps PARTITION_PREMAKE partitions ready ahead of
+the current one and detaches (or drops) partitions that ended more than PARTITION_RETENTION intervals ago. A default
+partition catches events outside every range; their rows move into the right partition when it gets created.
+
+Inserts and COPY are routed to their partition by dt, export and the rollups filter on dt so Postgres only scans the
+partitions in range. Bounds are read and written in the type of the dt column: for timestamp without time zone they
+are UTC wall-clock values, whatever the session TimeZone is.
+'''
+
+PARTITION_INTERVAL: Literal["day", "month"] = os.getenv("PARTITION_INTERVAL", "month")
+PARTITION_PREMAKE = int(os.getenv("PARTITION_PREMAKE", "3"))            # intervals created ahead of the current one
+PARTITION_RETENTION = int(os.getenv("PARTITION_RETENTION", "0"))        # intervals kept, 0 keeps everything
+PARTITION_RETENTION_MODE = os.getenv("PARTITION_RETENTION_MODE", "detach")     # detach|drop
+MAINTENANCE_SECONDS = float(os.getenv("PARTITION_MAINTENANCE_SECONDS", "3600"))
+
+LEGACY_TABLE = f"{EVENTS_TABLE}_unpartitioned"
+DEFAULT_PARTITION = f"{EVENTS_TABLE}_default"
+BOUND_PATTERN = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def floor_interval(moment: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    moment = moment.astimezone(timezone.utc)
+    if interval == "month":
+        return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+    return datetime(moment.year, moment.month, moment.day, tzinfo=timezone.utc)
+
+def next_interval(start: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    if interval == "month":
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return datetime.fromordinal(start.toordinal() + 1).replace(tzinfo=timezone.utc)
+
+def shift_interval(start: datetime, count: int, interval: str = PARTITION_INTERVAL) -> datetime:
+    if interval == "month":
+        months = start.year * 12 + start.month - 1 + count
+        return start.replace(year=months // 12, month=months % 12 + 1)
+    return datetime.fromordinal(start.toordinal() + count).replace(tzinfo=timezone.utc)
+
+def partition_name(start: datetime) -> str:
+    return f"{EVENTS_TABLE}_p{start:%Y%m%d}"
+
+
+# True when dt is timestamp without time zone, its partition bounds are then naive UTC values
+def dt_is_naive(cursor) -> bool:
+    cursor.execute("SELECT atttypid = 'timestamp'::regtype FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'dt';",
+                   (EVENTS_TABLE,))
+    row = cursor.fetchone()
+    return row is not None and row[0]
+
+# A UTC bound as a value of the dt column's type
+def bound_value(moment: datetime, naive: bool) -> datetime:
+    return moment.astimezone(timezone.utc).replace(tzinfo=None) if naive else moment
+
+def parse_bound(value: str, naive: bool) -> datetime:
+    moment = datetime.fromisoformat(value)
+    return moment.replace(tzinfo=timezone.utc) if naive else moment.astimezone(timezone.utc)
+
+def is_partitioned(cursor) -> bool:
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (EVENTS_TABLE,))
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+# (name, start, end) of every range partition, oldest first
+def list_partitions(cursor) -> list[tuple[str, datetime, datetime]]:
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s);
+    """, (EVENTS_TABLE,))
+    rows = cursor.fetchall()
+    naive = dt_is_naive(cursor)
+    partitions = []
+    for name, bound in rows:
+        match = BOUND_PATTERN.search(bound)
+        if match:
+            start, end = (parse_bound(value, naive) for value in match.groups())
+            partitions.append((name, start, end))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+# Creates the partition for [start, next interval), pulling its rows out of the default partition first
+def create_partition(cursor, start: datetime, interval: str = PARTITION_INTERVAL) -> str:
+    name = partition_name(start)
+    naive = dt_is_naive(cursor)
+    bounds = (bound_value(start, naive), bound_value(next_interval(start, interval), naive))
+    cursor.execute(f"CREATE TEMP TABLE moved_events (LIKE {EVENTS_TABLE});")
+    cursor.execute(f"""
+        WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE dt >= %s AND dt < %s RETURNING *)
+        INSERT INTO moved_events SELECT * FROM moved;
+    """, bounds)
+    cursor.execute(f"CREATE TABLE {name} PARTITION OF {EVENTS_TABLE} FOR VALUES FROM (%s) TO (%s);", bounds)
+    cursor.execute(f"INSERT INTO {EVENTS_TABLE} OVERRIDING SYSTEM VALUE SELECT * FROM moved_events;")
+    cursor.execute("DROP TABLE moved_events;")
+    return name
+
+def ensure_partitions(cursor, now: datetime, ahead: int = PARTITION_PREMAKE, interval: str = PARTITION_INTERVAL) -> list[str]:
+    existing = {start for _, start, _ in list_partitions(cursor)}
+    created = []
+    start = floor_interval(now, interval)
+    for _ in range(ahead + 1):
+        if start not in existing:
+            created.append(create_partition(cursor, start, interval))
+        start = next_interval(start, interval)
+    return created
+
+# Detaches (or drops) partitions that ended before the retention window
+def apply_retention(cursor, now: datetime, retention: int = PARTITION_RETENTION, mode: str = PARTITION_RETENTION_MODE,
+                    interval: str = PARTITION_INTERVAL) -> list[str]:
+    if retention <= 0:
+        return []
+    cutoff = shift_interval(floor_interval(now, interval), -retention, interval)
+    expired = []
+    for name, _, end in list_partitions(cursor):
+        if end > cutoff:
+            break
+        cursor.execute(f"ALTER TABLE {EVENTS_TABLE} DETACH PARTITION {name};")
+        if mode == "drop":
+            cursor.execute(f"DROP TABLE {name};")
+        expired.append(name)
+    return expired
+
+def maintain(now: datetime | None = None) -> dict:
+    now = now or datetime.now(timezone.utc)
+    with lh.get_cursor(transaction=True) as cursor:
+        if not is_partitioned(cursor):
+            return {"partitioned": False, "created": [], "expired": []}
+        # One worker at a time, the others skip this round
+        cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s));", (f"{EVENTS_TABLE}_partitions",))
+        if not cursor.fetchone()[0]:
+            return {"partitioned": True, "created": [], "expired": []}
+        created = ensure_partitions(cursor, now)
+        expired = apply_retention(cursor, now)
+    return {"partitioned": True, "created": created, "expired": expired}
+
+
+# One-time conversion of the plain table: it is renamed to LEGACY_TABLE and its rows (event_id included) are copied
+# into a partitioned parking_events covering their time range plus the premade intervals
+def migrate(drop_legacy: bool = False, interval: str = PARTITION_INTERVAL) -> int:
+    rollups.ensure_schema()
+    with lh.get_cursor(transaction=True) as cursor:
+        if is_partitioned(cursor):
+            return 0
+        cursor.execute(f"LOCK TABLE {EVENTS_TABLE} IN ACCESS EXCLUSIVE MODE;")
+        cursor.execute(f"ALTER TABLE {EVENTS_TABLE} RENAME TO {LEGACY_TABLE};")
+        cursor.execute(f"ALTER INDEX IF EXISTS {EVENTS_TABLE}_event_id_idx RENAME TO {LEGACY_TABLE}_event_id_idx;")
+        cursor.execute(f"ALTER INDEX IF EXISTS {EVENTS_TABLE}_lot_id_dt_idx RENAME TO {LEGACY_TABLE}_lot_id_dt_idx;")
+        cursor.execute(f"""
+            CREATE TABLE {EVENTS_TABLE} (LIKE {LEGACY_TABLE} INCLUDING DEFAULTS INCLUDING IDENTITY) PARTITION BY RANGE (dt);
+            CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {EVENTS_TABLE} DEFAULT;
+            CREATE INDEX {EVENTS_TABLE}_event_id_idx ON {EVENTS_TABLE} (event_id);
+            CREATE INDEX {EVENTS_TABLE}_lot_id_dt_idx ON {EVENTS_TABLE} (lot_id, dt);
+        """)
+
+        cursor.execute(f"SELECT min(dt), max(dt) FROM {LEGACY_TABLE};")
+        first, last = (parse_bound(moment.isoformat(), dt_is_naive(cursor)) if moment else None for moment in cursor.fetchone())
+        now = datetime.now(timezone.utc)
+        start = floor_interval(min(first or now, now), interval)
+        end = shift_interval(floor_interval(max(last or now, now), interval), PARTITION_PREMAKE + 1, interval)
+        while start < end:
+            create_partition(cursor, start, interval)
+            start = next_interval(start, interval)
+
+        cursor.execute(f"""
+            INSERT INTO {EVENTS_TABLE} (dt, is_entering, lot_id, event_id) OVERRIDING SYSTEM VALUE
+            SELECT dt, is_entering, lot_id, event_id FROM {LEGACY_TABLE};
+        """)
+        copied = cursor.rowcount
+        cursor.execute(f"""
+            SELECT setval(pg_get_serial_sequence(%s, 'event_id'), GREATEST(max(event_id), 1), max(event_id) IS NOT NULL)
+            FROM {EVENTS_TABLE};
+        """, (EVENTS_TABLE,))
+        if drop_legacy:
+            cursor.execute(f"DROP TABLE {LEGACY_TABLE};")
+    return copied
+
+
+_thread = None
+_stop = threading.Event()
+
+def _run():
+    while not _stop.is_set():
+        try:
+            result = maintain()
+            if result["created"] or result["expired"]:
+                print(f"Partition maintenance created {result['created']} and expired {result['expired']}")
+        except (psycopg2.Error, OSError, RuntimeError) as exc:
+            print(f"Partition maintenance failed ({exc}), retrying next round")
+        _stop.wait(MAINTENANCE_SECONDS)
+
+
+def start():
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="event-partitions", daemon=True)
+    _thread.start()
+
+def stop(timeout: float = 5.0):
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+    _thread = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partition parking_events by time and apply retention.")
+    parser.add_argument("--migrate", action="store_true", help="Convert the plain parking_events table first")
+    parser.add_argument("--drop-legacy", action="store_true", help="Drop the old table after --migrate copies it")
+    args = parser.parse_args()
+
+    if args.migrate:
+        print(f"Copied {migrate(drop_legacy=args.drop_legacy)} events into the partitioned table")
+    print(maintain())
@@ -0,0 +1,108 @@
+import gzip
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:     # optional, falls back to the stdlib encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:     # optional, only gzip variants without it
+    brotli = None
+
+'''
+Pre-encoded JSON bodies for the hot lot read endpoints.
+Each body is keyed by endpoint + query parameters and tagged with the lot_cache ETag it was built from; the first
+request after a lot changes rebuilds it, every other request just looks up the bytes. gzip / brotli variants are
+compressed on first use and kept next to the plain body, bodies smaller than MIN_COMPRESS_BYTES are always sent as is.
+Only used from the event loop, so no locking.
+'''
+
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+MIN_COMPRESS_BYTES = 1024
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(",", ":")).encode()
+
+# Best encoding the client accepts (skipping q=0), None for the plain body
+def pick_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if quality > 0:
+            accepted.add(name.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+class CachedBody:
+    __slots__ = ("etag", "body", "headers", "variants")
+
+    def __init__(self, etag: str, body: bytes, headers: Optional[dict] = None):
+        self.etag = etag
+        self.body = body
+        self.headers = headers or {}
+        self.variants: dict[str, bytes] = {}
+
+    # (bytes, content-encoding) to send for the negotiated encoding
+    def encoded(self, encoding: Optional[str]) -> tuple[bytes, Optional[str]]:
+        if encoding is None or len(self.body) < MIN_COMPRESS_BYTES:
+            return self.body, None
+        variant = self.variants.get(encoding)
+        if variant is None:
+            variant = brotli.compress(self.body) if encoding == "br" else gzip.compress(self.body, compresslevel=6)
+            self.variants[encoding] = variant
+        return variant, encoding
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, CachedBody] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Body for key if it was built from the state tagged etag
+    def get(self, key: tuple, etag: str) -> Optional[CachedBody]:
+        entry = self._entries.get(key)
+        if entry is None or entry.etag != etag:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: tuple, etag: str, content: Any, headers: Optional[dict] = None) -> CachedBody:
+        entry = CachedBody(etag, dumps(content), headers)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "encodings": list(ENCODINGS)}
+
+
+lot_responses = ResponseCache()
@@ -0,0 +1,319 @@
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Literal
+import psycopg2
+from pydantic import BaseModel
+import lot_helper as lh
+import lot_cache as lc
+from detection_database import EVENTS_TABLE
+
+'''
+Per-lot time-bucket rollups of parking_events, so history queries never scan the events table.
+Every event gets an identity event_id; rollup_state keeps a high-water mark below which every event is committed and
+folded into the per-minute and per-hour tables. Each refresh finds the buckets touched by events past the mark and
+recounts those buckets from the events table, so folding an event twice changes nothing and late commits are picked up.
+
+occupancy is the running net change (entries - exits) of the lot at the end of the bucket. Only buckets from the
+earliest one touched by a batch onwards are recomputed: events arriving in time order touch the last bucket or two,
+a late event re-runs the tail of that lot. history() anchors the series to the lot's current count.
+
+The schema (event_id column + index, rollup tables) is only created by the explicit migration `python rollups.py --init`,
+adding an identity column rewrites parking_events under an ACCESS EXCLUSIVE lock. At startup the background thread
+only checks that it exists and switches itself off if it doesn't.
+
+Identity values are handed out at insert time but become visible at commit, so a long COPY, a retried buffer flush or
+a bulk upload can commit ids below ones that are already visible. The mark therefore only moves to a candidate
+recorded on an earlier pass (the newest visible event_id plus the snapshot xmax at that moment), once every
+transaction older than that snapshot has finished (pg_snapshot_xmin) and ROLLUP_LAG_SECONDS have passed. Until then
+the events past the mark are re-read on every pass.
+
+Passes only read events dated after the time the mark last moved minus ROLLUP_LATE_SECONDS, so on a partitioned
+table the planner skips every older partition. Events dated before that (backfills, devices with a stale clock) are
+folded by sweep(), which reads every id between its own swept_event_id and the mark regardless of dt and runs every
+ROLLUP_SWEEP_SECONDS.
+'''
+
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL_SECONDS", "5"))
+ROLLUP_BATCH = int(os.getenv("ROLLUP_BATCH", "100000"))     # events folded per transaction
+ROLLUP_LAG = float(os.getenv("ROLLUP_LAG_SECONDS", "2"))    # minimum age of a candidate mark before it is promoted
+ROLLUP_LATE = float(os.getenv("ROLLUP_LATE_SECONDS", "86400"))     # how far before the mark event dt may lag
+ROLLUP_SWEEP = float(os.getenv("ROLLUP_SWEEP_SECONDS", "3600"))   # how often events older than that are folded
+HISTORY_MAX_BUCKETS = 10000
+RECONNECT_MAX_SECONDS = 60.0
+
+STATE_NAME = EVENTS_TABLE
+RESOLUTIONS = {
+    "minute": "parking_event_rollups_minute",
+    "hour": "parking_event_rollups_hour",
+}
+STEPS = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1)}
+
+SCHEMA = f"""
+    ALTER TABLE {EVENTS_TABLE} ADD COLUMN IF NOT EXISTS event_id bigint GENERATED ALWAYS AS IDENTITY;
+    CREATE INDEX IF NOT EXISTS {EVENTS_TABLE}_event_id_idx ON {EVENTS_TABLE} (event_id);
+    CREATE INDEX IF NOT EXISTS {EVENTS_TABLE}_lot_id_dt_idx ON {EVENTS_TABLE} (lot_id, dt);
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        name          text PRIMARY KEY,
+        last_event_id bigint NOT NULL DEFAULT 0,
+        updated_at    timestamptz NOT NULL DEFAULT now()
+    );
+    ALTER TABLE rollup_state
+        ADD COLUMN IF NOT EXISTS candidate_event_id bigint,
+        ADD COLUMN IF NOT EXISTS candidate_xmax xid8,
+        ADD COLUMN IF NOT EXISTS candidate_at timestamptz,
+        ADD COLUMN IF NOT EXISTS swept_event_id bigint NOT NULL DEFAULT 0;
+    INSERT INTO rollup_state (name) VALUES ('{STATE_NAME}') ON CONFLICT (name) DO NOTHING;
+""" + "".join(f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        lot_id    integer NOT NULL,
+        bucket    timestamptz NOT NULL,
+        entries   integer NOT NULL DEFAULT 0,
+        exits     integer NOT NULL DEFAULT 0,
+        occupancy integer NOT NULL DEFAULT 0,
+        PRIMARY KEY (lot_id, bucket)
+    );
+""" for table in RESOLUTIONS.values())
+
+# Recounts every bucket holding an event of the batch, returns the earliest bucket per lot whose counts changed
+UPSERT_QUERY = """
+    WITH touched AS (
+        SELECT DISTINCT lot_id, date_trunc(%(unit)s, dt) AS bucket
+        FROM {events}
+        WHERE event_id > %(after)s AND event_id <= %(upto)s AND dt >= %(since)s::timestamptz
+    ), counted AS (
+        SELECT t.lot_id, t.bucket,
+               count(*) FILTER (WHERE e.is_entering) AS entries,
+               count(*) FILTER (WHERE NOT e.is_entering) AS exits
+        FROM touched t
+        JOIN {events} e ON e.lot_id = t.lot_id AND e.dt >= t.bucket AND e.dt < t.bucket + %(step)s
+            AND e.dt >= date_trunc(%(unit)s, %(since)s::timestamptz)
+        GROUP BY 1, 2
+    ), upserted AS (
+        INSERT INTO {table} AS r (lot_id, bucket, entries, exits)
+        SELECT lot_id, bucket, entries, exits FROM counted
+        ON CONFLICT (lot_id, bucket) DO UPDATE
+        SET entries = EXCLUDED.entries, exits = EXCLUDED.exits
+        WHERE (r.entries, r.exits) IS DISTINCT FROM (EXCLUDED.entries, EXCLUDED.exits)
+        RETURNING r.lot_id, r.bucket
+    )
+    SELECT lot_id, min(bucket) FROM upserted GROUP BY lot_id;
+"""
+
+# Re-runs the occupancy running sum from each lot's earliest touched bucket, seeded by the bucket before it
+RECOMPUTE_QUERY = """
+    WITH touched AS (
+        SELECT t.lot_id, t.since,
+               COALESCE((SELECT p.occupancy FROM {table} p
+                         WHERE p.lot_id = t.lot_id AND p.bucket < t.since
+                         ORDER BY p.bucket DESC LIMIT 1), 0) AS base
+        FROM unnest(%(lot_ids)s::int[], %(since)s::timestamptz[]) AS t(lot_id, since)
+    ), running AS (
+        SELECT r.lot_id, r.bucket,
+               t.base + SUM(r.entries - r.exits) OVER (PARTITION BY r.lot_id ORDER BY r.bucket) AS occupancy
+        FROM touched t
+        JOIN {table} r ON r.lot_id = t.lot_id AND r.bucket >= t.since
+    )
+    UPDATE {table} r SET occupancy = running.occupancy
+    FROM running
+    WHERE r.lot_id = running.lot_id AND r.bucket = running.bucket AND r.occupancy <> running.occupancy;
+"""
+
+
+class RollupsUnavailableError(RuntimeError):
+    pass
+
+
+class HistoryBucket(BaseModel):
+    bucket: datetime
+    entries: int
+    exits: int
+    occupancy: int
+
+class LotHistory(BaseModel):
+    lot_id: int
+    resolution: Literal["minute", "hour"]
+    start: datetime
+    end: datetime
+    buckets: list[HistoryBucket]
+
+
+# Migration entry point (rollups.py --init, partitions.py --migrate), never run by the API workers
+def ensure_schema():
+    with lh.get_cursor(transaction=True) as cursor:
+        cursor.execute(SCHEMA)
+
+def schema_ready() -> bool:
+    with lh.get_cursor() as cursor:
+        cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'event_id')
+               AND to_regclass('rollup_state') IS NOT NULL
+               AND to_regclass(%s) IS NOT NULL AND to_regclass(%s) IS NOT NULL;
+        """, (EVENTS_TABLE, *RESOLUTIONS.values()))
+        if not cursor.fetchone()[0]:
+            return False
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM rollup_state WHERE name = %s);", (STATE_NAME,))
+        return cursor.fetchone()[0]
+
+def latest_event_id() -> int:
+    with lh.get_cursor() as cursor:
+        cursor.execute(f"SELECT COALESCE(max(event_id), 0) FROM {EVENTS_TABLE};")
+        return cursor.fetchone()[0]
+
+# since is a literal lower bound on dt, so partitions before it are pruned at plan time
+def _fold_batch(cursor, after: int, upto: int, since: datetime | str = "-infinity"):
+    for unit, table in RESOLUTIONS.items():
+        cursor.execute(UPSERT_QUERY.format(events=EVENTS_TABLE, table=table),
+                       {"unit": unit, "step": STEPS[unit], "after": after, "upto": upto, "since": since})
+        touched = cursor.fetchall()
+        if touched:
+            cursor.execute(RECOMPUTE_QUERY.format(table=table), {
+                "lot_ids": [lot_id for lot_id, _ in touched],
+                "since": [since for _, since in touched],
+            })
+
+# Folds the events past the high-water mark into the rollups (at most ROLLUP_BATCH ids per transaction), promotes the
+# candidate mark once it is safe and records the next one. Returns the high-water mark.
+def refresh(lag: float = ROLLUP_LAG) -> int:
+    while True:
+        with lh.get_cursor(transaction=True) as cursor:
+            # The row lock keeps workers from folding the same events at the same time
+            cursor.execute("""
+                SELECT last_event_id, candidate_event_id,
+                       candidate_xmax IS NOT NULL AND pg_snapshot_xmin(pg_current_snapshot()) >= candidate_xmax
+                           AND now() - candidate_at >= make_interval(secs => %s),
+                       updated_at - make_interval(secs => %s)
+                FROM rollup_state WHERE name = %s FOR UPDATE;
+            """, (lag, ROLLUP_LATE, STATE_NAME))
+            mark, candidate, promote, since = cursor.fetchone()
+            # Read after the check above, so every id up to a promotable candidate is visible to the fold
+            cursor.execute(f"SELECT max(event_id), pg_snapshot_xmax(pg_current_snapshot()) FROM {EVENTS_TABLE} WHERE event_id > %s;", (mark,))
+            newest, xmax = cursor.fetchone()
+            if newest is None:
+                return mark
+            upto = min(newest, mark + ROLLUP_BATCH)
+            _fold_batch(cursor, mark, upto, since)
+
+            promoted = min(candidate, upto) if promote else mark
+            cursor.execute("""
+                UPDATE rollup_state
+                SET last_event_id = %(promoted)s,
+                    updated_at = CASE WHEN %(promoted)s > last_event_id THEN now() ELSE updated_at END,
+                    candidate_event_id = %(upto)s, candidate_xmax = %(xmax)s, candidate_at = now()
+                WHERE name = %(name)s;
+            """, {"promoted": promoted, "upto": upto, "xmax": xmax, "name": STATE_NAME})
+        if promoted == mark or promoted >= newest:
+            return promoted
+
+# Folds every event up to the mark that refresh() may have skipped for being dated too far back, returns how far it got
+def sweep() -> int:
+    while True:
+        with lh.get_cursor(transaction=True) as cursor:
+            cursor.execute("SELECT last_event_id, swept_event_id FROM rollup_state WHERE name = %s FOR UPDATE;", (STATE_NAME,))
+            mark, swept = cursor.fetchone()
+            if swept >= mark:
+                return swept
+            upto = min(mark, swept + ROLLUP_BATCH)
+            _fold_batch(cursor, swept, upto)
+            cursor.execute("UPDATE rollup_state SET swept_event_id = %s WHERE name = %s;", (upto, STATE_NAME))
+        if upto >= mark:
+            return upto
+
+
+def history(lot_id: int, resolution: str, start: datetime, end: datetime) -> LotHistory:
+    table = RESOLUTIONS[resolution]
+    step = timedelta(minutes=1) if resolution == "minute" else timedelta(hours=1)
+    if end <= start:
+        raise ValueError("end must be after start")
+    if (end - start) / step > HISTORY_MAX_BUCKETS:
+        raise ValueError(f"At most {HISTORY_MAX_BUCKETS} {resolution} buckets per request, narrow the range or use a coarser resolution")
+
+    try:
+        with lh.get_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT bucket, entries, exits, occupancy FROM {table}
+                WHERE lot_id = %s AND bucket >= %s AND bucket < %s
+                ORDER BY bucket;
+            """, (lot_id, start, end))
+            rows = cursor.fetchall()
+            cursor.execute(f"SELECT occupancy FROM {table} WHERE lot_id = %s ORDER BY bucket DESC LIMIT 1;", (lot_id,))
+            latest = cursor.fetchone()
+    except psycopg2.errors.UndefinedTable as exc:
+        raise RollupsUnavailableError("Event rollups are not set up, run `python rollups.py --init`") from exc
+
+    # Shift the running net change so the newest bucket lines up with the lot's current count
+    lot = lc.get_lot(lot_id)
+    offset = lot.current - latest[0] if lot is not None and latest is not None else 0
+    capacity = lot.total_capacity if lot is not None else None
+    buckets = [
+        HistoryBucket(
+            bucket=bucket,
+            entries=entries,
+            exits=exits,
+            occupancy=max(0, min(capacity, occupancy + offset)) if capacity is not None else occupancy + offset,
+        )
+        for bucket, entries, exits, occupancy in rows
+    ]
+    return LotHistory(lot_id=lot_id, resolution=resolution, start=start, end=end, buckets=buckets)
+
+# Awaitable version for the async endpoint
+history_async = lh.awaitable(history)
+
+
+_thread = None
+_stop = threading.Event()
+
+def _run():
+    backoff = 1.0
+    checked = False
+    next_sweep = time.monotonic()
+    while not _stop.is_set():
+        try:
+            if not checked and not schema_ready():
+                print("Event rollups are not set up (run `python rollups.py --init`), rollups are off")
+                return
+            checked = True
+            refresh()
+            if time.monotonic() >= next_sweep:
+                sweep()
+                next_sweep = time.monotonic() + ROLLUP_SWEEP
+            backoff = 1.0
+            _stop.wait(ROLLUP_INTERVAL)
+        except (psycopg2.Error, OSError, RuntimeError) as exc:
+            print(f"Event rollup failed ({exc}), retrying in {backoff:.0f}s")
+            _stop.wait(backoff)
+            backoff = min(backoff * 2, RECONNECT_MAX_SECONDS)
+
+
+def start():
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="event-rollups", daemon=True)
+    _thread.start()
+
+def stop(timeout: float = 5.0):
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+    _thread = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create and catch up the parking_events rollups.")
+    parser.add_argument("--init", action="store_true", help="Create the rollup tables and the event_id column first")
+    args = parser.parse_args()
+
+    if args.init:
+        ensure_schema()
+    started = datetime.now(timezone.utc)
+    # Catching up promotes one batch per pass, each once the transactions older than it have finished
+    while (mark := refresh()) < latest_event_id():
+        time.sleep(ROLLUP_LAG)
+    sweep()
+    print(f"Rolled up to event_id {mark} in {(datetime.now(timezone.utc) - started).total_seconds():.2f}s")
@@ -0,0 +1,130 @@
+import argparse
+import math
+import random
+from datetime import datetime, timedelta
+import numpy as np
+import lot_helper as lh
+import lot_cache as lc
+import detection_database as ddb
+
+'''
+In-memory version of the detection_database DES.
+Lot state is loaded once, then the _progress_time / _randomizeIsEntering model runs entirely in memory: occupancy
+evolves as simulated cars come and go, inter-arrival times are drawn SKEW_BATCH at a time as NumPy arrays from a
+seeded Generator, and nothing touches the database until persist() writes every event in one bulk COPY.
+'''
+
+SKEW_BATCH = 4096       # inter-arrival samples drawn per refill
+# The uniform / lognormal mixture of ddb._sample_skew, in minutes
+SKEW_UNIFORM = (1.0, 5.0)
+SKEW_LOG_MU, SKEW_LOG_SIGMA = math.log(50), 0.25
+SKEW_CLIP = (5.0, 80.0)
+
+
+class SimulationEngine:
+    def __init__(self, lots: list[lh.Lot], seed: int | None = None, tails: float = 0.05):
+        self.rng = random.Random(seed)
+        self.generator = np.random.default_rng(seed)
+        self.tails = tails
+        self.current = {lot.lot_id: lot.current for lot in lots}
+        self.capacity = {lot.lot_id: lot.total_capacity for lot in lots}
+        self.initial = dict(self.current)
+        self._skews = []
+
+        for lot in lots:
+            if lot.total_capacity <= 0:
+                raise ValueError(f"Lot {lot.lot_id} has no capacity.")
+
+    @classmethod
+    def from_db(cls, seed: int | None = None, tails: float = 0.05) -> "SimulationEngine":
+        return cls(lc.get_all_lots(), seed=seed, tails=tails)
+
+    # SKEW_BATCH draws of the mixture in a few vectorized calls: uniform with probability 1 - tails, else clipped lognormal
+    def _draw_skews(self, count: int = SKEW_BATCH) -> np.ndarray:
+        generator = self.generator
+        heads = generator.random(count) >= self.tails
+        uniform = generator.uniform(*SKEW_UNIFORM, count)
+        lognormal = np.clip(np.exp(SKEW_LOG_MU + SKEW_LOG_SIGMA * generator.standard_normal(count)), *SKEW_CLIP)
+        return np.where(heads, uniform, lognormal)
+
+    # Minutes until the next event, popped from the last batch (a plain list, cheaper to pop than an array)
+    def _next_skew(self) -> float:
+        if not self._skews:
+            self._skews = self._draw_skews().tolist()
+        return self._skews.pop()
+
+    def _select_lot_id(self, input_lot: int) -> int:
+        if input_lot >= 0:
+            if input_lot not in self.current:
+                raise ValueError(f"Lot {input_lot} does not exist.")
+            return input_lot
+        return self.rng.choice(list(self.current))
+
+    # One simulated car at dt, updates the in-memory occupancy
+    def step(self, lot_id: int, dt: datetime) -> ddb.Vehicle:
+        is_entering = ddb._is_entering_for(self.current[lot_id], self.capacity[lot_id], self.rng)
+        self.current[lot_id] += 1 if is_entering else -1
+        # Values come straight from the model, skip pydantic validation in the hot loop
+        return ddb.Vehicle.model_construct(dt=dt, is_entering=is_entering, lot_id=lot_id)
+
+    # Same contract as ddb.simulate: either a number of days (time advances per event) or a number of iterations
+    def run(self, days: int = 0, itterations: int = 0, input_lot: int = -1, start: datetime | None = None) -> list[ddb.Vehicle]:
+        if (days >= 1 and itterations >= 1) or days < 0 or itterations < 0 or (days == 0 and itterations == 0):
+            raise ValueError("Please only specify either days or itterations, not both (or neither).")
+
+        dt = start or datetime.now()
+        vehicles = []
+        if itterations:
+            for _ in range(itterations):
+                vehicles.append(self.step(self._select_lot_id(input_lot), dt))
+            return vehicles
+
+        end_dt = dt + timedelta(days=days)
+        while dt < end_dt:
+            vehicles.append(self.step(self._select_lot_id(input_lot), dt))
+            dt = ddb._advance_time(dt, self._next_skew())
+        return vehicles
+
+    # Every lot on its own timeline over the same window, merged in time order
+    def run_all_lots(self, days: int, start: datetime | None = None) -> list[ddb.Vehicle]:
+        start = start or datetime.now()
+        vehicles = []
+        for lot_id in self.current:
+            vehicles.extend(self.run(days=days, input_lot=lot_id, start=start))
+        vehicles.sort(key=lambda vehicle: vehicle.dt)
+        return vehicles
+
+    # Writes the events with one COPY and moves each lot by its net simulated change, in one transaction
+    def persist(self, vehicles: list[ddb.Vehicle]) -> int:
+        deltas = {lot_id: self.current[lot_id] - self.initial[lot_id] for lot_id in self.current}
+        with lh.get_cursor(transaction=True) as cursor:
+            ddb._copy_events(cursor, [v.model_copy(update={"dt": v.dt.replace(microsecond=0)}) for v in vehicles])
+            updated = ddb._apply_lot_deltas(cursor, deltas, clamp=True)
+
+        for lot_id, current, total_capacity in updated:
+            lc.set_occupancy(lot_id, current, total_capacity)
+        self.initial = dict(self.current)
+        return len(vehicles)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the parking DES in memory.")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--lot", type=int, default=-1, help="Only simulate this lot_id (default: every lot)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--tails", type=float, default=0.05)
+    parser.add_argument("--persist", action="store_true", help="Write the events and final counts to the db")
+    args = parser.parse_args()
+
+    engine = SimulationEngine.from_db(seed=args.seed, tails=args.tails)
+    started = datetime.now()
+    if args.lot >= 0:
+        events = engine.run(days=args.days, input_lot=args.lot)
+    else:
+        events = engine.run_all_lots(args.days)
+    elapsed = (datetime.now() - started).total_seconds()
+    print(f"Simulated {len(events)} events over {args.days} days in {elapsed:.2f}s")
+
+    if args.persist:
+        engine.persist(events)
+        print(f"Persisted {len(events)} events")
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import random
+from typing import Any, Optional
+import httpx
+
+try:
+    import h2     # noqa: F401, only needed so httpx can negotiate HTTP/2
+    HTTP2 = os.getenv("SUPABASE_HTTP2", "1") != "0"
+except ImportError:
+    HTTP2 = False
+
+'''
+One application-lifetime HTTP client for the Supabase auth proxy (/auth/login, /auth/register) and key set fetches.
+Connections are kept alive (HTTP/2 when h2 is installed) so a login doesn't pay a fresh TCP + TLS handshake.
+Every call has connect / read timeouts, at most SUPABASE_MAX_CONCURRENCY calls are in flight per worker, and callers
+that can't get a slot within SUPABASE_QUEUE_TIMEOUT seconds are turned away instead of piling up.
+Failures where the request never reached Supabase (connect errors / timeouts) are retried for any call, read timeouts
+and 502/503/504 answers only for idempotent ones, with full jitter backoff. stats() shows how it is being used.
+'''
+
+CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.getenv("SUPABASE_READ_TIMEOUT", "10"))
+MAX_CONCURRENCY = int(os.getenv("SUPABASE_MAX_CONCURRENCY", "32"))
+QUEUE_TIMEOUT = float(os.getenv("SUPABASE_QUEUE_TIMEOUT", "2"))
+RETRIES = int(os.getenv("SUPABASE_RETRIES", "2"))
+BACKOFF_BASE = 0.1          # seconds, doubled per attempt before jitter
+BACKOFF_MAX = 2.0
+RETRY_STATUSES = {502, 503, 504}
+
+
+class UpstreamError(RuntimeError):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+_client: Optional[httpx.AsyncClient] = None
+_slots: Optional[asyncio.Semaphore] = None
+_stats = {"requests": 0, "retries": 0, "timeouts": 0, "rejected": 0, "in_flight": 0}
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=HTTP2,
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=QUEUE_TIMEOUT),
+        limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY),
+    )
+
+# Opens the shared client, called from the app lifespan (get_client() opens it lazily otherwise)
+def start():
+    global _client, _slots
+    if _client is None:
+        _client = _new_client()
+        _slots = asyncio.Semaphore(MAX_CONCURRENCY)
+
+async def stop():
+    global _client, _slots
+    client, _client, _slots = _client, None, None
+    if client is not None:
+        await client.aclose()
+
+def get_client() -> httpx.AsyncClient:
+    start()
+    return _client
+
+def stats() -> dict:
+    return dict(_stats, http2=HTTP2, max_concurrency=MAX_CONCURRENCY)
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def auth_url(path: str) -> str:
+    return f"{os.getenv('EXPO_PUBLIC_SUPABASE_URL')}/auth/v1/{path}"
+
+def auth_headers() -> dict:
+    anon_key = os.getenv("EXPO_PUBLIC_SUPABASE_ANON_KEY")
+    return {"apikey": anon_key, "Authorization": f"Bearer {anon_key}", "Content-Type": "application/json"}
+
+
+async def request(method: str, url: str, json: Any = None, headers: Optional[dict] = None,
+                  idempotent: bool = False) -> httpx.Response:
+    client, slots = get_client(), _slots
+    try:
+        await asyncio.wait_for(slots.acquire(), QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        _stats["rejected"] += 1
+        raise UpstreamError(503, "Too many auth requests in flight, try again shortly") from None
+
+    _stats["in_flight"] += 1
+    try:
+        for attempt in range(RETRIES + 1):
+            last = attempt == RETRIES
+            _stats["requests"] += 1
+            try:
+                response = await client.request(method, url, json=json, headers=headers)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as exc:
+                # Never reached Supabase, safe to send again whatever the call does
+                if last:
+                    raise UpstreamError(502, f"Auth service unreachable: {exc!r}") from exc
+            except httpx.TimeoutException as exc:
+                _stats["timeouts"] += 1
+                if last or not idempotent:
+                    raise UpstreamError(504, "Auth service timed out") from exc
+            except httpx.TransportError as exc:
+                if last or not idempotent:
+                    raise UpstreamError(502, f"Auth service connection failed: {exc!r}") from exc
+            else:
+                if response.status_code not in RETRY_STATUSES or last or not idempotent:
+                    return response
+            _stats["retries"] += 1
+            await asyncio.sleep(_backoff(attempt))
+    finally:
+        _stats["in_flight"] -= 1
+        slots.release()
+
+async def post(url: str, json: Any, headers: Optional[dict] = None, idempotent: bool = False) -> httpx.Response:
+    return await request("POST", url, json, headers, idempotent)
+
+async def get(url: str, headers: Optional[dict] = None) -> httpx.Response:
+    return await request("GET", url, headers=headers, idempotent=True)
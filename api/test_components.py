@@ -1,12 +1,67 @@
 # pytest -q
+import asyncio
+import threading
+import time
 import pytest
+from fastapi.testclient import TestClient
 import lot_helper as lh
 import lot_database as ldb
 import datetime
+import json
+import os
+import zoneinfo
 import detection_database as ddb
+import db_pool
+import lot_cache as lc
+import lot_index
+import lot_search
+import lot_listener
+import event_buffer
+import simulation
+import ensemble
+import forecast
+import rollups
+import event_export
+import partitions
+import response_cache
+import supabase_client
+import auth_tokens
 import main
 
 
+# Throwaway schema with a copy of lots and a plain (unpartitioned) parking_events. Every connection made during the
+# test has it first on its search_path, so migrations and raw DELETE / UPDATE statements never touch the shared data
+def with_search_path(database_url: str, schema: str) -> str:
+    if "://" in database_url:
+        return f"{database_url}{'&' if '?' in database_url else '?'}options=-csearch_path%3D{schema}"
+    return f"{database_url} options='-csearch_path={schema}'"
+
+def reconnect():
+    db_pool.close_pool()
+    lc.invalidate()
+
+@pytest.fixture
+def scratch_db(monkeypatch):
+    schema = f"scratch_{os.getpid()}_{time.monotonic_ns()}"
+    with lh.get_cursor(transaction=True) as cursor:
+        cursor.execute(f"""
+            CREATE SCHEMA {schema};
+            CREATE TABLE {schema}.lots (LIKE public.lots INCLUDING ALL);
+            INSERT INTO {schema}.lots SELECT * FROM public.lots;
+            CREATE TABLE {schema}.parking_events (dt timestamptz NOT NULL, is_entering boolean NOT NULL, lot_id integer NOT NULL);
+        """)
+    shared_url = os.environ["DATABASE_URL"]
+    monkeypatch.setenv("DATABASE_URL", with_search_path(shared_url, schema))
+    reconnect()
+    try:
+        yield schema
+    finally:
+        monkeypatch.setenv("DATABASE_URL", shared_url)
+        reconnect()
+        with lh.get_cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA {schema} CASCADE;")
+
+
 
 # Lot Database Tests (lot_database)
 def test_fetch_all_lots_returns_list():
@@ -23,6 +78,44 @@ def test_fetch_lot_by_id():
         assert lot is not None, f"fetch_lot_by_id({lot_id}) returned None"
 
 
+def test_lot_cache_writes_through():
+    lot = ldb.fetch_lot_by_id(0)
+    updated = lh.update_lots_current(lot.current < lot.total_capacity, 0)
+    assert updated == lh.get_lot_current_and__total_capacity(0), "The new (current, total_capacity) is returned"
+    assert lh.update_lots_current(True, -5) is None, "Nothing to update for an unknown lot"
+
+    cached = ldb.fetch_lot_by_id(0)
+    assert cached.current != lot.current, "update_lots_current should update the cached lot without mutating old copies"
+    assert cached.current == lh.get_lot_current_and__total_capacity(0)[0], "Cache should match the db after a write"
+
+
+def test_lot_listener_applies_notifications(scratch_db):
+    lc.get_all_lots()
+    lot_listener.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not lc.is_live() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # Simulate another worker writing lot 1 on its own connection
+        lot = lh.get_lot_current_and__total_capacity(1)
+        new_current = 0 if lot[0] > 0 else 1
+        connection = lh.establish_connection()
+        cursor = connection.cursor()
+        cursor.execute("UPDATE lots SET current = %s WHERE lot_id = 1;", (new_current,))
+        lh.notify_lot_change(cursor, 1, new_current, lot[1])
+        connection.commit()
+        cursor.close()
+        connection.close()
+
+        while ldb.fetch_lot_by_id(1).current != new_current and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert ldb.fetch_lot_by_id(1).current == new_current, "Listener should apply NOTIFY payloads to the cache"
+    finally:
+        lot_listener.stop()
+    assert not lc.is_live()
+
+
 def test_randomize_lot_data_runs_without_error():
     lots_dict = lh.lot_dict()
     for lot_id in range(len(lots_dict)):
@@ -32,6 +125,16 @@ def test_randomize_lot_data_runs_without_error():
     assert isinstance(lots, list)
     assert len(lots) >= 0
 
+def test_randomize_all_lots_is_set_based_and_seedable():
+    first = ldb.randomize_lot_data(all_lots=True, seed=42)
+    second = ldb.randomize_lot_data(all_lots=True, seed=42)
+    assert [lot.lot_id for lot in first] == sorted(lh.lot_dict().keys())
+    assert [(l.total_capacity, l.current) for l in first] == [(l.total_capacity, l.current) for l in second]
+    for lot in first:
+        assert 50 <= lot.total_capacity < 550 and 0 <= lot.current < lot.total_capacity
+        assert ldb.fetch_lot_by_id(lot.lot_id).current == lot.current, "Randomized values should be written to the cache"
+
+
 def test_simulate_single_entry():
     v = ddb.simulate_single_entry()
     assert v is not None, "simulate_single_entry() should return a Vehicle"
@@ -45,6 +148,554 @@ def test_simulate_multiple_entries():
         assert isinstance(v, ddb.Vehicle), "simulate() should return a list of Vehicle instances"
 
 
+# Connection Pool Tests (db_pool)
+def test_pool_reuses_connections():
+    pool = db_pool.ConnectionPool(os.getenv("DATABASE_URL"), min_size=1, max_size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second, "Released connections should be handed out again"
+    assert pool.stats()["connections_created"] == 1
+    pool.closeall()
+
+
+def test_pool_acquire_timeout():
+    pool = db_pool.ConnectionPool(os.getenv("DATABASE_URL"), min_size=0, max_size=1, acquire_timeout=0.05)
+    with pool.connection():
+        with pytest.raises(db_pool.PoolTimeoutError):
+            pool.getconn()
+    assert pool.stats()["timeouts"] == 1
+    pool.closeall()
+
+
+def test_db_executor_sheds_load(monkeypatch):
+    monkeypatch.setenv("DB_EXECUTOR_MAX_PENDING", "1")
+
+    async def scenario():
+        slow_call = asyncio.create_task(db_pool.run_in_executor(time.sleep, 0.2))
+        await asyncio.sleep(0.05)
+        with pytest.raises(db_pool.DatabaseBusyError):
+            await db_pool.run_in_executor(time.sleep, 0)
+        await slow_call
+
+    asyncio.run(scenario())
+    assert db_pool.executor_stats()["pending"] == 0
+
+
+def test_auth_proxy_reuses_one_client_and_bounds_failures(monkeypatch):
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    seen = {"token": 0, "signup": 0, "ports": set()}
+
+    class StubSupabase(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            seen["ports"].add(self.client_address[1])
+            if self.path.startswith("/slow"):
+                time.sleep(0.3)
+            route = "token" if "/token" in self.path else "signup"
+            seen[route] += 1
+            # The first login attempt and every signup hit a flaky upstream
+            failing = route == "signup" or seen["token"] == 1
+            body = json.dumps({"msg": "unavailable"} if failing else {"access_token": "stub"}).encode()
+            self.send_response(503 if failing else 200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSupabase)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("EXPO_PUBLIC_SUPABASE_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setenv("EXPO_PUBLIC_SUPABASE_ANON_KEY", "anon")
+    monkeypatch.setattr(supabase_client, "BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(supabase_client, "READ_TIMEOUT", 0.1)
+    credentials = {"email": "driver@example.com", "password": "secret"}
+    try:
+        with TestClient(main.app) as client:
+            # Login is retried past the 503, over the same kept-alive connection
+            response = client.post("/auth/login", json=credentials)
+            assert response.status_code == 200 and response.json() == {"access_token": "stub"}
+            assert client.post("/auth/login", json=credentials).status_code == 200
+            assert seen["token"] == 3 and len(seen["ports"]) == 1
+
+            # Signups are not idempotent, the upstream error is passed through after one attempt
+            assert client.post("/auth/register", json=credentials).status_code == 503
+            assert seen["signup"] == 1
+
+            monkeypatch.setenv("EXPO_PUBLIC_SUPABASE_URL", f"http://127.0.0.1:{server.server_port}/slow")
+            assert client.post("/auth/login", json=credentials).status_code == 504
+            assert client.get("/auth/client_stats").json()["timeouts"] == supabase_client.RETRIES + 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def b64url(data: bytes) -> str:
+    import base64
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def make_token(alg: str, kid: str, sign, sub: str, exp_in: int = 3600) -> str:
+    header = b64url(json.dumps({"alg": alg, "typ": "JWT", "kid": kid}).encode())
+    claims = b64url(json.dumps({"sub": sub, "aud": "authenticated", "exp": int(time.time()) + exp_in}).encode())
+    return f"{header}.{claims}.{b64url(sign(f'{header}.{claims}'.encode()))}"
+
+# Serves {"keys": jwks} at the Supabase JWKS path, recording every fetch
+def serve_jwks(jwks: list, fetches: list):
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StubJwks(BaseHTTPRequestHandler):
+        def do_GET(self):
+            fetches.append(self.path)
+            body = json.dumps({"keys": jwks}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubJwks)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def test_access_tokens_are_verified_locally_against_cached_keys(monkeypatch):
+    import hashlib
+    import hmac
+    import uuid
+
+    def hs256(secret: bytes):
+        return lambda signing_input: hmac.new(secret, signing_input, hashlib.sha256).digest()
+
+    # The key set also publishes a shared secret, which must never be trusted
+    fetches = []
+    server = serve_jwks([{"kty": "oct", "kid": "k1", "k": b64url(b"published-secret")}], fetches)
+    monkeypatch.setenv("EXPO_PUBLIC_SUPABASE_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setenv("AUTH_REQUIRED", "1")
+    monkeypatch.setenv("SUPABASE_JWT_SECRET", "legacy-secret")
+    me, someone_else = str(uuid.uuid4()), str(uuid.uuid4())
+    token = make_token("HS256", "legacy", hs256(b"legacy-secret"), me)
+    try:
+        with TestClient(main.app) as client:
+            deadline = time.monotonic() + 5
+            while not fetches and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert fetches == ["/auth/v1/.well-known/jwks.json"], "Keys should be fetched in the background at startup"
+            assert auth_tokens.stats()["keys"] == 0, "oct keys from the JWKS are ignored"
+
+            bearer = {"Authorization": f"Bearer {token}"}
+            assert client.get(f"/profile/{me}").status_code == 401
+            assert client.get(f"/profile/{me}", headers=bearer).json()["uuid"] == me
+            assert token in auth_tokens._verified, "Verified tokens should be remembered"
+            assert client.get(f"/vehicle-pin/{someone_else}", headers=bearer).status_code == 403
+
+            expired = make_token("HS256", "legacy", hs256(b"legacy-secret"), me, exp_in=-3600)
+            forged = make_token("HS256", "legacy", hs256(b"not-the-secret"), me)
+            from_jwks = make_token("HS256", "k1", hs256(b"published-secret"), me)
+            for bad in (expired, forged, from_jwks, "not.a.token"):
+                assert client.get(f"/profile/{me}", headers={"Authorization": f"Bearer {bad}"}).status_code == 401
+            assert len(fetches) == 1, "HS256 tokens never trigger a key refresh"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_access_tokens_verify_rs256_and_es256_keys_from_the_jwks(monkeypatch):
+    pytest.importorskip("cryptography")
+    import uuid
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+
+    def b64int(value: int, length: int | None = None) -> str:
+        return b64url(value.to_bytes(length or (value.bit_length() + 7) // 8, "big"))
+
+    rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    ec_key = ec.generate_private_key(ec.SECP256R1())
+    rsa_public, ec_public = rsa_key.public_key().public_numbers(), ec_key.public_key().public_numbers()
+
+    def rs256(signing_input: bytes) -> bytes:
+        return rsa_key.sign(signing_input, padding.PKCS1v15(), hashes.SHA256())
+
+    def es256(signing_input: bytes) -> bytes:
+        r, s = utils.decode_dss_signature(ec_key.sign(signing_input, ec.ECDSA(hashes.SHA256())))
+        return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+    jwks = [{"kty": "RSA", "kid": "rsa1", "alg": "RS256", "use": "sig", "n": b64int(rsa_public.n), "e": b64int(rsa_public.e)}]
+    fetches = []
+    server = serve_jwks(jwks, fetches)
+    monkeypatch.setenv("EXPO_PUBLIC_SUPABASE_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setenv("AUTH_REQUIRED", "1")
+    monkeypatch.delenv("SUPABASE_JWT_SECRET", raising=False)
+    monkeypatch.setattr(auth_tokens, "JWKS_MIN_REFRESH_SECONDS", 0)
+    me = str(uuid.uuid4())
+    try:
+        with TestClient(main.app) as client:
+            deadline = time.monotonic() + 5
+            while auth_tokens.stats()["keys"] == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            def status_for(token: str) -> int:
+                return client.get(f"/profile/{me}", headers={"Authorization": f"Bearer {token}"}).status_code
+
+            assert status_for(make_token("RS256", "rsa1", rs256, me)) == 200
+            assert status_for(make_token("RS256", "rsa1", es256, me)) == 401, "Signature from another key"
+            assert status_for(make_token("ES256", "rsa1", es256, me)) == 401, "Algorithm must match the key"
+
+            # A token signed with a rotated-in key triggers one early refresh, which also drops the remembered tokens
+            jwks.append({"kty": "EC", "crv": "P-256", "kid": "ec1", "use": "sig",
+                         "x": b64int(ec_public.x, 32), "y": b64int(ec_public.y, 32)})
+            remembered = len(auth_tokens._verified)
+            assert status_for(make_token("ES256", "ec1", es256, me)) == 200
+            assert len(fetches) >= 2 and len(auth_tokens._verified) <= remembered
+            assert status_for(make_token("ES256", "ec1", rs256, me)) == 401
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_async_lot_endpoints():
+    with TestClient(main.app) as client:
+        response = client.get("/lots_percent_full")
+        assert response.status_code == 200
+        assert len(response.json()) == len(ldb.fetch_all_lots())
+
+        response = client.get("/lots/0")
+        assert response.status_code == 200
+        assert response.json()["lot_name"] == lh.lot_dict()[0]
+
+
+def test_lot_endpoints_answer_304_while_nothing_changed(monkeypatch):
+    # Background db work would trip the no-db check below
+    monkeypatch.setenv("EVENT_ROLLUPS", "0")
+    monkeypatch.setenv("PARTITION_MAINTENANCE", "0")
+    with TestClient(main.app) as client:
+        first = client.get("/lots_percent_full")
+        etag = first.headers["etag"]
+        assert client.get("/lots").headers["etag"] == etag, "Every lot read endpoint shares the occupancy version"
+
+        def no_db(*args, **kwargs):
+            raise AssertionError("A 304 should not touch the database")
+        lc.get_all_lots()
+        with monkeypatch.context() as patched:
+            patched.setattr(lh, "get_cursor", no_db)
+            patched.setattr(ldb, "fetch_all_lots", no_db)
+            for path in ("/lots", "/lots/3", "/lots_percent_full"):
+                response = client.get(path, headers={"If-None-Match": etag})
+                assert response.status_code == 304 and response.content == b""
+                assert response.headers["etag"] == etag
+
+        lot = ldb.fetch_lot_by_id(3)
+        lh.update_lots_current(lot.current < lot.total_capacity, 3)
+        changed = client.get("/lots/3", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["etag"] != etag
+        assert changed.json()["current"] == ldb.fetch_lot_by_id(3).current
+
+
+def test_lot_endpoints_serve_pre_encoded_bodies(monkeypatch):
+    calls = []
+    fetch_all_lots, fetch_lot_page_async = ldb.fetch_all_lots, ldb.fetch_lot_page_async
+    async def counting_fetch(*args):
+        calls.append(1)
+        return await fetch_lot_page_async(*args)
+    monkeypatch.setattr(ldb, "fetch_lot_page_async", counting_fetch)
+    response_cache.lot_responses.clear()
+
+    with TestClient(main.app) as client:
+        lc.get_all_lots()
+        plain = client.get("/lots", params={"sort_option": "lot_name"}, headers={"Accept-Encoding": "identity"})
+        again = client.get("/lots", params={"sort_option": "lot_name"}, headers={"Accept-Encoding": "gzip"})
+        assert len(calls) == 1, "The second request should be served from the cached body"
+        assert again.json() == plain.json() == [main.to_summary(lot).model_dump() for lot in
+                                               sorted(fetch_all_lots(), key=lambda lot: lot.lot_name.lower())]
+        if len(plain.content) >= response_cache.MIN_COMPRESS_BYTES:
+            assert again.headers["content-encoding"] == "gzip"
+
+        lot = ldb.fetch_lot_by_id(5)
+        lh.update_lots_current(lot.current < lot.total_capacity, 5)
+        rebuilt = client.get("/lots", params={"sort_option": "lot_name"})
+        assert len(calls) == 2, "A lot change should rebuild the body"
+        assert next(item for item in rebuilt.json() if item["lot_id"] == 5)["current"] == ldb.fetch_lot_by_id(5).current
+
+    assert response_cache.pick_encoding("gzip;q=0, br;q=0") is None
+    assert response_cache.pick_encoding("deflate, gzip;q=0.5") == "gzip"
+
+
+def test_lots_pages_follow_the_maintained_sort_order():
+    def expected(sort_field, descending, lot_type=None):
+        lots = [lot for lot in ldb.fetch_all_lots() if lot_type is None or lot.type.lower() == lot_type.lower()]
+        ordered = sorted(lots, key=lambda lot: lot_index.sort_key(lot, sort_field))
+        return [lot.lot_id for lot in (reversed(ordered) if descending else ordered)]
+
+    with TestClient(main.app) as client:
+        lot = ldb.fetch_lot_by_id(6)
+        lh.update_lots_current(lot.current < lot.total_capacity, 6)
+
+        for sort_option in ("percent_full", "-percent_full", "lot_name", "-lot_name"):
+            seen, cursor = [], None
+            while True:
+                params = {"sort_option": sort_option, "limit": 5} | ({"cursor": cursor} if cursor else {})
+                response = client.get("/lots", params=params)
+                seen += [item["lot_id"] for item in response.json()]
+                cursor = response.headers.get("x-next-cursor")
+                if not cursor:
+                    break
+            assert seen == expected(sort_option.lstrip("-"), sort_option.startswith("-")), sort_option
+
+        paged = client.get("/lots", params={"sort_option": "-percent_full", "limit": 3, "offset": 2}).json()
+        assert [item["lot_id"] for item in paged] == expected("percent_full", True)[2:5]
+
+        lot_type = ldb.fetch_all_lots()[0].type
+        typed = client.get("/lots", params={"lot_category": lot_type.upper(), "sort_option": "lot_name"}).json()
+        assert [item["lot_id"] for item in typed] == expected("lot_name", False, lot_type)
+
+        name_cursor = lot_index.encode_cursor("lot_name", ("a", 0))
+        assert client.get("/lots", params={"cursor": name_cursor}).status_code == 400
+
+
+def test_lot_search_finds_aliases_and_typos():
+    lot = ldb.fetch_lot_by_name("P15")
+
+    for query in ("P15", "P 15", "p-15", "lot15", "Parking Lot 15", "15"):
+        assert lot_search.search(query)[0].lot_id == lot.lot_id, query
+    assert lot.lot_id in [hit.lot_id for hit in lot_search.search("pl5")], "A one character typo should still match"
+    assert lot.lot_id in [hit.lot_id for hit in lot_search.search(str(lot.lot_id))], "Lot IDs are searchable too"
+
+    prefix = [hit.lot_name for hit in lot_search.search("P1")]
+    assert prefix[0] == "P1" and set(prefix) >= {"P10", "P11", "P13", "P15"}, "Exact match first, then prefixes"
+    assert lot_search.search("zzzz") == []
+
+    # Rebuilt only when the catalog reloads
+    index = lot_search.get_index()
+    lh.update_lots_current(lot.current < lot.total_capacity, lot.lot_id)
+    assert lot_search.get_index() is index
+    lc.invalidate()
+    assert lot_search.get_index() is not index
+
+    with TestClient(main.app) as client:
+        hits = client.get("/lots/search", params={"q": "lot 15", "limit": 3}).json()
+        assert hits[0]["lot_id"] == lot.lot_id and len(hits) <= 3
+        filtered = client.get("/lots", params={"search_query": "P 15"}).json()
+        assert lot.lot_id in [item["lot_id"] for item in filtered]
+        # The /lots filter keeps exact / prefix / substring matches only, no typo or trigram neighbours
+        names = {item["lot_name"] for item in client.get("/lots", params={"search_query": "P13"}).json()}
+        assert "P13" in names and not names & {"P1", "P3", "P15"}, names
+        assert client.get("/lots", params={"search_query": "pl5"}).json() == []
+        # Queries too short for a trigram still match as substrings ("7" is inside P27)
+        short = {item["lot_name"] for item in client.get("/lots", params={"search_query": "7"}).json()}
+        assert "P27" in short, short
+
+def test_lot_batch_keeps_request_order_and_flags_missing_ids():
+    with TestClient(main.app) as client:
+        response = client.get("/lots/batch", params={"ids": "7,999,0,3"})
+        assert response.status_code == 200
+        batch = response.json()
+        assert [entry["lot_id"] for entry in batch["lots"]] == [7, 999, 0, 3]
+        assert batch["missing"] == [999]
+        assert batch["lots"][1] == {"lot_id": 999, "found": False, "lot": None}
+        assert batch["lots"][0]["lot"]["lot_name"] == ldb.fetch_lot_by_id(7).lot_name
+        assert client.get("/lots/999").status_code == 404, "Single lookups of unknown IDs are a plain 404"
+        assert client.get("/lots/999", params={"fields": "lot_id"}).status_code == 404
+
+        assert client.get("/lots/batch", params={"ids": "7,999,0,3"}, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+        posted = client.post("/lots/batch", json={"ids": [3, 3, 11]}).json()
+        assert [entry["lot_id"] for entry in posted["lots"]] == [3, 3, 11] and posted["missing"] == []
+
+        assert client.get("/lots/batch", params={"ids": "1,x"}).status_code == 400
+        assert client.post("/lots/batch", json={"ids": []}).status_code == 400
+
+def test_lot_endpoints_project_requested_fields():
+    with TestClient(main.app) as client:
+        full = client.get("/lots", params={"sort_option": "lot_name"}).json()
+        slim = client.get("/lots", params={"sort_option": "lot_name", "fields": "percent_full,lot_id"}).json()
+        assert slim == [{"lot_id": item["lot_id"], "percent_full": item["percent_full"]} for item in full]
+
+        lot = client.get("/lots/3", params={"fields": "state,lot_name"}).json()
+        assert lot == {"lot_name": full[[item["lot_id"] for item in full].index(3)]["lot_name"], "state": client.get("/lots/3").json()["state"]}
+        assert client.get("/lots/3").json().keys() == lh.LotSummary.model_fields.keys()
+
+        assert client.get("/lots", params={"fields": "lot_id,capacity"}).status_code == 400
+        assert client.get("/lots/3", params={"fields": ","}).status_code == 400
+
+    # A lot without capacity reads as empty instead of dividing by zero
+    closed = lh.Lot(lot_id=99, lot_name="Closed", total_capacity=0, current=0, type="Staff", hours="")
+    assert main.project_summary(closed, ("percent_full", "state")) == {"percent_full": 0, "state": "EMPTY"}
+    assert main.to_summary(closed).percent_full == 0
+
+def test_websocket_stream_sends_snapshot_then_deltas():
+    with TestClient(main.app) as client:
+        with client.websocket_connect("/ws/lots?lot_ids=2") as websocket:
+            snapshot = websocket.receive_json()
+            assert snapshot["type"] == "snapshot"
+            assert [lot["lot_id"] for lot in snapshot["lots"]] == [2], "Snapshot should be filtered by lot_ids"
+
+            before = snapshot["lots"][0]
+            lh.update_lots_current(before["current"] < before["total_capacity"], 2)
+            lh.update_lots_current(before["current"] < before["total_capacity"], 3)
+
+            delta = websocket.receive_json()
+            assert delta["type"] == "delta"
+            assert delta["lot"]["lot_id"] == 2, "Changes to unwatched lots should not be sent"
+            assert delta["lot"]["current"] != before["current"]
+
+
+def test_simulation_engine_runs_in_memory_and_persists(scratch_db):
+    lots = ldb.fetch_all_lots()
+    start = datetime.datetime(2026, 1, 5, 7, 0)
+    first = simulation.SimulationEngine(lots, seed=7).run_all_lots(days=5, start=start)
+    engine = simulation.SimulationEngine(lots, seed=7)
+    second = engine.run_all_lots(days=5, start=start)
+    assert [(v.dt, v.lot_id, v.is_entering) for v in first] == [(v.dt, v.lot_id, v.is_entering) for v in second]
+    assert all(0 <= engine.current[lot.lot_id] <= lot.total_capacity for lot in lots)
+    assert all(ddb.START_TIME <= v.dt.hour < ddb.END_TIME for v in second)
+
+    # The vectorized draws follow the same mixture as ddb._sample_skew
+    skews = simulation.SimulationEngine(lots, seed=7, tails=0.2)._draw_skews(20000)
+    assert skews.min() >= 1 and skews.max() <= 80
+    assert abs((skews > 5).mean() - 0.2) < 0.02
+
+    engine.persist(second)
+    for lot in lots:
+        assert ldb.fetch_lot_by_id(lot.lot_id).current == engine.current[lot.lot_id]
+        assert lh.get_lot_current_and__total_capacity(lot.lot_id)[0] == engine.current[lot.lot_id]
+
+
+def test_ensemble_bands_are_ordered_and_reproducible():
+    lots = ldb.fetch_all_lots()[:2]
+    request = ensemble.EnsembleRequest(replications=8, days=2, seed=3, capacity_jitter=0.1)
+    first = ensemble.run_ensemble(request, lots, max_workers=2)
+    second = ensemble.run_ensemble(request, lots, max_workers=1)
+    assert first == second, "Results should not depend on how replications are spread over workers"
+
+    assert len(first.bucket_starts) == 2 * 24
+    for bands in first.lots:
+        for low, mid, high in zip(bands.occupancy["p5"], bands.occupancy["p50"], bands.occupancy["p95"]):
+            assert low <= mid <= high
+        assert 0 <= bands.full_probability <= 1
+
+    with pytest.raises(ValueError):
+        ensemble.EnsembleRequest(replications=5000, days=90, bucket_minutes=5)
+    with TestClient(main.app) as client:
+        assert client.post("/simulation/ensemble", json={"replications": 5000, "days": 90, "bucket_minutes": 5}).status_code == 422
+        # Every slot taken: turned away instead of queued
+        for _ in range(ensemble.ENSEMBLE_MAX_CONCURRENT):
+            ensemble._slots.acquire()
+        try:
+            response = client.post("/simulation/ensemble", json={"replications": 1, "days": 1})
+            assert response.status_code == 429 and "Retry-After" in response.headers
+        finally:
+            for _ in range(ensemble.ENSEMBLE_MAX_CONCURRENT):
+                ensemble._slots.release()
+        assert len(client.post("/simulation/ensemble", json={"replications": 2, "days": 1, "lot_ids": [0]}).json()["lots"]) == 1
+
+
+def test_occupancy_store_appends_and_converts_csv(tmp_path):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("pandas")
+    import train_model
+    from occupancy_store import OccupancyStore, convert_csv
+
+    dates, days = train_model.simulate_days_array(train_model.SEED, train_model.MAX_VAR, 10,
+                                                  datetime.datetime(2026, 1, 5), lots=3, rng_seed=1)
+    csv_path = tmp_path / "simulated.csv"
+    train_model.write_days_csv(csv_path, dates, days)
+    store = convert_csv(csv_path, tmp_path / "simulated.occ")
+    assert (store.count, store.hours, store.lots) == (10, len(train_model.HOURS), 3)
+    assert np.array_equal(store.values(), days)
+    assert store.last_date() == dates[-1].astype(datetime.date)
+
+    more_dates, more_days = train_model.simulate_days_array(train_model.SEED, train_model.MAX_VAR, 5,
+                                                            datetime.datetime(2026, 2, 2), lots=3, rng_seed=2)
+    size = os.path.getsize(tmp_path / "simulated.occ")
+    store.append(more_dates, more_days)
+    reopened = OccupancyStore(tmp_path / "simulated.occ")
+    assert reopened.count == 15
+    assert os.path.getsize(tmp_path / "simulated.occ") == size + 5 * reopened.dtype.itemsize
+    assert np.array_equal(reopened.lookup(more_dates[2]), more_days[2])
+    assert reopened.lookup("2026-01-10") is None, "Weekends are never stored"
+    with pytest.raises(ValueError):
+        reopened.append(dates[:1], days[:1])
+
+
+def test_event_samples_skip_histories_missing_opening_hours(scratch_db):
+    pytest.importorskip("pandas")
+    import train_model
+
+    start = datetime.datetime(2031, 4, 7, 9, 0, tzinfo=datetime.timezone.utc)
+    with lh.get_cursor(transaction=True) as cursor:
+        ddb._copy_events(cursor, [ddb.Vehicle(dt=start + datetime.timedelta(seconds=i), is_entering=True, lot_id=0)
+                                  for i in range(5)])
+
+    keys, weekdays, rows = train_model.event_samples(ldb.fetch_all_lots())
+    assert len(keys) == len(weekdays) == 0 and rows.shape == (0, len(train_model.HOURS)), "A few minutes of events is no full day"
+
+
+def test_forecast_trains_and_serves_from_memory(scratch_db, tmp_path, monkeypatch):
+    pytest.importorskip("numpy")
+    pytest.importorskip("pandas")
+    import train_model
+
+    # One fully covered Wednesday of events for lot 0, in the scratch schema so leftovers of other tests don't count
+    with lh.get_cursor(transaction=True) as cursor:
+        cursor.execute("SELECT current_setting('TimeZone');")
+        wednesday = datetime.datetime(2031, 4, 9, 6, 30, tzinfo=zoneinfo.ZoneInfo(cursor.fetchone()[0]))
+        ddb._copy_events(cursor, [ddb.Vehicle(dt=wednesday + datetime.timedelta(hours=i), is_entering=i < 8, lot_id=0)
+                                  for i in range(16)])
+
+    dates, days = train_model.simulate_days_array(train_model.SEED, train_model.MAX_VAR, 50,
+                                                  datetime.datetime(2026, 1, 5), rng_seed=4)
+    train_model.write_days_csv(tmp_path / "simulated.csv", dates, days)
+    lots = ldb.fetch_all_lots()
+
+    # The simulator only produces weekdays: no training days for a Saturday is a 404, not an outage
+    train_model.train_forecast(str(tmp_path / "simulated.csv"), tmp_path / "weekdays.json")
+    forecast.load(tmp_path / "weekdays.json")
+    with TestClient(main.app) as client:
+        weekend = client.get("/lots/0/forecast", params={"weekday": 5})
+        assert weekend.status_code == 404 and "Saturday" in weekend.json()["detail"]
+        assert client.get("/lots/0/forecast", params={"weekday": 4}).status_code == 200
+
+    train_model.train_forecast(str(tmp_path / "simulated.csv"), tmp_path / "forecast.json", lots)
+    with pytest.raises(FileNotFoundError):
+        train_model.train_forecast(str(tmp_path / "missing.csv"), tmp_path / "unused.json", lots)
+    forecast.load(tmp_path / "forecast.json")
+
+    def no_reload(*args, **kwargs):
+        raise AssertionError("Forecasts should be served from the table already in memory")
+    monkeypatch.setattr(forecast, "load", no_reload)
+    monkeypatch.setattr(train_model, "event_samples", no_reload)
+
+    with TestClient(main.app) as client:
+        response = client.get("/lots/0/forecast", params={"weekday": 3, "hour": 14})
+        assert response.status_code == 200
+        body = response.json()
+        assert [point["hour"] for point in body["points"]] == [14]
+        point = body["points"][0]
+        assert point["quantiles"]["p10"] <= point["quantiles"]["p50"] <= point["quantiles"]["p90"]
+        assert point["expected_current"] == round(point["mean"] * body["total_capacity"])
+
+        assert client.get("/lots/0/forecast", params={"weekday": 2}).json()["source"] == "lot"
+        assert client.get("/lots/1/forecast", params={"weekday": 2}).json()["source"] == "default"
+        whole_day = client.get("/lots/0/forecast", params={"weekday": 0}).json()
+        assert [point["hour"] for point in whole_day["points"]] == train_model.OPEN_HOURS
+        assert client.get("/lots/0/forecast", params={"weekday": 0, "hour": 3}).status_code == 400
+        assert client.get("/lots/9999/forecast").status_code == 404
+
+    # Relative paths resolve next to the module whatever the working directory
+    assert os.path.dirname(forecast.FORECAST_PATH) == os.path.dirname(os.path.abspath(forecast.__file__))
+
+
 # Detection Database Tests (detection_database)
 def test_insert_and_fetch_vehicle_entries():
     vehicle1 = ddb.Vehicle(
@@ -78,21 +729,311 @@ def test_insert_and_fetch_vehicle_entries():
         assert r[2] == vehicle1.lot_id or r[2] == vehicle2.lot_id, "Fetched lot_id does not match inserted lot_id"
 
 
+def test_insert_vehicle_entry_enforces_bounds(scratch_db):
+    lot = ldb.fetch_lot_by_id(4)
+    with lh.get_cursor() as cursor:
+        cursor.execute("UPDATE lots SET current = total_capacity WHERE lot_id = 4;")
+    lc.set_occupancy(4, lot.total_capacity)
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    rejected = ddb.insert_vehicle_entry(ddb.Vehicle(dt=now, is_entering=True, lot_id=4))
+    assert rejected.status == "rejected" and rejected.reason == "lot_full"
+    assert lh.get_lot_current_and__total_capacity(4)[0] == lot.total_capacity, "Rejected events must not change the lot"
+
+    accepted = ddb.insert_vehicle_entry(ddb.Vehicle(dt=now, is_entering=False, lot_id=4))
+    assert accepted.status == "accepted"
+    assert accepted.current == lot.total_capacity - 1
+    assert ldb.fetch_lot_by_id(4).current == accepted.current, "Accepted events should update the cache"
+
+    unknown = ddb.insert_vehicle_entry(ddb.Vehicle(dt=now, is_entering=True, lot_id=-5))
+    assert unknown.status == "rejected" and unknown.reason == "unknown_lot"
+
+
+def test_rollups_fold_new_events_from_the_high_water_mark(scratch_db):
+    rollups.ensure_schema()
+    rollups.refresh()
+    start = datetime.datetime(2031, 3, 3, 10, 0, tzinfo=datetime.timezone.utc)
+
+    def add_events(events):
+        with lh.get_cursor(transaction=True) as cursor:
+            ddb._copy_events(cursor, [ddb.Vehicle(dt=dt, is_entering=entering, lot_id=9) for dt, entering in events])
+
+    minute = datetime.timedelta(minutes=1)
+    add_events([(start, True), (start + 10 * datetime.timedelta(seconds=1), True), (start + minute, False),
+                (start + 61 * minute, True)])
+    assert rollups.refresh(lag=0) == 0, "The first pass folds the events but only records a candidate mark"
+    mark = rollups.refresh(lag=0)
+    assert mark == rollups.latest_event_id(), "The next pass promotes the candidate once nothing older is running"
+
+    def rows(resolution):
+        with lh.get_cursor() as cursor:
+            cursor.execute(f"SELECT bucket, entries, exits, occupancy FROM {rollups.RESOLUTIONS[resolution]} "
+                           "WHERE lot_id = 9 AND bucket >= %s ORDER BY bucket;", (start - datetime.timedelta(hours=1),))
+            return cursor.fetchall()
+
+    hours = rows("hour")
+    assert [(bucket, entries, exits) for bucket, entries, exits, _ in hours] == [(start, 2, 1), (start + 60 * minute, 1, 0)]
+    assert hours[1][3] - hours[0][3] == 1
+    assert [entries - exits for _, entries, exits, _ in rows("minute")] == [2, -1, 1]
+    assert rollups.refresh(lag=0) == mark and rows("hour") == hours, "Refolding without new events changes nothing"
+
+    # A late event only shifts the buckets after it
+    add_events([(start - 30 * minute, True)])
+    rollups.refresh()
+    late = rows("hour")
+    assert late[0][1:3] == (1, 0)
+    assert [occupancy for *_, occupancy in late[1:]] == [occupancy + 1 for *_, occupancy in hours]
+
+    # Events dated before the pruning window are left to the sweep
+    backfill = datetime.datetime(2020, 6, 1, 9, 30, tzinfo=datetime.timezone.utc)
+    add_events([(backfill, True)])
+    rollups.refresh(lag=0)
+    assert rollups.refresh(lag=0) == rollups.latest_event_id()
+    with lh.get_cursor() as cursor:
+        cursor.execute(f"EXPLAIN " + rollups.UPSERT_QUERY.format(events="parking_events", table=rollups.RESOLUTIONS["hour"]),
+                       {"unit": "hour", "step": rollups.STEPS["hour"], "after": 0, "upto": 1, "since": start})
+        assert "dt >=" in " ".join(row[0] for row in cursor.fetchall()), "Passes should bound dt for partition pruning"
+    assert rows("hour")[0][0] == start - 60 * minute
+    assert rollups.sweep() == rollups.latest_event_id()
+    with lh.get_cursor() as cursor:
+        cursor.execute(f"SELECT entries FROM {rollups.RESOLUTIONS['hour']} WHERE lot_id = 9 AND bucket = '2020-06-01 09:00+00';")
+        assert cursor.fetchone()[0] == 1
+
+    with TestClient(main.app) as client:
+        response = client.get("/lots/9/history", params={"resolution": "minute", "start": start.isoformat(),
+                                                         "end": (start + 2 * minute).isoformat()})
+        assert response.status_code == 200
+        assert [(b["entries"], b["exits"]) for b in response.json()["buckets"]] == [(2, 0), (0, 1)]
+        assert client.get("/lots/9/history", params={"resolution": "minute", "start": "2020-01-01T00:00:00Z",
+                                                     "end": "2030-01-01T00:00:00Z"}).status_code == 400
+        assert client.get("/lots/9999/history").status_code == 404
+
+
+def test_rollups_count_events_that_commit_out_of_id_order(scratch_db):
+    rollups.ensure_schema()
+    start = datetime.datetime(2031, 3, 4, 10, 0, tzinfo=datetime.timezone.utc)
+
+    # A slow COPY takes the lower event_id but commits after a later insert has been rolled up
+    slow = lh.establish_connection()
+    try:
+        slow_cursor = slow.cursor()
+        ddb._copy_events(slow_cursor, [ddb.Vehicle(dt=start, is_entering=True, lot_id=8)])
+        with lh.get_cursor(transaction=True) as cursor:
+            ddb._copy_events(cursor, [ddb.Vehicle(dt=start + datetime.timedelta(seconds=5), is_entering=True, lot_id=8)])
+        for _ in range(3):
+            mark = rollups.refresh(lag=0)
+        assert mark == 0, "The mark must not pass ids held by a transaction that is still running"
+        slow.commit()
+    finally:
+        slow.close()
+
+    rollups.refresh(lag=0)
+    assert rollups.refresh(lag=0) == rollups.latest_event_id()
+    with lh.get_cursor() as cursor:
+        cursor.execute(f"SELECT entries FROM {rollups.RESOLUTIONS['hour']} WHERE lot_id = 8 AND bucket = %s;", (start,))
+        assert cursor.fetchone()[0] == 2, "The late commit should be counted in its bucket"
+
+
+def test_event_export_streams_in_batches(scratch_db):
+    start = datetime.datetime(2031, 4, 7, 8, 0, tzinfo=datetime.timezone.utc)
+    end = start + datetime.timedelta(hours=1)
+    with lh.get_cursor(transaction=True) as cursor:
+        ddb._copy_events(cursor, [ddb.Vehicle(dt=start + datetime.timedelta(minutes=i), is_entering=i % 3 != 0, lot_id=i % 2)
+                                  for i in range(25)])
+
+    batches = list(event_export.iter_event_batches(lot_id=1, start=start, end=end, batch_size=5))
+    assert [len(rows) for rows in batches] == [5, 5, 2]
+    assert all(lot_id == 1 for rows in batches for _, _, lot_id in rows)
+
+    with TestClient(main.app) as client:
+        params = {"start": start.isoformat(), "end": end.isoformat()}
+        ndjson = client.get("/vehicle_events/export", params=params)
+        assert ndjson.headers["content-type"].startswith("application/x-ndjson")
+        events = [json.loads(line) for line in ndjson.text.splitlines()]
+        assert len(events) == 25 and events == sorted(events, key=lambda event: event["dt"])
+
+        exported = client.get("/vehicle_events/export", params=dict(params, format="csv", lot_id=0)).text.splitlines()
+        assert exported[0] == "dt,is_entering,lot_id"
+        assert len(exported) == 1 + 13
+        assert client.get("/vehicle_events/export", params={"format": "xml"}).status_code == 422
+
+        # Every export slot taken: 503 up front, and finished exports give their slot back
+        for _ in range(event_export.EXPORT_MAX_CONCURRENT):
+            event_export._slots.acquire()
+        try:
+            busy = client.get("/vehicle_events/export", params=params)
+            assert busy.status_code == 503 and "Retry-After" in busy.headers
+        finally:
+            for _ in range(event_export.EXPORT_MAX_CONCURRENT):
+                event_export._slots.release()
+
+        # A stream dropped mid-way closes on the DB executor, never on the event loop thread
+        closed_on = []
+        close = event_export.ExportStream.close
+        def record_close(export):
+            closed_on.append(threading.current_thread())
+            close(export)
+
+        async def abandon():
+            with pytest.MonkeyPatch.context() as patch:
+                patch.setattr(event_export.ExportStream, "close", record_close)
+                export = await event_export.open_export_async(start=start, end=end, batch_size=5)
+                chunks = export.__aiter__()
+                await chunks.__anext__()
+                await chunks.aclose()
+            return threading.current_thread()
+
+        loop_thread = asyncio.run(abandon())
+        assert closed_on and loop_thread not in closed_on
+        assert event_export._slots.acquire(blocking=False), "The abandoned export gave its slot back"
+        event_export._slots.release()
+
+        # Events with the same dt come out in insert order once event_id exists
+        rollups.ensure_schema()
+        tie = end + datetime.timedelta(minutes=5)
+        with lh.get_cursor(transaction=True) as cursor:
+            ddb._copy_events(cursor, [ddb.Vehicle(dt=tie, is_entering=True, lot_id=lot_id) for lot_id in (5, 3, 4)])
+        tied = client.get("/vehicle_events/export", params={"start": tie.isoformat()}).text.splitlines()
+        assert [json.loads(line)["lot_id"] for line in tied] == [5, 3, 4]
+
+
+def test_partitioned_events_keep_rows_and_expire_old_ranges(scratch_db):
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    with lh.get_cursor(transaction=True) as cursor:
+        ddb._copy_events(cursor, [ddb.Vehicle(dt=now - datetime.timedelta(days=40 * i), is_entering=True, lot_id=i) for i in range(5)])
+        cursor.execute("SELECT count(*) FROM parking_events;")
+        count = cursor.fetchone()[0]
+    partitions.migrate(drop_legacy=True)
+    assert partitions.migrate() == 0, "Migrating twice should be a no-op"
+
+    utc = datetime.timezone.utc
+    with lh.get_cursor(transaction=True) as cursor:
+        assert partitions.is_partitioned(cursor)
+        cursor.execute("SELECT count(*) FROM parking_events;")
+        assert cursor.fetchone()[0] == count
+        ahead = partitions.shift_interval(partitions.floor_interval(datetime.datetime.now(utc)), partitions.PARTITION_PREMAKE)
+        assert ahead in {start for _, start, _ in partitions.list_partitions(cursor)}
+
+        # Out of range events land in the default partition and move when their partition is created
+        old = datetime.datetime(2001, 1, 15, 12, 0, tzinfo=utc)
+        ddb._copy_events(cursor, [ddb.Vehicle(dt=old, is_entering=True, lot_id=3)])
+        cursor.execute("SELECT tableoid::regclass::text FROM parking_events WHERE dt = %s;", (old,))
+        assert cursor.fetchone()[0] == partitions.DEFAULT_PARTITION
+        if partitions.partition_name(partitions.floor_interval(old)) not in {name for name, _, _ in partitions.list_partitions(cursor)}:
+            partitions.create_partition(cursor, partitions.floor_interval(old))
+        cursor.execute("SELECT tableoid::regclass::text FROM parking_events WHERE dt = %s;", (old,))
+        assert cursor.fetchone()[0] == partitions.partition_name(partitions.floor_interval(old))
+
+        cursor.execute("EXPLAIN SELECT * FROM parking_events WHERE dt >= %s AND dt < %s;", (old, old + datetime.timedelta(days=1)))
+        plan = " ".join(row[0] for row in cursor.fetchall())
+        assert partitions.partition_name(partitions.floor_interval(old)) in plan and partitions.DEFAULT_PARTITION not in plan
+
+        expired = partitions.apply_retention(cursor, datetime.datetime(2001, 3, 10, tzinfo=utc), retention=1, mode="drop")
+        assert expired == [partitions.partition_name(partitions.floor_interval(old))]
+        cursor.execute("SELECT count(*) FROM parking_events WHERE dt = %s;", (old,))
+        assert cursor.fetchone()[0] == 0
+
+
+def test_partition_bounds_follow_a_naive_dt_column(scratch_db):
+    utc = datetime.timezone.utc
+    with lh.get_cursor(transaction=True) as cursor:
+        cursor.execute("""
+            DROP TABLE parking_events;
+            CREATE TABLE parking_events (dt timestamp NOT NULL, is_entering boolean NOT NULL, lot_id integer NOT NULL) PARTITION BY RANGE (dt);
+            SET LOCAL TIME ZONE 'America/New_York';
+        """)
+        cursor.execute(f"CREATE TABLE {partitions.DEFAULT_PARTITION} PARTITION OF parking_events DEFAULT;")
+        now = datetime.datetime(2031, 5, 20, 12, 0, tzinfo=utc)
+        assert len(partitions.ensure_partitions(cursor, now, ahead=1, interval="month")) == 2
+        assert partitions.ensure_partitions(cursor, now, ahead=1, interval="month") == [], "Existing bounds should be recognised"
+        assert [start for _, start, _ in partitions.list_partitions(cursor)] == [datetime.datetime(2031, 5, 1, tzinfo=utc),
+                                                                                 datetime.datetime(2031, 6, 1, tzinfo=utc)]
+        cursor.execute("SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE oid = to_regclass(%s);",
+                       (partitions.partition_name(datetime.datetime(2031, 5, 1, tzinfo=utc)),))
+        assert "'2031-05-01 00:00:00'" in cursor.fetchone()[0], "Naive bounds are UTC wall-clock values"
+
+
+def test_bulk_vehicle_events_reports_rejections(scratch_db):
+    with lh.get_cursor() as cursor:
+        cursor.execute("UPDATE lots SET current = total_capacity - 1 WHERE lot_id = 5 RETURNING total_capacity;")
+        total_capacity = cursor.fetchone()[0]
+    lc.set_occupancy(5, total_capacity - 1)
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+    records = [
+        {"dt": now, "is_entering": True, "lot_id": 5},      # fills the lot
+        {"dt": now, "is_entering": True, "lot_id": 5},      # over capacity
+        {"dt": now, "is_entering": False, "lot_id": 5},
+        {"dt": now, "is_entering": True, "lot_id": 999},    # unknown lot
+    ]
+    with TestClient(main.app) as client:
+        response = client.post(
+            "/vehicle_events/bulk",
+            content="\n".join(json.dumps(record) for record in records),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+    assert response.status_code == 200
+    result = response.json()
+    assert result["accepted"] == 2
+    assert [(r["index"], r["reason"]) for r in result["rejected"]] == [(1, "lot_full"), (3, "unknown_lot")]
+    assert lh.get_lot_current_and__total_capacity(5)[0] == total_capacity - 1, "Only the net delta should be applied"
+    assert ldb.fetch_lot_by_id(5).current == total_capacity - 1
+
+
+def test_write_behind_buffer_updates_cache_then_flushes(scratch_db, monkeypatch):
+    monkeypatch.setenv("EVENT_WRITE_BEHIND", "1")
+    with lh.get_cursor() as cursor:
+        cursor.execute("UPDATE lots SET current = 10 WHERE lot_id = 7;")
+    lc.set_occupancy(7, 10)
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    for _ in range(3):
+        result = ddb.record_vehicle_entry(ddb.Vehicle(dt=now, is_entering=True, lot_id=7))
+        assert result.status == "accepted" and result.queued
+
+    assert ldb.fetch_lot_by_id(7).current == 13, "Buffered events should show up in the lot state immediately"
+    assert lh.get_lot_current_and__total_capacity(7)[0] == 10, "Nothing is written before the flush"
+
+    event_buffer.start()
+    event_buffer.stop()
+    assert lh.get_lot_current_and__total_capacity(7)[0] == 13, "stop() should drain the buffer to the db"
+    assert lc.pending_deltas().get(7) is None
+    assert ldb.fetch_lot_by_id(7).current == 13
+
+    # Another worker fills the lot before the flush: events that no longer fit are left out of the log too
+    total_capacity = ldb.fetch_lot_by_id(7).total_capacity
+    for _ in range(3):
+        ddb.record_vehicle_entry(ddb.Vehicle(dt=now, is_entering=True, lot_id=7))
+    with lh.get_cursor() as cursor:
+        cursor.execute("UPDATE lots SET current = %s WHERE lot_id = 7;", (total_capacity - 1,))
+    rejected = event_buffer.stats()["rejected"]
+    event_buffer.start()
+    event_buffer.stop()
+    assert event_buffer.stats()["rejected"] == rejected + 2
+    with lh.get_cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM parking_events WHERE lot_id = 7;")
+        assert cursor.fetchone()[0] == 4, "Only events that were applied to the lot are logged"
+    assert lh.get_lot_current_and__total_capacity(7)[0] == total_capacity == ldb.fetch_lot_by_id(7).current
+
+    # With the database gone, stop() gives up after the drain timeout and hands the reservations back
+    def unreachable(batch):
+        raise OSError("database unreachable")
+    monkeypatch.setattr(event_buffer, "_write_batch", unreachable)
+    monkeypatch.setattr(event_buffer, "DRAIN_TIMEOUT", 0.2)
+    ddb.record_vehicle_entry(ddb.Vehicle(dt=now, is_entering=False, lot_id=7))
+    dropped = event_buffer.stats()["dropped"]
+    started = time.monotonic()
+    event_buffer.start()
+    event_buffer.stop()
+    assert time.monotonic() - started < 5
+    assert event_buffer.stats()["dropped"] == dropped + 1
+    assert lc.pending_deltas().get(7) is None and ldb.fetch_lot_by_id(7).current == total_capacity
+
+
 # Helper function
 def get_lot(lot_id):
     lot = ldb.fetch_lot_by_id(lot_id)
-    if not lot:
-        return lh.LotSummary(
-            lot_id=lot_id,
-            lot_name='N/A',
-            total_capacity=0,
-            current=0,
-            percent_full=0,
-            state="N/A",
-            type="N/A",
-            hours="N/A"
-        )
-    return main.to_summary(lot)
+    return main.to_summary(lot) if lot else None
 
 # Load dict call helper function and assert with pytest
 def assert_lot_by_id(lot_id):
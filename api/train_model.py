@@ -1,10 +1,15 @@
+import argparse
 import random
 from datetime import datetime, timedelta
 from pydantic import BaseModel
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import math
 import os
+import json
+from occupancy_store import OccupancyStore
+import forecast
     
 class Day(BaseModel):
     day: list[float]
@@ -14,6 +19,8 @@ SEED = [0.2, 0.8, 0.5, 0.7, 0.8, 0.95, 0.9, 0.7, 0.8, 0.7, 0.5, 0.4, 0.25, 0.1]
 MAX_VAR = 0.05
 HOURS = ['7AM', '8AM', '9AM', '10AM', '11AM', '12PM',
          '1PM', '2PM', '3PM', '4PM', '5PM', '6PM', '7PM', '8PM']
+OPEN_HOURS = list(range(7, 7 + len(HOURS)))     # hour of day for each HOURS column
+FORECAST_QUANTILES = (10, 50, 90)
 
 def simulate_day(seed, variance, count, date_seed = datetime.now()) -> list[Day]:
     days = []
@@ -27,6 +34,131 @@ def simulate_day(seed, variance, count, date_seed = datetime.now()) -> list[Day]
 
     return days
 
+# Vectorized version of simulate_day: every weekday, hour and lot in one (days x hours x lots) float32 array.
+# Weekends are skipped with a business-day mask instead of a per-day loop, and no per-day objects are built.
+def simulate_days_array(seed, variance, count, date_seed = None, lots = 1, rng_seed = None) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(rng_seed)
+    start = np.datetime64((date_seed or datetime.now()).date(), "D")
+
+    # count weekdays always fit in count * 7/5 calendar days plus a week of slack
+    calendar = np.arange(start, start + count * 7 // 5 + 7, dtype="datetime64[D]")
+    dates = calendar[np.is_busday(calendar)][:count]
+
+    profile = np.asarray(seed, dtype=np.float32)[None, :, None]
+    noise = rng.uniform(-variance, variance, size=(count, len(seed), lots)).astype(np.float32)
+    days = np.clip(profile + noise, 0, 1, out=noise)
+    return dates, days
+
+# Writes the generated block straight to csv (columns: date, 7AM, 8AM, ...), one block of rows per lot
+# A lot column is added in front of the hours when there is more than one lot
+def write_days_csv(path: str, dates: np.ndarray, days: np.ndarray, append: bool = False):
+    frames = []
+    for lot in range(days.shape[2]):
+        frame = pd.DataFrame(days[:, :, lot], columns=HOURS)
+        frame.insert(0, "date", np.datetime_as_string(dates, unit="D"))
+        if days.shape[2] > 1:
+            frame.insert(1, "lot", lot)
+        frames.append(frame)
+    pd.concat(frames).to_csv(path, mode="a" if append else "w", header=not append, index=False)
+
+# Occupancy samples from the simulated dataset (csv or .occ store) as (lot keys, weekdays, rows x hours fractions)
+# Rows without a lot column get lot key -1, they only feed the shared default profile
+def dataset_samples(path: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if path.endswith(".occ"):
+        store = OccupancyStore(path)
+        values = np.asarray(store.values())                         # (days, hours, lots)
+        weekdays = (store.dates().astype("datetime64[D]").view("int64") + 3) % 7     # 1970-01-01 was a Thursday
+        lots = np.arange(store.lots) if store.lots > 1 else np.array([-1])
+        return (np.tile(lots, len(weekdays)), np.repeat(weekdays, len(lots)),
+                values.transpose(0, 2, 1).reshape(-1, store.hours))
+
+    frame = pd.read_csv(path)
+    lots = frame["lot"].to_numpy() if "lot" in frame.columns else np.full(len(frame), -1)
+    weekdays = pd.to_datetime(frame["date"]).dt.weekday.to_numpy()
+    return lots, weekdays, frame[HOURS].to_numpy(dtype=np.float32)
+
+# Rebuilds each lot's hourly occupancy from parking_events: net change per hour is summed in the database, then
+# accumulated and anchored so the last hour ends at the lot's current count. One row per lot and fully covered day.
+def event_samples(lots) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    import lot_helper as lh
+    query = """
+        SELECT lot_id, date_trunc('hour', dt) AS hour, SUM(CASE WHEN is_entering THEN 1 ELSE -1 END) AS delta
+        FROM parking_events
+        GROUP BY lot_id, hour
+        ORDER BY lot_id, hour;
+    """
+    with lh.get_cursor() as cursor:
+        cursor.execute(query)
+        frame = pd.DataFrame(cursor.fetchall(), columns=["lot_id", "hour", "delta"])
+
+    keys, weekdays, rows = [], [], []
+    for lot in lots:
+        deltas = frame.loc[frame["lot_id"] == lot.lot_id].set_index("hour")["delta"]
+        if deltas.empty or lot.total_capacity <= 0:
+            continue
+        timeline = pd.date_range(deltas.index[0], deltas.index[-1], freq="h")
+        occupancy = deltas.reindex(timeline, fill_value=0).cumsum()
+        occupancy = (occupancy + lot.current - occupancy.iloc[-1]).clip(0, lot.total_capacity) / lot.total_capacity
+
+        # The count at the end of the bucket starting at 7:00 is the 7AM value
+        daily = pd.DataFrame({"date": occupancy.index.normalize(), "hour": occupancy.index.hour, "value": occupancy.to_numpy()})
+        # Days (or a whole short history) that miss an opening hour are dropped, not a KeyError
+        daily = daily[daily["hour"].isin(OPEN_HOURS)].pivot(index="date", columns="hour", values="value")
+        daily = daily.reindex(columns=OPEN_HOURS).dropna()
+        if daily.empty:
+            continue
+        keys.append(np.full(len(daily), lot.lot_id))
+        weekdays.append(daily.index.weekday.to_numpy())
+        rows.append(daily.to_numpy(dtype=np.float32))
+
+    if not rows:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty((0, len(HOURS)), dtype=np.float32)
+    return np.concatenate(keys), np.concatenate(weekdays), np.concatenate(rows)
+
+# Mean and quantiles per weekday and hour, rounded to keep the table compact
+def fit_profile(weekdays: np.ndarray, values: np.ndarray) -> dict:
+    profile = {"samples": [], "mean": [], "quantiles": {f"p{q}": [] for q in FORECAST_QUANTILES}}
+    for weekday in range(7):
+        rows = values[weekdays == weekday]
+        profile["samples"].append(len(rows))
+        if not len(rows):
+            profile["mean"].append(None)
+            for label in profile["quantiles"]:
+                profile["quantiles"][label].append(None)
+            continue
+        profile["mean"].append(np.round(rows.mean(axis=0), 4).tolist())
+        quantiles = np.quantile(rows, np.array(FORECAST_QUANTILES) / 100, axis=0)
+        for q, row in zip(FORECAST_QUANTILES, quantiles):
+            profile["quantiles"][f"p{q}"].append(np.round(row, 4).tolist())
+    return profile
+
+# Fits the forecast table served by forecast.py. Multi-lot datasets use their lot column as the lot_id.
+# A dataset_path that doesn't exist is an error, not silently left out of the training
+def train_forecast(dataset_path: str | None, output_path: str, lots = None) -> dict:
+    samples = []
+    if dataset_path:
+        if not os.path.exists(dataset_path):
+            raise FileNotFoundError(f"No dataset at {os.path.abspath(dataset_path)}")
+        samples.append(dataset_samples(dataset_path))
+    if lots is not None:
+        samples.append(event_samples(lots))
+    if not samples:
+        raise ValueError("Nothing to train on, give a dataset or parking_events lots.")
+
+    keys = np.concatenate([s[0] for s in samples])
+    weekdays = np.concatenate([s[1] for s in samples])
+    values = np.concatenate([s[2] for s in samples])
+
+    table = {
+        "trained_at": datetime.now().isoformat(timespec="seconds"),
+        "hours": OPEN_HOURS,
+        "default": fit_profile(weekdays, values),
+        "lots": {int(key): fit_profile(weekdays[keys == key], values[keys == key]) for key in np.unique(keys) if key >= 0},
+    }
+    with open(output_path, "w") as file:
+        json.dump(table, file, separators=(",", ":"))
+    return table
+
 def graphing_test(days: list[Day]):
         # Dynamic subplot layout
         n = len(days)
@@ -55,29 +187,52 @@ def graphing_test(days: list[Day]):
         plt.show()
 
 if __name__ == "__main__":
-    # simulate X days and write to csv, if csv exists, append to it instead of overwriting
-    if os.path.exists('simulated_parking_data.csv'):
-        print("File 'simulated_parking_data.csv' already exists. Appending new data to it.")
+    parser = argparse.ArgumentParser(description="Generate simulated weekday occupancy data.")
+    parser.add_argument("--days", type=int, default=1000, help="Number of weekdays to generate")
+    parser.add_argument("--lots", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default="simulated_parking_data.csv", help="A .occ path writes the binary occupancy store instead of csv")
+    parser.add_argument("--train", action="store_true", help="Fit the forecast table from --output and parking_events instead of generating data")
+    parser.add_argument("--no-events", action="store_true", help="Train on the dataset only, without reading parking_events")
+    parser.add_argument("--forecast-output", default=forecast.FORECAST_PATH, help="Defaults to where the API reads it (FORECAST_PATH)")
+    args = parser.parse_args()
 
-        existing_df = pd.read_csv('simulated_parking_data.csv', index_col=0)
-        last_date = datetime.strptime(existing_df.index[-1], '%Y-%m-%d')
+    if args.train:
+        import lot_cache as lc
+        try:
+            table = train_forecast(args.output, args.forecast_output, None if args.no_events else lc.get_all_lots())
+        except FileNotFoundError as exc:
+            raise SystemExit(f"{exc}, point --output at the simulated dataset (or pass --output '' to train on parking_events only)")
+        print(f"Wrote forecasts for {len(table['lots'])} lots to {args.forecast_output}")
+        raise SystemExit(0)
+
+    binary = args.output.endswith(".occ")
+
+    # simulate X days and write to the output, if it exists, append to it instead of overwriting
+    if os.path.exists(args.output):
+        print(f"File '{args.output}' already exists. Appending new data to it.")
+
+        if binary:
+            store = OccupancyStore(args.output)
+            last_date = datetime.combine(store.last_date(), datetime.min.time())
+        else:
+            existing_df = pd.read_csv(args.output, usecols=["date"])
+            last_date = datetime.strptime(existing_df["date"].iloc[-1], '%Y-%m-%d')
         new_start_date = last_date + timedelta(days=1)
 
         print("Starting at day:", new_start_date.strftime('%Y-%m-%d'))
 
-        new_days = simulate_day(SEED, MAX_VAR, 1000, new_start_date)
-        new_df = pd.DataFrame({day.date.strftime('%Y-%m-%d'): day.day for day in new_days}).T
-        new_df.to_csv('simulated_parking_data.csv', mode='a', header=False)
+        dates, days = simulate_days_array(SEED, MAX_VAR, args.days, new_start_date, args.lots, args.seed)
+        if binary:
+            store.append(dates, days)
+        else:
+            write_days_csv(args.output, dates, days, append=True)
     else:
-        print("File 'simulated_parking_data.csv' does not exist. Creating new file and writing data to it.")
+        print(f"File '{args.output}' does not exist. Creating new file and writing data to it.")
         print("Starting at day:", datetime.now().strftime('%Y-%m-%d'))
 
-    df_dict = {}
-    days = simulate_day(SEED, MAX_VAR, 1000)
-    for day in days:
-        formatted_date = day.date.strftime('%Y-%m-%d')
-        df_dict[formatted_date] = day.day
-
-    df = pd.DataFrame(df_dict, index=HOURS).T
-    df = df.reset_index(names='date')
-    df.to_csv('simulated_parking_data.csv', index=False)  # CSV columns are: date, 7AM, 8AM, ...
+        dates, days = simulate_days_array(SEED, MAX_VAR, args.days, lots=args.lots, rng_seed=args.seed)
+        if binary:
+            OccupancyStore.create(args.output, hours=len(HOURS), lots=args.lots).append(dates, days)
+        else:
+            write_days_csv(args.output, dates, days)  # CSV columns are: date, 7AM, 8AM, ...
@@ -40,9 +40,7 @@ class UserProfile(BaseModel):
 
 
 def upsert_vehicle_pin(vehicle_pin: VehiclePin) -> VehiclePin:
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-    try:
+    with lh.get_cursor() as cursor:
         cursor.execute(
             """
             INSERT INTO users (id, lat, lon, current_lot, username, notes, favorite_lot)
@@ -60,17 +58,11 @@ def upsert_vehicle_pin(vehicle_pin: VehiclePin) -> VehiclePin:
                 FAVORITE_LOT_DEFAULT,
             ),
         )
-        connection.commit()
         return vehicle_pin
-    finally:
-        cursor.close()
-        connection.close()
 
 
 def fetch_vehicle_pin(user_uuid: UUID) -> Optional[VehiclePin]:
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-    try:
+    with lh.get_cursor() as cursor:
         cursor.execute(
             """
             SELECT lat, lon, current_lot
@@ -86,15 +78,10 @@ def fetch_vehicle_pin(user_uuid: UUID) -> Optional[VehiclePin]:
         if row is None:
             return None
         return VehiclePin(uuid=user_uuid, lat=row[0], lon=row[1], current_lot=row[2])
-    finally:
-        cursor.close()
-        connection.close()
 
 
 def delete_vehicle_pin(user_uuid: UUID) -> bool:
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-    try:
+    with lh.get_cursor() as cursor:
         cursor.execute(
             """
             UPDATE users
@@ -105,17 +92,11 @@ def delete_vehicle_pin(user_uuid: UUID) -> bool:
             """,
             (str(user_uuid),),
         )
-        connection.commit()
         return cursor.rowcount > 0
-    finally:
-        cursor.close()
-        connection.close()
 
 
 def fetch_user_profile(user_uuid: UUID) -> UserProfile:
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-    try:
+    with lh.get_cursor() as cursor:
         cursor.execute(
             """
             SELECT COALESCE(username, ''),
@@ -131,15 +112,10 @@ def fetch_user_profile(user_uuid: UUID) -> UserProfile:
         if row is None:
             return UserProfile(uuid=user_uuid, username="", notes="")
         return UserProfile(uuid=user_uuid, username=row[0], notes=row[1], favorite_lot=row[2])
-    finally:
-        cursor.close()
-        connection.close()
 
 
 def upsert_user_profile(user_profile: UserProfile) -> UserProfile:
-    connection = lh.establish_connection()
-    cursor = connection.cursor()
-    try:
+    with lh.get_cursor() as cursor:
         cursor.execute(
             """
             INSERT INTO users (id, username, notes, favorite_lot)
@@ -161,7 +137,6 @@ def upsert_user_profile(user_profile: UserProfile) -> UserProfile:
             ),
         )
         row = cursor.fetchone()
-        connection.commit()
         if row is None:
             return UserProfile(
                 uuid=user_profile.uuid,
@@ -170,6 +145,11 @@ def upsert_user_profile(user_profile: UserProfile) -> UserProfile:
                 favorite_lot=normalize_favorite_lot(user_profile.favorite_lot),
             )
         return UserProfile(uuid=user_profile.uuid, username=row[0], notes=row[1], favorite_lot=row[2])
-    finally:
-        cursor.close()
-        connection.close()
+
+
+# Awaitable versions for the async endpoints, these run on the DB executor so the event loop never blocks
+upsert_vehicle_pin_async = lh.awaitable(upsert_vehicle_pin)
+fetch_vehicle_pin_async = lh.awaitable(fetch_vehicle_pin)
+delete_vehicle_pin_async = lh.awaitable(delete_vehicle_pin)
+fetch_user_profile_async = lh.awaitable(fetch_user_profile)
+upsert_user_profile_async = lh.awaitable(upsert_user_profile)
@@ -35,6 +35,24 @@ export class HttpClient {
     return (await res.json()) as T;
   }
 
+  socketUrl(
+    path: string,
+    query?: Record<string, string | number | boolean | undefined>
+  ): string {
+    const url = new URL(path, this.baseUrl);
+    url.protocol = url.protocol === "https:" ? "wss:" : "ws:";
+
+    if (query) {
+      Object.entries(query).forEach(([key, value]) => {
+        if (value !== undefined && value !== null) {
+          url.searchParams.append(key, String(value));
+        }
+      });
+    }
+
+    return url.toString();
+  }
+
   async post<T>(path: string, body?: unknown): Promise<T> {
     const url = new URL(path, this.baseUrl);
 
@@ -107,6 +125,69 @@ export async function fetchLotData(lot_id: number) {
   return apiClient.get<Lot>(`/lots/${lot_id}`);
 }
 
+export type LotStreamMessage =
+  | { type: "snapshot"; lots: Lot[] }
+  | { type: "delta"; lot: Lot }
+  | { type: "keepalive" };
+
+const LOT_STREAM_RETRY_MS = 5000;
+
+// Pushes the current state of each watched lot, then every change to it, instead of polling /lots/{lot_id}
+// onConnectionChange reports when the socket opens or drops, callers poll only while it is down; a dropped socket
+// is reopened every LOT_STREAM_RETRY_MS. Returns a function that closes the stream
+export function subscribeLotUpdates(
+  lotIds: number[],
+  onLot: (lot: Lot) => void,
+  onConnectionChange?: (connected: boolean) => void
+) {
+  let socket: WebSocket | null = null;
+  let retryTimer: ReturnType<typeof setTimeout> | null = null;
+  let closed = false;
+
+  const connect = () => {
+    socket = new WebSocket(
+      apiClient.socketUrl("/ws/lots", { lot_ids: lotIds.join(",") })
+    );
+
+    socket.onopen = () => {
+      onConnectionChange?.(true);
+    };
+
+    socket.onmessage = (event) => {
+      let message: LotStreamMessage;
+      try {
+        message = JSON.parse(String(event.data)) as LotStreamMessage;
+      } catch {
+        return;
+      }
+
+      if (message.type === "snapshot") {
+        message.lots.forEach(onLot);
+      } else if (message.type === "delta") {
+        onLot(message.lot);
+      }
+    };
+
+    socket.onclose = () => {
+      if (closed) {
+        return;
+      }
+      onConnectionChange?.(false);
+      retryTimer = setTimeout(connect, LOT_STREAM_RETRY_MS);
+    };
+  };
+
+  connect();
+
+  return () => {
+    closed = true;
+    if (retryTimer != null) {
+      clearTimeout(retryTimer);
+    }
+    socket?.close();
+  };
+}
+
 export async function randomizeData(lot_id: number) {
   return apiClient.post<Lot>(`/randomize_lot/${lot_id}`);
 }
@@ -130,10 +211,13 @@ export async function fetchLotFullnessPercentages() {
 
 export async function randomize_all_lot_events(
   lot_id: number,
-  all_lots: boolean
+  all_lots: boolean,
+  seed?: number
 ) {
-  return apiClient.post<null>(
-    `/randomize_all_lot_events/${lot_id}/${all_lots}`
+  const query =
+    typeof seed === "number" ? `?seed=${encodeURIComponent(String(seed))}` : "";
+  return apiClient.post<Lot[]>(
+    `/randomize_all_lot_events/${lot_id}/${all_lots}${query}`
   );
 }
 
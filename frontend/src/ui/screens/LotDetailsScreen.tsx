@@ -12,7 +12,12 @@ import { RouteProp, useNavigation, useRoute } from '@react-navigation/native';
 import type { NativeStackNavigationProp } from '@react-navigation/native-stack';
 
 import { getLang } from '../../langSave';
-import { fetchLotData, fetchLotFullnessPercentages, Lot as LotData, randomizeData } from '../../api/api';
+import {
+  fetchLotData,
+  fetchLotFullnessPercentages,
+  Lot as LotData,
+  subscribeLotUpdates,
+} from '../../api/api';
 import MapboxView from '../MapboxView';
 import type { RootStackParamList } from '../RootNavigator';
 import { LOTS } from '../data/campusLots';
@@ -51,6 +56,7 @@ const POPULAR_TIMES_SEED = [0.2, 0.8, 0.5, 0.7, 0.8, 0.95, 0.9, 0.7, 0.8, 0.7, 0
 const CONDENSED_LABEL_TICKS = new Set(['7AM', '12PM', '5PM', '8PM']);
 const POPULAR_TIMES_BAR_HEIGHT = 144;
 const POPULAR_TIMES_HOUR_SET = new Set(POPULAR_TIMES_HOURS);
+const LOT_POLL_INTERVAL_MS = 15000;
 
 const LOT_ZOOM_BY_ID: Record<number, number> = {
   5: 16.35,
@@ -87,6 +93,21 @@ const POPULAR_TIMES_PROFILE: PopularTimesBar[] = POPULAR_TIMES_HOURS.map((hour,
   busynessPercent: POPULAR_TIMES_SEED[index] * 100,
 }));
 
+// Map fullness keyed by both lot id and lot name, for every campus lot with a usable percentage
+function fullnessForLots(byId: Record<string, number>): Record<string, number> {
+  const next: Record<string, number> = {};
+  LOTS.forEach((lotEntry) => {
+    const percent = byId[String(lotEntry.id)];
+    if (typeof percent !== 'number' || !Number.isFinite(percent)) {
+      return;
+    }
+
+    next[String(lotEntry.id)] = percent;
+    next[lotEntry.name] = percent;
+  });
+  return next;
+}
+
 function getCurrentPopularTimesHour(date: Date): string | null {
   const rawHour = date.getHours();
   const normalizedHour = rawHour % 12 || 12;
@@ -214,6 +235,8 @@ export default function LotDetailsScreen() {
   const lot = useMemo(() => LOTS.find((entry) => entry.id === lotId), [lotId]);
   const [lotData, setLotData] = useState<LotData | null>(null);
   const [lotFullnessById, setLotFullnessById] = useState<Record<string, number>>({});
+  // null until the first connection attempt settles
+  const [streamConnected, setStreamConnected] = useState<boolean | null>(null);
 
   useEffect(() => {
     const intervalId = setInterval(() => {
@@ -225,69 +248,64 @@ export default function LotDetailsScreen() {
     };
   }, []);
 
+  // Live occupancy pushed by the API: a snapshot of every campus lot on connect, then each change. Feeds both this
+  // lot's details and the map colors, nothing is polled while the socket is open
   useEffect(() => {
-    let active = true;
-
-    async function loadLotDetails() {
-      try {
-        const nextLotData = await fetchLotData(lotId);
-        if (active) {
+    setStreamConnected(null);
+    const unsubscribe = subscribeLotUpdates(
+      LOTS.map((lotEntry) => lotEntry.id),
+      (nextLotData) => {
+        if (nextLotData.lot_id === lotId) {
           setLotData(nextLotData);
         }
-      } catch {
-        try {
-          await randomizeData(lotId);
-          const nextLotData = await fetchLotData(lotId);
-          if (active) {
-            setLotData(nextLotData);
-          }
-        } catch {
-          if (active) {
-            setLotData(null);
-          }
-        }
-      }
-    }
 
-    void loadLotDetails();
+        const percent = Math.max(0, Math.min(100, nextLotData.percent_full));
+        setLotFullnessById((current) => ({
+          ...current,
+          ...fullnessForLots({ [String(nextLotData.lot_id)]: percent }),
+        }));
+      },
+      setStreamConnected
+    );
 
-    return () => {
-      active = false;
-    };
+    return unsubscribe;
   }, [lotId]);
 
+  // Fallback while the socket is down (it keeps reconnecting): poll the lot and the map fullness instead
   useEffect(() => {
+    if (streamConnected !== false) {
+      return;
+    }
+
     let active = true;
 
-    fetchLotFullnessPercentages()
-      .then((byId) => {
-        if (!active) {
-          return;
-        }
+    async function poll() {
+      const [lotResult, fullnessResult] = await Promise.allSettled([
+        fetchLotData(lotId),
+        fetchLotFullnessPercentages(),
+      ]);
+      if (!active) {
+        return;
+      }
 
-        const next: Record<string, number> = {};
-        LOTS.forEach((lotEntry) => {
-          const percent = byId[String(lotEntry.id)];
-          if (typeof percent !== 'number' || !Number.isFinite(percent)) {
-            return;
-          }
-
-          next[String(lotEntry.id)] = percent;
-          next[lotEntry.name] = percent;
-        });
-
-        setLotFullnessById(next);
-      })
-      .catch(() => {
-        if (active) {
-          setLotFullnessById({});
-        }
-      });
+      if (lotResult.status === 'fulfilled') {
+        setLotData(lotResult.value);
+      }
+      if (fullnessResult.status === 'fulfilled') {
+        setLotFullnessById(fullnessForLots(fullnessResult.value));
+      }
+    }
+
+    void poll();
+    const intervalId = setInterval(() => {
+      void poll();
+    }, LOT_POLL_INTERVAL_MS);
 
     return () => {
       active = false;
+      clearInterval(intervalId);
     };
-  }, []);
+  }, [lotId, streamConnected]);
 
   const total = lotData?.total_capacity ?? null;
   const occupied = lotData?.current ?? null;